@@ -1,16 +1,17 @@
 import os
 from datetime import datetime, timedelta
+from typing import Optional
 
 from dotenv import load_dotenv
-from fastapi import Depends, HTTPException, status
+from fastapi import Cookie, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from passlib import pwd
 from passlib.context import CryptContext
 
 import app.models as models
+import app.prepared as prepared
 import app.schemas as schemas
-from app.database import SessionLocal, get_db
+from app.database import READ_YOUR_WRITES_COOKIE, SessionLocal, get_db, read_session
 
 load_dotenv()
 
@@ -51,7 +52,7 @@ def create_access_token(data: dict, expires_delta: timedelta):
     return encoded_jwt
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: SessionLocal = Depends(get_db)):
+def _user_from_token(db, token: str):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Credenziali non valide.",
@@ -65,23 +66,49 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: SessionLocal
         token_data = schemas.TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = db.query(models.User).filter(models.User.username == token_data.username).join(models.Client,
-                                                                                          models.User.client_id == models.Client.id).first()
+    user = prepared.cached(db.query(models.User).filter(models.User.username == token_data.username).join(
+        models.Client, models.User.client_id == models.Client.id)).first()
     if user is None:
         raise credentials_exception
     return user
 
 
+def get_current_user(token: str = Depends(oauth2_scheme), db: SessionLocal = Depends(get_db)):
+    return _user_from_token(db, token)
+
+
+def get_read_db(last_write_lsn: Optional[str] = Cookie(None, alias=READ_YOUR_WRITES_COOKIE)):
+    db = None
+    try:
+        db = read_session(last_write_lsn)
+        yield db
+    finally:
+        if db is not None:
+            db.close()
+
+
+def get_current_read_user(token: str = Depends(oauth2_scheme), db: SessionLocal = Depends(get_read_db)):
+    return _user_from_token(db, token)
+
+
 async def get_current_active_user(current_user: models.User = Depends(get_current_user)):
     return current_user
 
 
-async def is_admin(current_user: models.User = Depends(get_current_user)):
+def _admin(current_user: models.User):
     if not current_user.role_id == 1:
         raise HTTPException(status_code=403, detail="Non sei autorizzato a fare questa operazione.")
     return current_user
 
 
+async def is_admin(current_user: models.User = Depends(get_current_user)):
+    return _admin(current_user)
+
+
+async def is_read_admin(current_user: models.User = Depends(get_current_read_user)):
+    return _admin(current_user)
+
+
 def get_user_id_from_token(token: str) -> int:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -102,6 +129,7 @@ def reset_password(db: SessionLocal, user_id: int):
     user = db.query(models.User).get(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato.")
+    from passlib import pwd
     tmp_password = pwd.genword()
     tmp_password_hashed = get_password_hash(tmp_password)
     user.temp_password = tmp_password
@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import urlencode
+
+from dotenv import load_dotenv
+from starlette.requests import Request
+
+load_dotenv()
+
+COALESCE_CACHE_SECONDS = float(os.getenv("COALESCE_CACHE_SECONDS", "0"))
+COALESCE_CACHE_SIZE = int(os.getenv("COALESCE_CACHE_SIZE", "32"))
+
+
+def request_key(request: Request):
+    params = sorted((key, value.strip()) for key, value in request.query_params.multi_items() if value.strip())
+    return request.url.path + '?' + urlencode(params)
+
+
+class SingleFlight:
+    def __init__(self, cache_seconds: float = 0, cache_size: int = 32):
+        self.cache_seconds = cache_seconds
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def run(self, key: str, fn):
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached and cached[0] > time.monotonic():
+                self.hits += 1
+                return cached[1]
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+                self.misses += 1
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+                if self.cache_seconds > 0 and not future.exception():
+                    self._store(key, future.result())
+
+    def _store(self, key: str, result):
+        now = time.monotonic()
+        for stale in [cached for cached, (expires, _) in self.cache.items() if expires <= now]:
+            del self.cache[stale]
+        while len(self.cache) >= self.cache_size:
+            del self.cache[min(self.cache, key=lambda cached: self.cache[cached][0])]
+        self.cache[key] = (now + self.cache_seconds, result)
+
+
+pdf = SingleFlight(cache_seconds=COALESCE_CACHE_SECONDS, cache_size=COALESCE_CACHE_SIZE)
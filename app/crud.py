@@ -3,16 +3,26 @@ from typing import Optional
 from zoneinfo import ZoneInfo
 
 from fastapi import HTTPException
-from passlib import pwd
-from sqlalchemy import extract, or_, and_, func, Float, text, desc
-from sqlalchemy.orm import aliased
+from pydantic import ValidationError
+from sqlalchemy import or_, and_, func, Float, text, desc, select, update, not_, case, exists, table, column, \
+    union_all
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, undefer
 
 import app.auth as auth
 import app.models as models
+import app.prepared as prepared
 import app.schemas as schemas
 from app.database import SessionLocal
 
 
+def _returning(db: SessionLocal, stmt, model, *options):
+    stmt = stmt.returning(*model.__table__.c)
+    return db.execute(select(model).from_statement(stmt).options(*options).execution_options(
+        populate_existing=True)).scalars().first()
+
+
 def get_plant_by_client(db: SessionLocal, client_id: int):
     return db.query(models.Plant).filter(models.Plant.client_id == client_id).all()
 
@@ -22,15 +32,13 @@ def get_machine_by_plant(db: SessionLocal, plant_id: int):
 
 
 def create_machine(db: SessionLocal, machine: schemas.MachineCreate):
-    db_machine = models.Machine(date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")), name=machine.name,
-                                code=machine.code,
-                                brand=machine.brand, model=machine.model, serial_number=machine.serial_number,
-                                production_year=machine.production_year, cost_center=machine.cost_center,
-                                description=machine.description, plant_id=machine.plant_id,
-                                robotic_island=machine.robotic_island)
-    db.add(db_machine)
+    db_machine = _returning(db, insert(models.Machine).values(
+        date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")), name=machine.name, code=machine.code,
+        brand=machine.brand, model=machine.model, serial_number=machine.serial_number,
+        production_year=machine.production_year, cost_center=machine.cost_center,
+        description=machine.description, plant_id=machine.plant_id,
+        robotic_island=machine.robotic_island), models.Machine)
     db.commit()
-    db.refresh(db_machine)
     return db_machine
 
 
@@ -101,7 +109,7 @@ def get_reports(db: SessionLocal, user_id: Optional[int] = None, limit: Optional
 
 def get_report_by_id(db: SessionLocal, report_id: int):
     supervisor = aliased(models.User)
-    return db.query(
+    query = db.query(
         models.Report,
         models.Commission.id.label("commission_id"),
         models.Commission.code.label("commission_code"),
@@ -131,10 +139,10 @@ def get_report_by_id(db: SessionLocal, report_id: int):
         models.User, models.Report.operator_id == models.User.id).outerjoin(
         models.Plant, models.Machine.plant_id == models.Plant.id
     ).join(
-        models.Client,
-        or_(models.Plant.client_id == models.Client.id, models.Commission.client_id == models.Client.id)
+        models.Client, func.coalesce(models.Plant.client_id, models.Commission.client_id) == models.Client.id
     ).join(supervisor, models.Report.supervisor_id == supervisor.id
-           ).filter(models.Report.id == report_id).first()
+           ).filter(models.Report.id == report_id)
+    return prepared.cached(query).first()
 
 
 def get_months(db: SessionLocal, user_id: Optional[int] = None, client_id: Optional[int] = None):
@@ -148,12 +156,27 @@ def get_months(db: SessionLocal, user_id: Optional[int] = None, client_id: Optio
     return sorted(set([datetime.datetime.strftime(date[0], "%m/%Y") for date in dates]))
 
 
+def _reports(archive: bool = False):
+    if not archive:
+        return models.Report
+    columns = models.Report.__table__.c
+    archived = table('reports_archive', *[column(c.name, c.type) for c in columns])
+    return aliased(models.Report, union_all(select(*columns), select(*archived.c)).subquery('reports_all'),
+                   name='Report')
+
+
+def _month_range(month: str):
+    start_date = datetime.datetime.strptime(month, "%m/%Y").date()
+    return start_date, (start_date + datetime.timedelta(days=32)).replace(day=1)
+
+
 def get_monthly_reports(db: SessionLocal, month: Optional[str] = '0', user_id: Optional[int] = 0,
                         client_id: Optional[int] = 0,
-                        plant_id: Optional[int] = 0, work_id: Optional[int] = 0):
+                        plant_id: Optional[int] = 0, work_id: Optional[int] = 0, archive: bool = False):
+    report = _reports(archive)
     supervisor = aliased(models.User)
     query = db.query(
-        models.Report,
+        report,
         models.Commission.id.label("commission_id"),
         models.Commission.code.label("commission_code"),
         models.Commission.description.label("commission_description"),
@@ -174,44 +197,41 @@ def get_monthly_reports(db: SessionLocal, month: Optional[str] = '0', user_id: O
         supervisor.id.label("supervisor_id"),
         supervisor.first_name.label("supervisor_first_name"),
         supervisor.last_name.label("supervisor_last_name")
-    ).select_from(models.Report).outerjoin(
+    ).select_from(report).outerjoin(
         models.Commission,
-        and_(models.Report.type == "commission", models.Report.work_id == models.Commission.id)
+        and_(report.type == "commission", report.work_id == models.Commission.id)
     ).outerjoin(
         models.Machine,
-        and_(models.Report.type == "machine", models.Report.work_id == models.Machine.id)
-    ).join(models.User, models.Report.operator_id == models.User.id).outerjoin(
+        and_(report.type == "machine", report.work_id == models.Machine.id)
+    ).join(models.User, report.operator_id == models.User.id).outerjoin(
         models.Plant, models.Machine.plant_id == models.Plant.id
     ).join(
-        models.Client,
-        or_(models.Plant.client_id == models.Client.id, models.Commission.client_id == models.Client.id)
-    ).join(supervisor, models.Report.supervisor_id == supervisor.id)
+        models.Client, func.coalesce(models.Plant.client_id, models.Commission.client_id) == models.Client.id
+    ).join(supervisor, report.supervisor_id == supervisor.id)
     if month != '0':
-        start_date = datetime.datetime.strptime(month, "%m/%Y").date()
-        query = query.filter(
-            extract('month', models.Report.date) == start_date.month,
-            extract('year', models.Report.date) == start_date.year
-        )
+        start_date, end_date = _month_range(month)
+        query = query.filter(report.date >= start_date, report.date < end_date)
     if user_id:
-        query = query.filter(models.Report.operator_id == user_id)
+        query = query.filter(report.operator_id == user_id)
     if client_id:
         query = query.filter(models.Client.id == client_id)
     if plant_id == 0:
-        query = query.filter(models.Report.type == "machine")
+        query = query.filter(report.type == "machine")
     if plant_id != 0:
         query = query.filter(models.Plant.id == plant_id)
     if work_id:
-        query = query.filter(models.Report.work_id == work_id)
-    return query.order_by(models.Report.date).all()
+        query = query.filter(report.work_id == work_id)
+    return query.order_by(report.date).all()
 
 
 def get_interval_reports(db: SessionLocal, start_date: Optional[str] = None, end_date: Optional[str] = None,
                          user_id: Optional[int] = 0,
                          client_id: Optional[int] = 0,
-                         plant_id: Optional[int] = 0, work_id: Optional[int] = 0):
+                         plant_id: Optional[int] = 0, work_id: Optional[int] = 0, archive: bool = False):
+    report = _reports(archive)
     supervisor = aliased(models.User)
     query = db.query(
-        models.Report,
+        report,
         models.Commission.id.label("commission_id"),
         models.Commission.code.label("commission_code"),
         models.Commission.description.label("commission_description"),
@@ -232,48 +252,49 @@ def get_interval_reports(db: SessionLocal, start_date: Optional[str] = None, end
         supervisor.id.label("supervisor_id"),
         supervisor.first_name.label("supervisor_first_name"),
         supervisor.last_name.label("supervisor_last_name")
-    ).select_from(models.Report).outerjoin(
+    ).select_from(report).outerjoin(
         models.Commission,
-        and_(models.Report.type == "commission", models.Report.work_id == models.Commission.id)
+        and_(report.type == "commission", report.work_id == models.Commission.id)
     ).outerjoin(
         models.Machine,
-        and_(models.Report.type == "machine", models.Report.work_id == models.Machine.id)
-    ).join(models.User, models.Report.operator_id == models.User.id).outerjoin(
+        and_(report.type == "machine", report.work_id == models.Machine.id)
+    ).join(models.User, report.operator_id == models.User.id).outerjoin(
         models.Plant, models.Machine.plant_id == models.Plant.id
     ).join(
-        models.Client,
-        or_(models.Plant.client_id == models.Client.id, models.Commission.client_id == models.Client.id)
-    ).join(supervisor, models.Report.supervisor_id == supervisor.id)
+        models.Client, func.coalesce(models.Plant.client_id, models.Commission.client_id) == models.Client.id
+    ).join(supervisor, report.supervisor_id == supervisor.id)
     if start_date != '' and end_date != '':
-        start_date_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d")
-        end_date_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d")
-        query = query.filter(models.Report.date >= start_date_dt,
-                             models.Report.date <= end_date_dt)
+        start_date_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
+        end_date_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d").date()
+        query = query.filter(report.date >= start_date_dt,
+                             report.date <= end_date_dt)
     else:
         if start_date != '':
-            start_date_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d")
-            query = query.filter(models.Report.date >= start_date_dt)
+            start_date_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
+            query = query.filter(report.date >= start_date_dt)
         if end_date != '':
-            end_date_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d")
-            query = query.filter(models.Report.date <= end_date_dt)
+            end_date_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d").date()
+            query = query.filter(report.date <= end_date_dt)
     if user_id:
-        query = query.filter(models.Report.operator_id == user_id)
+        query = query.filter(report.operator_id == user_id)
     if client_id:
         query = query.filter(models.Client.id == client_id)
     if plant_id == 0:
-        query = query.filter(models.Report.type == "machine")
+        query = query.filter(report.type == "machine")
     if plant_id != 0:
         query = query.filter(models.Plant.id == plant_id)
     if work_id:
-        query = query.filter(models.Report.work_id == work_id)
-    return query.order_by(models.Report.date).all()
+        query = query.filter(report.work_id == work_id)
+    return query.order_by(report.date).all()
 
 
 def get_monthly_commission_reports(db: SessionLocal, month: str, user_id: Optional[int] = None,
-                                   client_id: Optional[int] = None, work_id: Optional[int] = None):
+                                   client_id: Optional[int] = None, work_id: Optional[int] = None,
+                                   archive: bool = False):
+    report = _reports(archive)
     supervisor = aliased(models.User)
     query = db.query(
-        models.Report,
+        report,
         models.Commission.id.label("commission_id"),
         models.Commission.code.label("commission_code"),
         models.Commission.description.label("commission_description"),
@@ -285,33 +306,32 @@ def get_monthly_commission_reports(db: SessionLocal, month: str, user_id: Option
         supervisor.id.label("supervisor_id"),
         supervisor.first_name.label("supervisor_first_name"),
         supervisor.last_name.label("supervisor_last_name")
-    ).select_from(models.Report).join(
+    ).select_from(report).join(
         models.Commission,
-        and_(models.Report.type == "commission", models.Report.work_id == models.Commission.id)
-    ).join(models.User, models.Report.operator_id == models.User.id).join(
+        and_(report.type == "commission", report.work_id == models.Commission.id)
+    ).join(models.User, report.operator_id == models.User.id).join(
         models.Client, models.Commission.client_id == models.Client.id
-    ).join(supervisor, models.Report.supervisor_id == supervisor.id)
+    ).join(supervisor, report.supervisor_id == supervisor.id)
     if month != '0':
-        start_date = datetime.datetime.strptime(month, "%m/%Y").date()
-        query = query.filter(
-            extract('month', models.Report.date) == start_date.month,
-            extract('year', models.Report.date) == start_date.year
-        )
+        start_date, end_date = _month_range(month)
+        query = query.filter(report.date >= start_date, report.date < end_date)
     if user_id:
-        query = query.filter(models.Report.operator_id == user_id)
+        query = query.filter(report.operator_id == user_id)
     if client_id:
         query = query.filter(models.Client.id == client_id)
     if work_id:
-        query = query.filter(models.Report.work_id == work_id)
-    return query.order_by(models.Report.date).all()
+        query = query.filter(report.work_id == work_id)
+    return query.order_by(report.date).all()
 
 
 def get_interval_commission_reports(db: SessionLocal, start_date: Optional[str] = None, end_date: Optional[str] = None,
                                     user_id: Optional[int] = None,
-                                    client_id: Optional[int] = None, work_id: Optional[int] = None):
+                                    client_id: Optional[int] = None, work_id: Optional[int] = None,
+                                    archive: bool = False):
+    report = _reports(archive)
     supervisor = aliased(models.User)
     query = db.query(
-        models.Report,
+        report,
         models.Commission.id.label("commission_id"),
         models.Commission.code.label("commission_code"),
         models.Commission.description.label("commission_description"),
@@ -323,39 +343,38 @@ def get_interval_commission_reports(db: SessionLocal, start_date: Optional[str]
         supervisor.id.label("supervisor_id"),
         supervisor.first_name.label("supervisor_first_name"),
         supervisor.last_name.label("supervisor_last_name")
-    ).select_from(models.Report).join(
+    ).select_from(report).join(
         models.Commission,
-        and_(models.Report.type == "commission", models.Report.work_id == models.Commission.id)
-    ).join(models.User, models.Report.operator_id == models.User.id).join(
+        and_(report.type == "commission", report.work_id == models.Commission.id)
+    ).join(models.User, report.operator_id == models.User.id).join(
         models.Client, models.Commission.client_id == models.Client.id
-    ).join(supervisor, models.Report.supervisor_id == supervisor.id)
+    ).join(supervisor, report.supervisor_id == supervisor.id)
     if start_date != '' and end_date != '':
-        start_date_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d")
-        end_date_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d")
-        query = query.filter(models.Report.date >= start_date_dt,
-                             models.Report.date <= end_date_dt)
+        start_date_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
+        end_date_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d").date()
+        query = query.filter(report.date >= start_date_dt,
+                             report.date <= end_date_dt)
     else:
         if start_date != '':
-            start_date_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d")
-            query = query.filter(models.Report.date >= start_date_dt)
+            start_date_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
+            query = query.filter(report.date >= start_date_dt)
         if end_date != '':
-            end_date_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d")
-            query = query.filter(models.Report.date <= end_date_dt)
+            end_date_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d").date()
+            query = query.filter(report.date <= end_date_dt)
     if user_id:
-        query = query.filter(models.Report.operator_id == user_id)
+        query = query.filter(report.operator_id == user_id)
     if client_id:
         query = query.filter(models.Client.id == client_id)
     if work_id:
-        query = query.filter(models.Report.work_id == work_id)
-    return query.order_by(models.Report.date).all()
+        query = query.filter(report.work_id == work_id)
+    return query.order_by(report.date).all()
 
 
 def get_daily_hours_in_month(db: SessionLocal, month: str, user_id: int):
-    start_date = datetime.datetime.strptime(month, "%m/%Y").date()
-    end_date = (start_date.replace(day=1) + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+    start_date, end_date = _month_range(month)
     dates = []
     current_date = start_date
-    while current_date <= end_date:
+    while current_date < end_date:
         dates.append(current_date)
         current_date += datetime.timedelta(days=1)
     query = db.query(
@@ -364,7 +383,7 @@ def get_daily_hours_in_month(db: SessionLocal, month: str, user_id: int):
         func.count().label('count')
     ).filter(
         models.Report.date >= start_date,
-        models.Report.date < end_date + datetime.timedelta(days=1),
+        models.Report.date < end_date,
         models.Report.operator_id == user_id
     ).group_by(
         func.date_trunc('day', models.Report.date)
@@ -468,10 +487,11 @@ def edit_machine(db: SessionLocal, machine_id: int, machine: schemas.MachineCrea
 
 
 def get_user_by_id(db: SessionLocal, user_id: int):
-    return db.query(models.User, models.Role.name.label('role'), models.Client.name.label('client_name'),
-                    models.Client.city.label('client_city')).join(models.Role,
-                                                                  models.User.role_id == models.Role.id).join(
-        models.Client, models.User.client_id == models.Client.id).filter(models.User.id == user_id).first()
+    return prepared.cached(db.query(models.User, models.Role.name.label('role'),
+                                    models.Client.name.label('client_name'),
+                                    models.Client.city.label('client_city')).join(
+        models.Role, models.User.role_id == models.Role.id).join(
+        models.Client, models.User.client_id == models.Client.id).filter(models.User.id == user_id)).first()
 
 
 def get_client_by_id(db: SessionLocal, client_id: int):
@@ -479,9 +499,9 @@ def get_client_by_id(db: SessionLocal, client_id: int):
 
 
 def get_plant_by_id(db: SessionLocal, plant_id: int):
-    return db.query(models.Plant, models.Client).filter(models.Plant.id == plant_id).join(
+    return prepared.cached(db.query(models.Plant, models.Client).filter(models.Plant.id == plant_id).join(
         models.Client,
-        models.Plant.client_id == models.Client.id).first()
+        models.Plant.client_id == models.Client.id)).first()
 
 
 def get_commission_by_id(db: SessionLocal, commission_id: int):
@@ -491,35 +511,39 @@ def get_commission_by_id(db: SessionLocal, commission_id: int):
 
 
 def get_machine_by_id(db: SessionLocal, machine_id: int):
-    return db.query(models.Machine, models.Plant, models.Client).filter(models.Machine.id == machine_id).join(
+    return prepared.cached(db.query(models.Machine, models.Plant, models.Client).filter(
+        models.Machine.id == machine_id).join(
         models.Plant,
         models.Machine.plant_id == models.Plant.id).join(
-        models.Client, models.Plant.client_id == models.Client.id).first()
+        models.Client, models.Plant.client_id == models.Client.id)).first()
 
 
 def create_user(db: SessionLocal, user: schemas.UserCreate):
-    db_user = db.query(models.User).filter(models.User.username == user.username).first()
-    if db_user:
-        raise HTTPException(status_code=400, detail="Username già registrato")
-    db_user = db.query(models.User).filter(models.User.email == user.email).first()
-    if db_user:
-        raise HTTPException(status_code=400, detail="Email già registrata")
+    from passlib import pwd
     tmp_password = user.password if user.password else pwd.genword()
     tmp_password_hashed = auth.get_password_hash(tmp_password)
-    db_user = models.User(first_name=user.first_name, last_name=user.last_name, email=user.email,
-                          phone_number=user.phone_number, username=user.username, role_id=user.role_id,
-                          client_id=user.client_id, temp_password=tmp_password, password=tmp_password_hashed)
-    db.add(db_user)
+    try:
+        db_user = _returning(db, insert(models.User).values(
+            first_name=user.first_name, last_name=user.last_name, email=user.email,
+            phone_number=user.phone_number, username=user.username, role_id=user.role_id,
+            client_id=user.client_id, temp_password=tmp_password, password=tmp_password_hashed
+        ).on_conflict_do_nothing(index_elements=[models.User.username]), models.User,
+            undefer(models.User.temp_password))
+    except IntegrityError:
+        db.rollback()
+        if db.query(models.User.id).filter(models.User.email == user.email).first():
+            raise HTTPException(status_code=400, detail="Email già registrata")
+        raise
+    if db_user is None:
+        raise HTTPException(status_code=400, detail="Username già registrato")
     db.commit()
-    db.refresh(db_user)
     return db_user
 
 
 def delete_user(db: SessionLocal, user_id: int, current_user_id: int):
     user = db.query(models.User).get(user_id)
-    if user_id == 1 or user_id == current_user_id or db.query(models.User).filter(
-            models.Report.operator_id == user_id).first() or db.query(models.User).filter(
-        models.Report.supervisor_id == user_id).first():
+    if user_id == 1 or user_id == current_user_id or db.query(exists().where(
+            or_(models.Report.operator_id == user_id, models.Report.supervisor_id == user_id))).scalar():
         raise HTTPException(status_code=403, detail="Non puoi eliminare questo utente")
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato")
@@ -595,16 +619,15 @@ def create_report(db: SessionLocal, report: schemas.ReportCreate, user_id: int):
         report.trip_kms = '0.0'
     if report.cost == '':
         report.cost = '0.0'
-    db_report = models.Report(date=report.date, intervention_duration=report.intervention_duration,
-                              intervention_type=report.intervention_type, type=report.type,
-                              intervention_location=report.intervention_location,
-                              work_id=report.work_id, description=report.description,
-                              supervisor_id=report.supervisor_id,
-                              notes=report.notes, trip_kms=report.trip_kms, cost=report.cost, operator_id=user_id,
-                              date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")))
-    db.add(db_report)
+    db_report = _returning(db, insert(models.Report).values(
+        date=report.date, intervention_duration=report.intervention_duration,
+        intervention_type=report.intervention_type, type=report.type,
+        intervention_location=report.intervention_location,
+        work_id=report.work_id, description=report.description,
+        supervisor_id=report.supervisor_id,
+        notes=report.notes, trip_kms=report.trip_kms, cost=report.cost, operator_id=user_id,
+        date_created=datetime.datetime.now(ZoneInfo("Europe/Rome"))), models.Report)
     db.commit()
-    db.refresh(db_report)
     return db_report
 
 
@@ -612,25 +635,22 @@ def create_commission(db: SessionLocal, commission: schemas.CommissionCreate):
     db_commission = db.query(models.Commission).filter(models.Commission.code == commission.code).first()
     if db_commission:
         raise HTTPException(status_code=400, detail="Codice commessa già registrato")
-    db_commission = models.Commission(date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")),
-                                      code=commission.code, description=commission.description,
-                                      client_id=commission.client_id, open=True)
-    db.add(db_commission)
+    db_commission = _returning(db, insert(models.Commission).values(
+        date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")), code=commission.code,
+        description=commission.description, client_id=commission.client_id, open=True), models.Commission)
     db.commit()
-    db.refresh(db_commission)
     return db_commission
 
 
 def create_client(db: SessionLocal, client: schemas.ClientCreate):
-    if db.query(models.Client).filter(models.Client.name == client.name).first():
+    db_client = _returning(db, insert(models.Client).values(
+        name=client.name, address=client.address, city=client.city, email=client.email,
+        phone_number=client.phone_number, contact=client.contact, province=client.province, cap=client.cap,
+        date_created=datetime.datetime.now(ZoneInfo("Europe/Rome"))
+    ).on_conflict_do_nothing(index_elements=[models.Client.name]), models.Client)
+    if db_client is None:
         raise HTTPException(status_code=400, detail="Cliente già registrato")
-    db_client = models.Client(name=client.name, address=client.address, city=client.city, email=client.email,
-                              phone_number=client.phone_number, contact=client.contact, province=client.province,
-                              cap=client.cap,
-                              date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")))
-    db.add(db_client)
     db.commit()
-    db.refresh(db_client)
     return db_client
 
 
@@ -656,17 +676,87 @@ def create_plant(db: SessionLocal, plant: schemas.PlantCreate):
     exists = db.query(models.Plant).filter(models.Plant.address == plant.address).first()
     if exists:
         raise HTTPException(status_code=400, detail="Esiste già uno stabilimento con questo indirizzo")
-    db_plant = models.Plant(date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")), name=plant.name,
-                            address=plant.address,
-                            province=plant.province, cap=plant.cap,
-                            city=plant.city, email=plant.email, phone_number=plant.phone_number, contact=plant.contact,
-                            client_id=plant.client_id)
-    db.add(db_plant)
+    db_plant = _returning(db, insert(models.Plant).values(
+        date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")), name=plant.name, address=plant.address,
+        province=plant.province, cap=plant.cap, city=plant.city, email=plant.email,
+        phone_number=plant.phone_number, contact=plant.contact, client_id=plant.client_id), models.Plant)
     db.commit()
-    db.refresh(db_plant)
     return db_plant
 
 
+def _import_row(schema, row: dict):
+    return schema(**{key: value if value != '' else None for key, value in row.items() if key})
+
+
+def _import_error(line: int, exc: ValidationError):
+    return {"row": line, "detail": ", ".join(
+        '.'.join(str(loc) for loc in error['loc']) + ': ' + error['msg'] for error in exc.errors())}
+
+
+def import_plants(db: SessionLocal, rows, batch_size: int = 1000):
+    plants, errors, client_names = [], [], set()
+    for line, row in enumerate(rows, start=2):
+        client_name = row.pop('client_name', None)
+        if not row.get('client_id') and client_name:
+            client_names.add(client_name)
+            row['client_id'] = 0
+        try:
+            plants.append((line, client_name, _import_row(schemas.PlantCreate, row)))
+        except ValidationError as e:
+            errors.append(_import_error(line, e))
+    client_ids = {client.id for client in db.query(models.Client.id).filter(
+        models.Client.id.in_({plant.client_id for _, _, plant in plants if plant.client_id})).all()}
+    client_ids_by_name = dict(db.query(models.Client.name, models.Client.id).filter(
+        models.Client.name.in_(client_names)).all()) if client_names else {}
+    addresses = {plant.address for plant in db.query(models.Plant.address).filter(
+        models.Plant.address.in_({plant.address for _, _, plant in plants})).all()}
+    now = datetime.datetime.now(ZoneInfo("Europe/Rome"))
+    values = []
+    for line, client_name, plant in plants:
+        if not plant.client_id:
+            if not client_name:
+                errors.append({"row": line, "detail": "Cliente non indicato"})
+                continue
+            plant.client_id = client_ids_by_name.get(client_name)
+            if plant.client_id is None:
+                errors.append({"row": line, "detail": "Cliente non trovato: " + client_name})
+                continue
+        elif plant.client_id not in client_ids:
+            errors.append({"row": line, "detail": "Cliente non trovato: " + str(plant.client_id)})
+            continue
+        if plant.address in addresses:
+            errors.append({"row": line, "detail": "Esiste già uno stabilimento con questo indirizzo"})
+            continue
+        addresses.add(plant.address)
+        values.append(dict(plant.dict(), date_created=now))
+    for i in range(0, len(values), batch_size):
+        db.execute(insert(models.Plant), values[i:i + batch_size])
+    db.commit()
+    return {"imported": len(values), "errors": sorted(errors, key=lambda error: error['row'])}
+
+
+def import_machines(db: SessionLocal, rows, batch_size: int = 1000):
+    machines, errors = [], []
+    for line, row in enumerate(rows, start=2):
+        try:
+            machines.append((line, _import_row(schemas.MachineCreate, row)))
+        except ValidationError as e:
+            errors.append(_import_error(line, e))
+    plant_ids = {plant.id for plant in db.query(models.Plant.id).filter(
+        models.Plant.id.in_({machine.plant_id for _, machine in machines})).all()}
+    now = datetime.datetime.now(ZoneInfo("Europe/Rome"))
+    values = []
+    for line, machine in machines:
+        if machine.plant_id not in plant_ids:
+            errors.append({"row": line, "detail": "Stabilimento non trovato: " + str(machine.plant_id)})
+            continue
+        values.append(dict(machine.dict(), date_created=now))
+    for i in range(0, len(values), batch_size):
+        db.execute(insert(models.Machine), values[i:i + batch_size])
+    db.commit()
+    return {"imported": len(values), "errors": sorted(errors, key=lambda error: error['row'])}
+
+
 def change_password(db: SessionLocal, old_password: str, new_password: str, user_id: int):
     user = db.query(models.User).get(user_id)
     if not user:
@@ -705,6 +795,7 @@ def reset_password(db: SessionLocal, user_id: int):
     user = db.query(models.User).get(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato")
+    from passlib import pwd
     tmp_password = pwd.genword()
     tmp_password_hashed = auth.get_password_hash(tmp_password)
     user.temp_password = tmp_password
@@ -715,39 +806,32 @@ def reset_password(db: SessionLocal, user_id: int):
 
 
 def edit_report_email_date(db: SessionLocal, report_id: int, email_date: datetime.datetime):
-    db_report = db.query(models.Report).get(report_id)
+    db_report = _returning(db, update(models.Report).where(models.Report.id == report_id).values(
+        email_date=email_date), models.Report)
     if not db_report:
         raise HTTPException(status_code=404, detail="Intervento non trovato")
-    db_report.email_date = email_date
     db.commit()
-    db.refresh(db_report)
     return db_report
 
 
 def close_commission(db: SessionLocal, commission_id: int):
-    db_commission = db.query(models.Commission).get(commission_id)
+    db_commission = _returning(db, update(models.Commission).where(models.Commission.id == commission_id).values(
+        open=not_(func.coalesce(models.Commission.open, False)),
+        date_closed=case((func.coalesce(models.Commission.open, False), datetime.datetime.now(ZoneInfo("Europe/Rome"))),
+                         else_=None)
+    ), models.Commission)
     if not db_commission:
         raise HTTPException(status_code=404, detail="Commessa non trovata")
-    if not db_commission.open:
-        db_commission.open = True
-        db_commission.date_closed = None
-        db.commit()
-        db.refresh(db_commission)
-        return db_commission
-    db_commission.open = False
-    db_commission.date_closed = datetime.datetime.now(ZoneInfo("Europe/Rome"))
     db.commit()
-    db.refresh(db_commission)
     return db_commission
 
 
 def create_ticket(db: SessionLocal, ticket: schemas.TicketCreate, user_id: int):
-    db_ticket = models.Ticket(title=ticket.title, status='open', priority=ticket.priority,
-                              date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")),
-                              requested_by=user_id, machine_id=ticket.machine_id, description=ticket.description)
-    db.add(db_ticket)
+    db_ticket = _returning(db, insert(models.Ticket).values(
+        title=ticket.title, status='open', priority=ticket.priority,
+        date_created=datetime.datetime.now(ZoneInfo("Europe/Rome")),
+        requested_by=user_id, machine_id=ticket.machine_id, description=ticket.description), models.Ticket)
     db.commit()
-    db.refresh(db_ticket)
     return db_ticket
 
 
@@ -816,3 +900,243 @@ def search_reports(db: SessionLocal, search: str):
             models.User.last_name.ilike(search)
         )
     ).order_by(models.Report.date).all()
+
+
+EXPORT_PARAMS = {
+    ('monthly', 'machine'): ('month', 'user_id', 'client_id', 'plant_id', 'work_id', 'archive'),
+    ('monthly', 'commission'): ('month', 'user_id', 'client_id', 'work_id', 'archive'),
+    ('interval', 'machine'): ('start_date', 'end_date', 'user_id', 'client_id', 'plant_id', 'work_id', 'archive'),
+    ('interval', 'commission'): ('start_date', 'end_date', 'user_id', 'client_id', 'work_id', 'archive'),
+}
+
+
+def create_export_job(db: SessionLocal, export: schemas.ExportCreate, user_id: int):
+    if export.period == 'monthly' and not export.month:
+        raise HTTPException(status_code=400, detail="Mese non specificato")
+    now = datetime.datetime.now(ZoneInfo("Europe/Rome"))
+    db_job = _returning(db, insert(models.ExportJob).values(
+        requested_by=user_id, format=export.format, period=export.period, type=export.type,
+        params=export.dict(include=set(EXPORT_PARAMS[(export.period, export.type)])),
+        status='queued', progress=0, date_created=now, date_updated=now), models.ExportJob)
+    db.commit()
+    return db_job
+
+
+def get_export_job(db: SessionLocal, job_id: int):
+    return db.query(models.ExportJob).filter(models.ExportJob.id == job_id).first()
+
+
+def claim_export_job(db: SessionLocal, job_id: int):
+    db_job = _returning(db, update(models.ExportJob).where(
+        models.ExportJob.id == job_id, models.ExportJob.status == 'queued').values(
+        status='running', progress=0, date_updated=datetime.datetime.now(ZoneInfo("Europe/Rome"))), models.ExportJob)
+    db.commit()
+    return db_job
+
+
+def _plant_id(report):
+    # commission rows carry no plant columns at all
+    return report.plant_id if report.Report.type == 'machine' else None
+
+
+def get_report_recipients(db: SessionLocal, reports: list):
+    client_ids = {report.client_id for report in reports}
+    plant_ids = {_plant_id(report) for report in reports if _plant_id(report)}
+    clients = dict(db.query(models.Client.id, models.Client.email).filter(models.Client.id.in_(client_ids)).all())
+    plants = dict(db.query(models.Plant.id, models.Plant.email).filter(models.Plant.id.in_(plant_ids)).all())
+    return {report.Report.id: (plants.get(_plant_id(report)) or clients.get(report.client_id) or '').strip() or None
+            for report in reports}
+
+
+def create_outbox_message(db: SessionLocal, recipients: list, subject: str, message: bytes, report_ids: list,
+                          user_id: int):
+    now = datetime.datetime.now(ZoneInfo("Europe/Rome"))
+    db_message = _returning(db, insert(models.OutboxMessage).values(
+        requested_by=user_id, recipients=recipients, subject=subject, message=message, report_ids=report_ids,
+        status='queued', attempts=0, next_attempt_at=now, date_created=now, date_updated=now), models.OutboxMessage)
+    db.commit()
+    return db_message
+
+
+def get_outbox_messages(db: SessionLocal, status: Optional[str] = None, limit: int = 100):
+    query = db.query(models.OutboxMessage)
+    if status:
+        query = query.filter(models.OutboxMessage.status == status)
+    return query.order_by(models.OutboxMessage.id.desc()).limit(limit).all()
+
+
+def claim_outbox_message(db: SessionLocal):
+    now = datetime.datetime.now(ZoneInfo("Europe/Rome"))
+    next_id = select(models.OutboxMessage.id).where(
+        models.OutboxMessage.status == 'queued', models.OutboxMessage.next_attempt_at <= now).order_by(
+        models.OutboxMessage.next_attempt_at, models.OutboxMessage.id).limit(1).with_for_update(
+        skip_locked=True).scalar_subquery()
+    db_message = _returning(db, update(models.OutboxMessage).where(models.OutboxMessage.id == next_id).values(
+        status='sending', attempts=models.OutboxMessage.attempts + 1, date_updated=now), models.OutboxMessage,
+        undefer(models.OutboxMessage.message))
+    db.commit()
+    return db_message
+
+
+def complete_outbox_message(db: SessionLocal, message: models.OutboxMessage):
+    now = datetime.datetime.now(ZoneInfo("Europe/Rome"))
+    db.execute(update(models.OutboxMessage).where(models.OutboxMessage.id == message.id).values(
+        status='sent', error=None, date_sent=now, date_updated=now))
+    if message.report_ids:
+        db.execute(update(models.Report).where(models.Report.id.in_(message.report_ids)).values(email_date=now))
+    db.commit()
+
+
+def _invoice_date(value: Optional[str]):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date() if value else None
+
+
+def _invoice_number(value):
+    return str(value) if value is not None else None
+
+
+def get_invoices_by_hash(db: SessionLocal, sha256: str):
+    return db.query(models.Invoice).filter(models.Invoice.sha256 == sha256).order_by(models.Invoice.body).all()
+
+
+def get_invoice_records(db: SessionLocal, invoices: list):
+    for invoice in invoices:
+        yield 'header', {
+            'IdPaese': invoice.supplier_country, 'IdCodice': invoice.supplier_code,
+            'CodiceFiscale': invoice.supplier_tax_code, 'Denominazione': invoice.supplier_name,
+            'RegimeFiscale': invoice.supplier_tax_regime, 'Indirizzo': invoice.supplier_address,
+            'Comune': invoice.supplier_city, 'Provincia': invoice.supplier_province, 'CAP': invoice.supplier_cap,
+            'Nazione': invoice.supplier_nation, 'Data': invoice.date.isoformat() if invoice.date else None,
+            'Numero': invoice.number, 'TipoDocumento': invoice.document_type,
+            'ImportoTotaleDocumento': _invoice_number(invoice.total)}
+        for line in db.query(models.InvoiceLine).filter(models.InvoiceLine.invoice_id == invoice.id).order_by(
+                models.InvoiceLine.id).yield_per(1000):
+            yield 'line', {
+                'NumeroLinea': _invoice_number(line.line_number), 'CodiceArticolo': line.article_codes or [],
+                'Descrizione': line.description, 'Quantita': _invoice_number(line.quantity),
+                'UnitaMisura': line.unit, 'PrezzoUnitario': _invoice_number(line.unit_price),
+                'ScontoMaggiorazione': line.discounts or [], 'PrezzoTotale': _invoice_number(line.total),
+                'AliquotaIVA': _invoice_number(line.vat_rate), 'Natura': line.vat_nature}
+        for summary in db.query(models.InvoiceSummary).filter(
+                models.InvoiceSummary.invoice_id == invoice.id).order_by(models.InvoiceSummary.id).all():
+            yield 'summary', {
+                'AliquotaIVA': _invoice_number(summary.vat_rate), 'Natura': summary.vat_nature,
+                'ImponibileImporto': _invoice_number(summary.taxable), 'Imposta': _invoice_number(summary.tax),
+                'Arrotondamento': _invoice_number(summary.rounding)}
+        for payment in invoice.payments or []:
+            yield 'payment', payment
+        yield 'end', {}
+
+
+def ingest_invoice(db: SessionLocal, sha256: str, filename: str, records, batch_size: int = 1000):
+    invoice_id, body, lines, summaries, payments = None, 0, [], [], []
+
+    def flush():
+        if lines:
+            db.execute(insert(models.InvoiceLine), lines)
+            lines.clear()
+        if summaries:
+            db.execute(insert(models.InvoiceSummary), summaries)
+            summaries.clear()
+
+    for kind, record in records:
+        if kind == 'header':
+            body += 1
+            payments = []
+            invoice_id = db.execute(insert(models.Invoice).values(
+                sha256=sha256, body=body, filename=filename, supplier_name=record['Denominazione'],
+                supplier_vat=(record['IdPaese'] or '') + (record['IdCodice'] or ''),
+                supplier_country=record['IdPaese'], supplier_code=record['IdCodice'],
+                supplier_tax_code=record['CodiceFiscale'], supplier_tax_regime=record['RegimeFiscale'],
+                supplier_address=record['Indirizzo'], supplier_city=record['Comune'],
+                supplier_province=record['Provincia'], supplier_cap=record['CAP'], supplier_nation=record['Nazione'],
+                document_type=record['TipoDocumento'], number=record['Numero'], date=_invoice_date(record['Data']),
+                total=record['ImportoTotaleDocumento'], date_created=datetime.datetime.now(ZoneInfo("Europe/Rome"))
+            ).on_conflict_do_nothing().returning(models.Invoice.id)).scalar()
+        elif invoice_id is None:
+            pass
+        elif kind == 'line':
+            codes = record['CodiceArticolo']
+            lines.append({'invoice_id': invoice_id, 'line_number': record['NumeroLinea'],
+                          'article_code': codes[0][1] if codes else None, 'article_codes': codes,
+                          'description': record['Descrizione'], 'quantity': record['Quantita'],
+                          'unit': record['UnitaMisura'], 'unit_price': record['PrezzoUnitario'],
+                          'discounts': record['ScontoMaggiorazione'], 'vat_rate': record['AliquotaIVA'],
+                          'vat_nature': record['Natura'], 'total': record['PrezzoTotale']})
+            if len(lines) >= batch_size:
+                flush()
+        elif kind == 'summary':
+            summaries.append({'invoice_id': invoice_id, 'vat_rate': record['AliquotaIVA'],
+                              'vat_nature': record['Natura'], 'taxable': record['ImponibileImporto'],
+                              'tax': record['Imposta'], 'rounding': record['Arrotondamento']})
+        elif kind == 'payment':
+            payments.append(record)
+        elif kind == 'end':
+            flush()
+            if payments:
+                db.execute(update(models.Invoice).where(models.Invoice.id == invoice_id).values(payments=payments))
+        yield kind, record
+    flush()
+    db.commit()
+
+
+def store_invoice(db: SessionLocal, sha256: str, filename: str, records):
+    for _ in ingest_invoice(db, sha256=sha256, filename=filename, records=records):
+        pass
+
+
+def _invoice_filters(query, supplier: Optional[str] = None, start_date: Optional[str] = None,
+                     end_date: Optional[str] = None):
+    if supplier:
+        # both arms indexed, so postgres can OR the two index scans together
+        prefix = supplier.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        query = query.filter(or_(models.Invoice.supplier_vat == supplier,
+                                 func.lower(models.Invoice.supplier_name).like(prefix, escape='\\')))
+    if start_date:
+        query = query.filter(models.Invoice.date >= _invoice_date(start_date))
+    if end_date:
+        query = query.filter(models.Invoice.date <= _invoice_date(end_date))
+    return query
+
+
+def get_invoices(db: SessionLocal, supplier: Optional[str] = None, start_date: Optional[str] = None,
+                 end_date: Optional[str] = None, limit: Optional[int] = None):
+    query = _invoice_filters(db.query(models.Invoice), supplier=supplier, start_date=start_date, end_date=end_date)
+    return query.order_by(models.Invoice.date.desc(), models.Invoice.id.desc()).limit(limit).all()
+
+
+def get_invoice_by_id(db: SessionLocal, invoice_id: int):
+    invoice = db.query(models.Invoice).filter(models.Invoice.id == invoice_id).first()
+    if invoice is None:
+        return None
+    return {"invoice": invoice,
+            "lines": db.query(models.InvoiceLine).filter(models.InvoiceLine.invoice_id == invoice_id).order_by(
+                models.InvoiceLine.id).all(),
+            "summaries": db.query(models.InvoiceSummary).filter(
+                models.InvoiceSummary.invoice_id == invoice_id).order_by(models.InvoiceSummary.id).all()}
+
+
+def get_invoice_lines(db: SessionLocal, article_code: Optional[str] = None, supplier: Optional[str] = None,
+                      start_date: Optional[str] = None, end_date: Optional[str] = None, limit: Optional[int] = None):
+    query = db.query(models.InvoiceLine, models.Invoice.supplier_name, models.Invoice.supplier_vat,
+                     models.Invoice.number, models.Invoice.date).join(
+        models.Invoice, models.InvoiceLine.invoice_id == models.Invoice.id)
+    if article_code:
+        query = query.filter(models.InvoiceLine.article_code == article_code)
+    query = _invoice_filters(query, supplier=supplier, start_date=start_date, end_date=end_date)
+    return query.order_by(models.Invoice.date.desc(), models.InvoiceLine.id).limit(limit).all()
+
+
+def get_invoice_spend(db: SessionLocal, group_by: str = 'supplier', supplier: Optional[str] = None,
+                      start_date: Optional[str] = None, end_date: Optional[str] = None):
+    columns = {
+        'supplier': [models.Invoice.supplier_vat, models.Invoice.supplier_name],
+        'article': [models.InvoiceLine.article_code],
+        'month': [func.to_char(models.Invoice.date, 'MM/YYYY').label('month')],
+    }[group_by]
+    query = db.query(*columns, func.sum(models.InvoiceLine.total).label('total'),
+                     func.sum(models.InvoiceLine.quantity).label('quantity'),
+                     func.count(models.InvoiceLine.id).label('lines')).select_from(models.InvoiceLine).join(
+        models.Invoice, models.InvoiceLine.invoice_id == models.Invoice.id)
+    query = _invoice_filters(query, supplier=supplier, start_date=start_date, end_date=end_date)
+    return query.group_by(*columns).order_by(desc('total')).all()
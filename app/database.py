@@ -1,25 +1,160 @@
+import math
 import os
+import re
+import time
+from contextvars import ContextVar
 
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+from starlette.concurrency import run_in_threadpool
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+REPLICA_DATABASE_URL = os.getenv("REPLICA_DATABASE_URL")
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+READ_YOUR_WRITES_COOKIE = "last_write_lsn"
+REPLICA_WAIT_SECONDS = float(os.getenv("REPLICA_WAIT_SECONDS", "2"))
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() == "true"
+REPLICA_POOL_SIZE = int(os.getenv("REPLICA_POOL_SIZE", str(POOL_SIZE)))
+REPLICA_MAX_OVERFLOW = int(os.getenv("REPLICA_MAX_OVERFLOW", str(MAX_OVERFLOW)))
 
-engine = create_engine(DATABASE_URL, pool_recycle=3600, pool_size=5, max_overflow=10, future=True)
-SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+pool_listeners = []
+
+
+class TimedQueuePool(QueuePool):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            for listener in pool_listeners:
+                listener(self, time.perf_counter() - start, True)
+            raise
+        for listener in pool_listeners:
+            listener(self, time.perf_counter() - start, False)
+        return connection
+
+
+def _engine(url: str, name: str, pool_size: int, max_overflow: int, **kwargs):
+    return create_engine(url, poolclass=TimedQueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                         pool_timeout=POOL_TIMEOUT, pool_recycle=POOL_RECYCLE, pool_pre_ping=POOL_PRE_PING,
+                         pool_logging_name=name, future=True, **kwargs)
+
+
+engine = _engine(DATABASE_URL, 'primary', POOL_SIZE, MAX_OVERFLOW)
+SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine))
+
+replica_engine = _engine(REPLICA_DATABASE_URL, 'replica', REPLICA_POOL_SIZE, REPLICA_MAX_OVERFLOW,
+                         connect_args={'options': '-c default_transaction_read_only=on'}) \
+    if REPLICA_DATABASE_URL else engine
+ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=replica_engine)
 
 Base = declarative_base()
 
+current_writes = ContextVar('writes', default=None)
+
+
+@event.listens_for(SessionLocal.session_factory, 'after_flush')
+def _flushed(session, flush_context):
+    if session.new or session.deleted or any(session.is_modified(instance) for instance in session.dirty):
+        session.info['wrote'] = True
+
+
+@event.listens_for(SessionLocal.session_factory, 'do_orm_execute')
+def _executed(state):
+    # crud._returning wraps its INSERT/UPDATE in select().from_statement()
+    if getattr(state.statement, 'element', state.statement).is_dml:
+        state.session.info['wrote'] = True
+
+
+@event.listens_for(SessionLocal.session_factory, 'after_commit')
+def _committed(session):
+    writes = current_writes.get()
+    if session.info.pop('wrote', False) and writes is not None:
+        writes.append(session)
+
+
+@event.listens_for(SessionLocal.session_factory, 'after_rollback')
+def _rolled_back(session):
+    session.info.pop('wrote', None)
+
+
+def current_lsn(db):
+    return db.execute(text('SELECT pg_current_wal_lsn()::text')).scalar()
+
+
+def _primary_lsn():
+    with engine.connect() as connection:
+        return current_lsn(connection)
+
+
+def replayed(replica, lsn: str):
+    return replica.execute(text('SELECT COALESCE(pg_last_wal_replay_lsn() >= CAST(:lsn AS pg_lsn), true)'),
+                           {'lsn': lsn}).scalar()
+
+
+def read_session(lsn: str = None):
+    if replica_engine is engine:
+        return SessionLocal.session_factory()
+    replica = ReplicaSessionLocal()
+    if lsn and re.fullmatch('[0-9A-F]{1,8}/[0-9A-F]{1,8}', lsn) and not replayed(replica, lsn):
+        replica.close()
+        return SessionLocal.session_factory()
+    return replica
+
+
+def caught_up_replica(db):
+    if replica_engine is engine:
+        return None
+    lsn = current_lsn(db)
+    replica = ReplicaSessionLocal()
+    deadline = time.monotonic() + REPLICA_WAIT_SECONDS
+    while not replayed(replica, lsn):
+        replica.rollback()
+        if time.monotonic() > deadline:
+            replica.close()
+            return None
+        time.sleep(0.1)
+    return replica
+
 
 def get_db():
     db = None
     try:
-        db = SessionLocal()
+        db = SessionLocal.session_factory()
         yield db
     finally:
         if db is not None:
             db.close()
+
+
+class ReadYourWritesMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or replica_engine is engine:
+            return await self.app(scope, receive, send)
+        writes = []
+
+        async def send_with_lsn(message):
+            # the client sends this back, so its next reads wait for the replica to replay its own writes
+            if message["type"] == "http.response.start" and writes:
+                cookie = '%s=%s; Max-Age=%d; Path=/; HttpOnly; SameSite=lax' % (
+                    READ_YOUR_WRITES_COOKIE, await run_in_threadpool(_primary_lsn), math.ceil(READ_YOUR_WRITES_SECONDS))
+                message["headers"] = list(message.get("headers", [])) + [(b"set-cookie", cookie.encode())]
+            await send(message)
+
+        token = current_writes.set(writes)
+        try:
+            await self.app(scope, receive, send_with_lsn)
+        finally:
+            current_writes.reset(token)
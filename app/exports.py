@@ -0,0 +1,195 @@
+import datetime
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from zoneinfo import ZoneInfo
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from sqlalchemy import update
+from starlette.responses import FileResponse, StreamingResponse
+
+import app.crud as crud
+import app.models as models
+import app.render as render
+from app.database import SessionLocal, caught_up_replica
+
+load_dotenv()
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", "app/exports")
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+EXPORT_TTL_HOURS = int(os.getenv("EXPORT_TTL_HOURS", "24"))
+EXPORT_STALE_MINUTES = int(os.getenv("EXPORT_STALE_MINUTES", "10"))
+# must stay well under EXPORT_STALE_MINUTES, or resume() in another worker takes over a job that is still running
+EXPORT_HEARTBEAT_SECONDS = float(os.getenv("EXPORT_HEARTBEAT_SECONDS", "60"))
+
+QUERIES = {
+    ('monthly', 'machine'): crud.get_monthly_reports,
+    ('monthly', 'commission'): crud.get_monthly_commission_reports,
+    ('interval', 'machine'): crud.get_interval_reports,
+    ('interval', 'commission'): crud.get_interval_commission_reports,
+}
+
+MEDIA_TYPES = {'pdf': 'application/pdf', 'csv': 'text/csv'}
+
+executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix='export')
+running = set()
+_heartbeat = None
+
+
+def now():
+    return datetime.datetime.now(ZoneInfo("Europe/Rome"))
+
+
+def beat():
+    job_ids = list(running)
+    if not job_ids:
+        return
+    db = SessionLocal()
+    try:
+        db.execute(update(models.ExportJob).where(models.ExportJob.id.in_(job_ids),
+                                                  models.ExportJob.status == 'running').values(date_updated=now()))
+        db.commit()
+    finally:
+        db.close()
+
+
+def heartbeat():
+    while True:
+        time.sleep(EXPORT_HEARTBEAT_SECONDS)
+        try:
+            beat()
+        except Exception:
+            pass
+
+
+def submit(job_id: int):
+    global _heartbeat
+    if _heartbeat is None:
+        _heartbeat = threading.Thread(target=heartbeat, name='export-heartbeat', daemon=True)
+        _heartbeat.start()
+    executor.submit(run, job_id)
+
+
+def filename(job: models.ExportJob):
+    if job.period == 'monthly':
+        suffix = '_' + job.params['month'].replace('/', '-')
+    else:
+        suffix = '_' + '_'.join(date for date in (job.params['start_date'], job.params['end_date']) if date)
+    return 'interventi' + ('_commesse' if job.type == 'commission' else '') + suffix + '.' + job.format
+
+
+def _update(db: SessionLocal, job_id: int, **values):
+    db.execute(update(models.ExportJob).where(models.ExportJob.id == job_id).values(date_updated=now(), **values))
+    db.commit()
+
+
+def run(job_id: int):
+    db = SessionLocal()
+    try:
+        cleanup(db)
+        job = crud.claim_export_job(db, job_id=job_id)
+        if job is None:
+            return
+        running.add(job.id)
+        path = os.path.join(EXPORT_DIR, str(job.id) + '.' + job.format)
+        try:
+            replica = caught_up_replica(db)
+            try:
+                reports = QUERIES[(job.period, job.type)](db=replica or db, **job.params)
+            finally:
+                if replica is not None:
+                    replica.close()
+            _update(db, job.id, total=len(reports))
+            last = [0]
+
+            def progress(done: int, total: int):
+                percent = done * 100 // total
+                if percent - last[0] >= 5:
+                    last[0] = percent
+                    _update(db, job.id, progress=min(percent, 99))
+
+            os.makedirs(EXPORT_DIR, exist_ok=True)
+            if job.format == 'pdf':
+                with open(path + '.part', 'wb') as file:
+                    file.write(render.render_reports_pdf(reports, progress=progress))
+            else:
+                write = render.write_commission_reports_csv if job.type == 'commission' else render.write_reports_csv
+                with open(path + '.part', 'w', newline='') as csvfile:
+                    write(reports, csvfile, progress=progress)
+            os.replace(path + '.part', path)
+            finished = now()
+            _update(db, job.id, status='done', progress=100, path=path, filename=filename(job),
+                    date_finished=finished, expires_at=finished + datetime.timedelta(hours=EXPORT_TTL_HOURS))
+        except Exception as e:
+            db.rollback()
+            if os.path.exists(path + '.part'):
+                os.remove(path + '.part')
+            _update(db, job.id, status='failed', error=str(e) or e.__class__.__name__, date_finished=now())
+        finally:
+            running.discard(job.id)
+    finally:
+        db.close()
+
+
+def cleanup(db: SessionLocal):
+    expired = db.query(models.ExportJob).filter(models.ExportJob.status == 'done',
+                                                models.ExportJob.expires_at < now()).all()
+    for job in expired:
+        if job.path and os.path.exists(job.path):
+            os.remove(job.path)
+    if expired:
+        db.execute(update(models.ExportJob).where(models.ExportJob.id.in_([job.id for job in expired])).values(
+            status='expired', path=None, date_updated=now()))
+        db.commit()
+
+
+def resume():
+    db = SessionLocal()
+    try:
+        cleanup(db)
+        db.execute(update(models.ExportJob).where(
+            models.ExportJob.status == 'running',
+            models.ExportJob.date_updated < now() - datetime.timedelta(minutes=EXPORT_STALE_MINUTES)
+        ).values(status='queued'))
+        db.commit()
+        for job in db.query(models.ExportJob.id).filter(models.ExportJob.status == 'queued').order_by(
+                models.ExportJob.id).all():
+            submit(job.id)
+    finally:
+        db.close()
+
+
+def _iter_file(path: str, start: int, length: int, chunk_size: int = 64 * 1024):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def file_response(job: models.ExportJob, range_header: str = None):
+    media_type = MEDIA_TYPES[job.format]
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip()) if range_header else None
+    if not match or match.groups() == ('', ''):
+        return FileResponse(job.path, media_type=media_type, filename=job.filename,
+                            headers={'Accept-Ranges': 'bytes'})
+    size = os.path.getsize(job.path)
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(size - int(last), 0), size - 1
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, detail="Intervallo non valido",
+                            headers={'Content-Range': 'bytes */' + str(size)})
+    return StreamingResponse(_iter_file(job.path, start, end - start + 1), status_code=206, media_type=media_type,
+                             headers={'Accept-Ranges': 'bytes',
+                                      'Content-Range': 'bytes ' + str(start) + '-' + str(end) + '/' + str(size),
+                                      'Content-Length': str(end - start + 1),
+                                      'Content-Disposition': 'attachment; filename="' + job.filename + '"'})
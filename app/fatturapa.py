@@ -0,0 +1,375 @@
+import base64
+import csv
+import hashlib
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree.ElementTree import iterparse
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+INVOICE_WORKERS = int(os.getenv("INVOICE_WORKERS", os.cpu_count() or 1))
+INVOICE_TOLERANCE = float(os.getenv("INVOICE_TOLERANCE", "0.01"))
+INVOICE_MAX_FILE_BYTES = int(os.getenv("INVOICE_MAX_FILE_BYTES", str(20 * 1024 * 1024)))
+INVOICE_MAX_BATCH_BYTES = int(os.getenv("INVOICE_MAX_BATCH_BYTES", str(500 * 1024 * 1024)))
+
+LEDGER_HEADER = ['File', 'Record', 'Data documento', 'Numero documento', 'Fornitore', 'Identificativo fiscale',
+                 'Codice', 'Descrizione', 'Quantità', 'Prezzo unitario', 'Unità di misura', 'Sconto', 'IVA',
+                 'Natura', 'Totale', 'Imponibile', 'Imposta']
+DISCREPANCY_HEADER = ['File', 'Data documento', 'Numero documento', 'Aliquota IVA', 'Natura', 'Imponibile calcolato',
+                      'Imponibile dichiarato', 'Imposta calcolata', 'Imposta dichiarata']
+
+
+def _name(elem):
+    return elem.tag.rsplit('}', 1)[-1]
+
+
+def _find(elem, *path):
+    for name in path:
+        if elem is None:
+            return None
+        elem = next((child for child in elem if _name(child) == name), None)
+    return elem
+
+
+def _text(elem, *path):
+    found = _find(elem, *path)
+    return found.text.strip() if found is not None and found.text is not None else None
+
+
+def _findall(elem, name):
+    return [child for child in elem if _name(child) == name]
+
+
+def _supplier(elem):
+    anagrafica = _find(elem, 'DatiAnagrafici', 'Anagrafica')
+    name = _text(anagrafica, 'Denominazione')
+    if name is None and anagrafica is not None:
+        name = ' '.join(part for part in (_text(anagrafica, 'Nome'), _text(anagrafica, 'Cognome')) if part)
+    return {
+        'IdPaese': _text(elem, 'DatiAnagrafici', 'IdFiscaleIVA', 'IdPaese'),
+        'IdCodice': _text(elem, 'DatiAnagrafici', 'IdFiscaleIVA', 'IdCodice'),
+        'CodiceFiscale': _text(elem, 'DatiAnagrafici', 'CodiceFiscale'),
+        'Denominazione': name,
+        'RegimeFiscale': _text(elem, 'DatiAnagrafici', 'RegimeFiscale'),
+        'Indirizzo': _text(elem, 'Sede', 'Indirizzo'),
+        'Comune': _text(elem, 'Sede', 'Comune'),
+        'Provincia': _text(elem, 'Sede', 'Provincia'),
+        'CAP': _text(elem, 'Sede', 'CAP'),
+        'Nazione': _text(elem, 'Sede', 'Nazione'),
+    }
+
+
+def _line(elem):
+    return {
+        'NumeroLinea': _text(elem, 'NumeroLinea'),
+        'CodiceArticolo': [(_text(code, 'CodiceTipo'), _text(code, 'CodiceValore'))
+                           for code in _findall(elem, 'CodiceArticolo')],
+        'Descrizione': _text(elem, 'Descrizione'),
+        'Quantita': _text(elem, 'Quantita'),
+        'UnitaMisura': _text(elem, 'UnitaMisura'),
+        'PrezzoUnitario': _text(elem, 'PrezzoUnitario'),
+        'ScontoMaggiorazione': [_text(discount, 'Percentuale')
+                                for discount in _findall(elem, 'ScontoMaggiorazione')],
+        'PrezzoTotale': _text(elem, 'PrezzoTotale'),
+        'AliquotaIVA': _text(elem, 'AliquotaIVA'),
+        'Natura': _text(elem, 'Natura'),
+    }
+
+
+def _summary(elem):
+    return {
+        'AliquotaIVA': _text(elem, 'AliquotaIVA'),
+        'Natura': _text(elem, 'Natura'),
+        'ImponibileImporto': _text(elem, 'ImponibileImporto'),
+        'Imposta': _text(elem, 'Imposta'),
+        'Arrotondamento': _text(elem, 'Arrotondamento'),
+    }
+
+
+def _payment(elem):
+    return {
+        'ModalitaPagamento': _text(elem, 'ModalitaPagamento'),
+        'DataScadenzaPagamento': _text(elem, 'DataScadenzaPagamento'),
+        'ImportoPagamento': _text(elem, 'ImportoPagamento'),
+    }
+
+
+def parse(source):
+    stack = []
+    supplier = {}
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        parent = stack[-1] if stack else None
+        name = _name(elem)
+        if name == 'CedentePrestatore':
+            supplier = _supplier(elem)
+        elif name == 'DatiGeneraliDocumento':
+            yield 'header', dict(supplier, Data=_text(elem, 'Data'), Numero=_text(elem, 'Numero'),
+                                 TipoDocumento=_text(elem, 'TipoDocumento'),
+                                 ImportoTotaleDocumento=_text(elem, 'ImportoTotaleDocumento'))
+        elif name == 'DettaglioLinee':
+            yield 'line', _line(elem)
+        elif name == 'DatiRiepilogo':
+            yield 'summary', _summary(elem)
+        elif name == 'DettaglioPagamento':
+            yield 'payment', _payment(elem)
+        elif name == 'FatturaElettronicaBody':
+            yield 'end', {}
+        elif name != 'Allegati':
+            continue
+        if parent is not None:
+            parent.remove(elem)
+        elem.clear()
+
+
+def _comma(value):
+    return value.replace('.', ',') if value is not None else None
+
+
+def _code(codes):
+    if len(codes) == 1:
+        return codes[0][1] + '\r(' + codes[0][0] + ')'
+    return ''.join(value + '\r(' + kind + ')\r' for kind, value in codes)
+
+
+def _discount(discounts):
+    discounts = [discount for discount in discounts if discount is not None]
+    if len(discounts) > 1:
+        return ''.join(_comma(discount) + '\r' for discount in discounts)
+    return _comma(discounts[0]) if discounts else None
+
+
+def _vat_key(record):
+    return '%.2f' % float(record['AliquotaIVA'] or 0) + '|' + (record['Natura'] or '')
+
+
+def _amounts(values):
+    import numpy as np
+    return np.array([value or 0 for value in values], dtype=float)
+
+
+def check_vat(lines: list, summaries: list):
+    if not lines and not summaries:
+        return []
+    import numpy as np
+    groups, index = np.unique([key for key, _ in lines] + [_vat_key(summary) for summary in summaries],
+                              return_inverse=True)
+    line_index, summary_index = index[:len(lines)], index[len(lines):]
+    taxable = np.bincount(line_index, weights=_amounts(total for _, total in lines), minlength=len(groups))
+    declared_taxable = np.bincount(summary_index, minlength=len(groups),
+                                   weights=_amounts(summary['ImponibileImporto'] for summary in summaries))
+    declared_tax = np.bincount(summary_index, weights=_amounts(summary['Imposta'] for summary in summaries),
+                               minlength=len(groups))
+    rounding = np.bincount(summary_index, weights=_amounts(summary['Arrotondamento'] for summary in summaries),
+                           minlength=len(groups))
+    declared = np.bincount(summary_index, minlength=len(groups)) > 0
+    rates = np.array([float(group.split('|')[0]) for group in groups])
+    tax = np.round(declared_taxable * rates / 100, 2)
+    tolerance = INVOICE_TOLERANCE + 1e-6
+    wrong = ~declared | (np.abs(taxable + rounding - declared_taxable) > tolerance) | \
+        (np.abs(tax - declared_tax) > tolerance)
+    return [{'AliquotaIVA': groups[i].split('|')[0], 'Natura': groups[i].split('|')[1] or None,
+             'ImponibileCalcolato': '%.2f' % taxable[i],
+             'ImponibileImporto': '%.2f' % declared_taxable[i] if declared[i] else None,
+             'ImpostaCalcolata': '%.2f' % tax[i] if declared[i] else None,
+             'Imposta': '%.2f' % declared_tax[i] if declared[i] else None}
+            for i in np.flatnonzero(wrong)]
+
+
+def reconcile(records):
+    header, lines, summaries = {}, [], []
+    for kind, record in records:
+        if kind == 'header':
+            header, lines, summaries = record, [], []
+        elif kind == 'line':
+            lines.append((_vat_key(record), record['PrezzoTotale']))
+        elif kind == 'summary':
+            summaries.append(record)
+        yield kind, record
+        if kind == 'end':
+            for discrepancy in check_vat(lines, summaries):
+                yield 'discrepancy', dict(discrepancy, Data=header.get('Data'), Numero=header.get('Numero'))
+
+
+def write_csv(records, csvfile):
+    csvwriter = csv.writer(csvfile, delimiter=';')
+    header = None
+    summaries = total = discrepancies = False
+    for kind, record in records:
+        if kind == 'header':
+            header = record
+            summaries = total = discrepancies = False
+            csvwriter.writerow(['Data documento', header['Data']])
+            csvwriter.writerow(['Numero documento', header['Numero']])
+            csvwriter.writerow(['Tipologia documento', header['TipoDocumento']])
+            csvwriter.writerow(['Identificativo fiscale', header['IdPaese'] + header['IdCodice']])
+            csvwriter.writerow(['Codice fiscale', header['IdCodice']])
+            csvwriter.writerow(['Denominazione', header['Denominazione']])
+            csvwriter.writerow(['Regime fiscale', header['RegimeFiscale']])
+            csvwriter.writerow(['Indirizzo', header['Indirizzo']])
+            if header['Provincia']:
+                csvwriter.writerow(['Comune', header['Comune'] + ' (' + header['Provincia'] + ')'])
+            else:
+                csvwriter.writerow(['Comune', header['Comune']])
+            csvwriter.writerow(['CAP', header['CAP']])
+            csvwriter.writerow(['Nazione', header['Nazione']])
+            csvwriter.writerow([''])
+            csvwriter.writerow(
+                ['Codice', 'Descrizione', 'Quantità', 'Prezzo unitario', 'Unità di misura', 'Sconto', 'IVA',
+                 'Totale'])
+        elif header is None:
+            raise ValueError('DatiGeneraliDocumento mancante')
+        elif kind == 'line':
+            csvwriter.writerow([_code(record['CodiceArticolo']) if record['CodiceArticolo'] else '',
+                                record['Descrizione'], _comma(record['Quantita']),
+                                _comma(record['PrezzoUnitario']), record['UnitaMisura'],
+                                _discount(record['ScontoMaggiorazione']),
+                                _comma(record['AliquotaIVA']), _comma(record['PrezzoTotale'])])
+        elif kind == 'summary':
+            if not summaries:
+                summaries = True
+                csvwriter.writerow([''])
+            csvwriter.writerow(['Aliquota IVA', _comma(record['AliquotaIVA'])])
+            csvwriter.writerow(['Totale imponibile', _comma(record['ImponibileImporto'])])
+            csvwriter.writerow(['Totale imposta', _comma(record['Imposta'])])
+            csvwriter.writerow(['', ''])
+        elif kind in ('payment', 'end'):
+            if not total:
+                total = True
+                csvwriter.writerow(['Totale documento', _comma(header['ImportoTotaleDocumento'])])
+            if kind == 'payment' and record['ModalitaPagamento']:
+                csvwriter.writerow(['Modalità di pagamento', record['ModalitaPagamento']])
+                csvwriter.writerow(['Data di scadenza', record['DataScadenzaPagamento']])
+        elif kind == 'discrepancy':
+            if not discrepancies:
+                discrepancies = True
+                csvwriter.writerow([''])
+                csvwriter.writerow(DISCREPANCY_HEADER[3:])
+            csvwriter.writerow([_comma(record['AliquotaIVA']), record['Natura'], _comma(record['ImponibileCalcolato']),
+                                _comma(record['ImponibileImporto']), _comma(record['ImpostaCalcolata']),
+                                _comma(record['Imposta'])])
+    if header is None:
+        raise ValueError('DatiGeneraliDocumento mancante')
+
+
+_pool = None
+
+
+def pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=INVOICE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def _der_item(data: bytes, offset: int):
+    tag = data[offset]
+    offset += 1
+    if tag & 0x1f == 0x1f:
+        while data[offset] & 0x80:
+            offset += 1
+        offset += 1
+    length = data[offset]
+    offset += 1
+    if length == 0x80:
+        return tag, offset, None
+    if length & 0x80:
+        size = length & 0x7f
+        length = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    return tag, offset, offset + length
+
+
+def _der_children(data: bytes, start: int, end):
+    offset = start
+    while (end is None or offset < end) and offset < len(data):
+        if end is None and data[offset:offset + 2] == b'\x00\x00':
+            return
+        tag, content, content_end = _der_item(data, offset)
+        if content_end is None:
+            last = content
+            for child in _der_children(data, content, None):
+                last = child[3]
+            content_end, offset = last, last + 2
+        else:
+            offset = content_end
+        yield tag, content, content_end, offset
+
+
+def _der_octets(data: bytes, tag: int, start: int, end: int):
+    if not tag & 0x20:
+        return data[start:end]
+    return b''.join(_der_octets(data, child_tag, child_start, child_end)
+                    for child_tag, child_start, child_end, _ in _der_children(data, start, end))
+
+
+def extract_p7m(data: bytes):
+    if not data.lstrip().startswith(b'0'):
+        data = base64.b64decode(data)
+    # ContentInfo -> [0] SignedData -> encapContentInfo -> [0] eContent
+    tag, start, end = _der_item(data, 0)
+    content_info = list(_der_children(data, start, end))
+    signed_data = list(_der_children(data, content_info[1][1], content_info[1][2]))
+    signed_data = list(_der_children(data, signed_data[0][1], signed_data[0][2]))
+    encap = list(_der_children(data, signed_data[2][1], signed_data[2][2]))
+    explicit = list(_der_children(data, encap[1][1], encap[1][2]))
+    return _der_octets(data, *explicit[0][:3])
+
+
+def _ledger(name: str, records, rows: list):
+    header = {}
+    for kind, record in records:
+        if kind == 'header':
+            header = record
+        elif kind in ('line', 'summary'):
+            document = [name, 'Riga' if kind == 'line' else 'Riepilogo', header.get('Data'), header.get('Numero'),
+                        header.get('Denominazione'), (header.get('IdPaese') or '') + (header.get('IdCodice') or '')]
+            if kind == 'line':
+                rows.append(document + [
+                    _code(record['CodiceArticolo']).replace('\r', ' ').strip() if record['CodiceArticolo'] else '',
+                    record['Descrizione'], _comma(record['Quantita']), _comma(record['PrezzoUnitario']),
+                    record['UnitaMisura'], (_discount(record['ScontoMaggiorazione']) or '').replace('\r', ' ').strip(),
+                    _comma(record['AliquotaIVA']), record['Natura'], _comma(record['PrezzoTotale']), None, None])
+            else:
+                rows.append(document + ['', '', None, None, None, None, _comma(record['AliquotaIVA']),
+                                        record['Natura'], None, _comma(record['ImponibileImporto']),
+                                        _comma(record['Imposta'])])
+        yield kind, record
+
+
+def sha256(file):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(64 * 1024), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def render_records(name: str, records):
+    records = list(reconcile(records))
+    csvfile = io.StringIO(newline='')
+    ledger = []
+    write_csv(_ledger(name, records, ledger), csvfile)
+    discrepancies = [[name, record['Data'], record['Numero'], _comma(record['AliquotaIVA']), record['Natura'],
+                      _comma(record['ImponibileCalcolato']), _comma(record['ImponibileImporto']),
+                      _comma(record['ImpostaCalcolata']), _comma(record['Imposta'])]
+                     for kind, record in records if kind == 'discrepancy']
+    return {'name': name, 'csv': csvfile.getvalue(), 'ledger': ledger, 'records': records,
+            'discrepancies': discrepancies}
+
+
+def convert(name: str, data: bytes):
+    try:
+        if name.lower().endswith('.p7m'):
+            data = extract_p7m(data)
+            name = name[:-4]
+        return render_records(name, parse(io.BytesIO(data)))
+    except Exception as e:
+        return {'name': name, 'error': str(e) or e.__class__.__name__}
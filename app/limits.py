@@ -0,0 +1,100 @@
+import asyncio
+import os
+import re
+
+from dotenv import load_dotenv
+from starlette.responses import JSONResponse
+
+load_dotenv()
+
+ROUTE_CLASSES = [
+    ('pdf', re.compile(r'.*/(pdf|email)$')),
+    ('csv', re.compile(r'.*/csv$')),
+    ('xml', re.compile(r'^/upload-xml')),
+]
+
+DEFAULTS = {
+    'pdf': (2, 10),
+    'csv': (4, 20),
+    'xml': (4, 20),
+    'crud': (64, 256),
+}
+
+LIMIT_TIMEOUT = float(os.getenv("LIMIT_TIMEOUT", "30"))
+LIMIT_RETRY_AFTER = os.getenv("LIMIT_RETRY_AFTER", "5")
+
+
+def route_class(path: str):
+    for name, pattern in ROUTE_CLASSES:
+        if pattern.match(path):
+            return name
+    return 'crud'
+
+
+class Limiter:
+    def __init__(self, name: str, concurrency: int, queue: int, timeout: float):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    async def acquire(self):
+        if self.semaphore.locked() and self.waiting >= self.queue:
+            self.rejected += 1
+            return False
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self.semaphore.release()
+
+    def stats(self):
+        return {"concurrency": self.concurrency, "queue": self.queue, "active": self.active,
+                "waiting": self.waiting, "max_waiting": self.max_waiting, "admitted": self.admitted,
+                "rejected": self.rejected}
+
+
+limiters = {
+    name: Limiter(name, int(os.getenv("LIMIT_" + name.upper() + "_CONCURRENCY", concurrency)),
+                  int(os.getenv("LIMIT_" + name.upper() + "_QUEUE", queue)), LIMIT_TIMEOUT)
+    for name, (concurrency, queue) in DEFAULTS.items()
+}
+
+
+def stats():
+    return {name: limiter.stats() for name, limiter in limiters.items()}
+
+
+class AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        limiter = limiters[route_class(scope["path"])]
+        if not await limiter.acquire():
+            response = JSONResponse({"detail": "Troppe richieste, riprova più tardi"}, status_code=429,
+                                    headers={"Retry-After": LIMIT_RETRY_AFTER})
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
@@ -0,0 +1,213 @@
+import datetime
+import os
+import smtplib
+import ssl
+import threading
+import time
+from email.message import EmailMessage, MIMEPart
+from email.policy import SMTP
+from email.utils import formataddr
+from zoneinfo import ZoneInfo
+
+from dotenv import load_dotenv
+from sqlalchemy import update
+
+import app.crud as crud
+import app.models as models
+from app.database import SessionLocal
+
+load_dotenv()
+
+MAIL_SERVER = os.getenv("MAIL_SERVER")
+MAIL_PORT = int(os.getenv("MAIL_PORT", "587"))
+MAIL_USERNAME = os.getenv("MAIL_USERNAME")
+MAIL_PASSWORD = os.getenv("MAIL_PASSWORD")
+MAIL_FROM = os.getenv("MAIL_FROM", "manutenzione@moveautomation.it")
+MAIL_FROM_NAME = os.getenv("MAIL_FROM_NAME", "Move Automation S.r.l.")
+MAIL_STARTTLS = os.getenv("MAIL_STARTTLS", "true").lower() in ("1", "true", "yes")
+MAIL_SSL_TLS = os.getenv("MAIL_SSL_TLS", "false").lower() in ("1", "true", "yes")
+MAIL_TIMEOUT = float(os.getenv("MAIL_TIMEOUT", "30"))
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "8"))
+MAIL_RETRY_SECONDS = int(os.getenv("MAIL_RETRY_SECONDS", "60"))
+MAIL_POLL_SECONDS = float(os.getenv("MAIL_POLL_SECONDS", "10"))
+MAIL_IDLE_SECONDS = float(os.getenv("MAIL_IDLE_SECONDS", "60"))
+MAIL_STALE_MINUTES = int(os.getenv("MAIL_STALE_MINUTES", "10"))
+MAIL_REQUEUE_SECONDS = float(os.getenv("MAIL_REQUEUE_SECONDS", "60"))
+MAIL_MAX_BYTES = int(os.getenv("MAIL_MAX_BYTES", str(20 * 1024 * 1024)))
+
+wakeup = threading.Event()
+_thread = None
+
+
+def now():
+    return datetime.datetime.now(ZoneInfo("Europe/Rome"))
+
+
+_logo = None
+_template = None
+
+
+def logo():
+    global _logo
+    if _logo is None:
+        with open('app/static/logo.png', 'rb') as file:
+            part = MIMEPart()
+            part.set_content(file.read(), 'image', 'png', cid='<logo>', filename='logo.png', disposition='inline')
+        _logo = part
+    return _logo
+
+
+def template():
+    global _template
+    if _template is None:
+        from jinja2 import Template
+        with open('app/email.html') as file:
+            _template = Template(file.read())
+    return _template
+
+
+def _message(subject: str, recipient: str, reports: list, month: str, attachments: list, single: bool):
+    message = EmailMessage()
+    message['Subject'] = subject
+    message['From'] = formataddr((MAIL_FROM_NAME, MAIL_FROM))
+    message['To'] = recipient
+    message.set_content(template().render(reports=reports, month=month, single=single), subtype='html')
+    message.make_related()
+    message.attach(logo())
+    for filename, pdf in attachments:
+        message.add_attachment(pdf, 'application', 'pdf', filename=filename)
+    return message
+
+
+def report_message(report, recipient: str, pdf: bytes, pdf_name: str):
+    return _message(report.last_name.upper() + ' ' + report.first_name.upper() + ' - Intervento ' +
+                    report.client_name + ' ' + report.Report.date.strftime('%d/%m/%Y'), recipient,
+                    [report], None, [(pdf_name, pdf)], single=True)
+
+
+def reports_message(reports: list, recipient: str, month: str, attachments: list):
+    return _message('Interventi ' + reports[0].client_name + ' ' + month, recipient, reports, month, attachments,
+                    single=False)
+
+
+def report_filename(report):
+    return 'intervento_' + str(report.Report.id) + '_' + report.Report.date.strftime('%d-%m-%Y') + '.pdf'
+
+
+def enqueue(db: SessionLocal, message: EmailMessage, report_ids: list, user_id: int):
+    db_message = crud.create_outbox_message(db, recipients=[address.strip() for address in message['To'].split(',')],
+                                            subject=message['Subject'], message=message.as_bytes(policy=SMTP),
+                                            report_ids=report_ids, user_id=user_id)
+    wakeup.set()
+    return db_message
+
+
+def connect():
+    if MAIL_SSL_TLS:
+        smtp = smtplib.SMTP_SSL(MAIL_SERVER, MAIL_PORT, timeout=MAIL_TIMEOUT, context=ssl.create_default_context())
+    else:
+        smtp = smtplib.SMTP(MAIL_SERVER, MAIL_PORT, timeout=MAIL_TIMEOUT)
+        if MAIL_STARTTLS:
+            smtp.starttls(context=ssl.create_default_context())
+    if MAIL_USERNAME:
+        smtp.login(MAIL_USERNAME, MAIL_PASSWORD)
+    return smtp
+
+
+def disconnect(smtp):
+    try:
+        smtp.quit()
+    except smtplib.SMTPException:
+        smtp.close()
+    except OSError:
+        pass
+
+
+def _update(db: SessionLocal, message_id: int, **values):
+    db.execute(update(models.OutboxMessage).where(models.OutboxMessage.id == message_id).values(
+        date_updated=now(), **values))
+    db.commit()
+
+
+def _failed(db: SessionLocal, message: models.OutboxMessage, error: Exception, permanent: bool = False):
+    if permanent or message.attempts >= MAIL_MAX_ATTEMPTS:
+        _update(db, message.id, status='failed', error=str(error) or error.__class__.__name__)
+    else:
+        _update(db, message.id, status='queued', error=str(error) or error.__class__.__name__,
+                next_attempt_at=now() + datetime.timedelta(seconds=MAIL_RETRY_SECONDS * 2 ** (message.attempts - 1)))
+
+
+def deliver(smtp, message: models.OutboxMessage):
+    smtp.sendmail(MAIL_FROM, message.recipients, message.message)
+
+
+def send_next(db: SessionLocal, smtp):
+    message = crud.claim_outbox_message(db)
+    if message is None:
+        return smtp, None
+    try:
+        if smtp is None:
+            smtp = connect()
+        try:
+            deliver(smtp, message)
+        except smtplib.SMTPServerDisconnected:
+            smtp = connect()
+            deliver(smtp, message)
+    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused) as e:
+        _failed(db, message, e, permanent=True)
+    except smtplib.SMTPResponseException as e:
+        _failed(db, message, e, permanent=500 <= e.smtp_code < 600)
+    except (smtplib.SMTPException, OSError) as e:
+        if smtp is not None:
+            disconnect(smtp)
+            smtp = None
+        _failed(db, message, e)
+    else:
+        crud.complete_outbox_message(db, message=message)
+    return smtp, message
+
+
+def requeue_stale(db: SessionLocal):
+    db.execute(update(models.OutboxMessage).where(
+        models.OutboxMessage.status == 'sending',
+        models.OutboxMessage.date_updated < now() - datetime.timedelta(minutes=MAIL_STALE_MINUTES)
+    ).values(status='queued').execution_options(synchronize_session=False))
+    db.commit()
+
+
+def work():
+    smtp, last_used, last_requeued = None, 0, time.monotonic()
+    while True:
+        db = SessionLocal()
+        try:
+            # messages a dead worker left in 'sending'
+            if time.monotonic() - last_requeued > MAIL_REQUEUE_SECONDS:
+                requeue_stale(db)
+                last_requeued = time.monotonic()
+            smtp, message = send_next(db, smtp)
+            if message is None:
+                if smtp is not None and time.monotonic() - last_used > MAIL_IDLE_SECONDS:
+                    disconnect(smtp)
+                    smtp = None
+                db.close()
+                wakeup.wait(MAIL_POLL_SECONDS)
+                wakeup.clear()
+                continue
+            last_used = time.monotonic()
+        except Exception:
+            db.rollback()
+            time.sleep(MAIL_POLL_SECONDS)
+        finally:
+            db.close()
+
+
+def start():
+    global _thread
+    db = SessionLocal()
+    try:
+        requeue_stale(db)
+    finally:
+        db.close()
+    if _thread is None and MAIL_SERVER:
+        _thread = threading.Thread(target=work, name='mail', daemon=True)
+        _thread.start()
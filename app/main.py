@@ -1,36 +1,43 @@
+import codecs
+import collections
 import csv
-import datetime
+import hashlib
+import io
+import itertools
 import os
+import shutil
+import tempfile
+import zipfile
 from datetime import timedelta
-from io import BytesIO
-from typing import Optional
-from zoneinfo import ZoneInfo
+from typing import Optional, List, Literal
 
-import xmltodict
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI, HTTPException, status, UploadFile, Form, File
+from fastapi import Depends, FastAPI, HTTPException, status, UploadFile, Form, File, Request
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi_mail import ConnectionConfig, FastMail, MessageType, MessageSchema
-from jinja2 import Template
 from pydantic import BaseSettings, EmailStr
-from pypdf import PdfWriter
-from sqlalchemy import or_
-from starlette.background import BackgroundTasks
+from sqlalchemy import exc, or_
+from starlette.background import BackgroundTask
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import Response, FileResponse
-from weasyprint import HTML
+from starlette.responses import Response, FileResponse, JSONResponse
 
+import app.coalesce as coalesce
 import app.crud as crud
+import app.exports as exports
+import app.fatturapa as fatturapa
+import app.limits as limits
+import app.mail as mail
+import app.metrics as metrics
 import app.models as models
+import app.profiler as profiler
+import app.queries as queries
+import app.render as render
 import app.schemas as schemas
-from app.auth import create_access_token, get_current_user, is_admin
-from app.database import SessionLocal, engine, get_db
+from app.auth import create_access_token, get_current_read_user, get_current_user, get_read_db, is_admin, is_read_admin
+from app.database import ReadYourWritesMiddleware, SessionLocal, get_db
 
 load_dotenv()
 ACCESS_TOKEN_EXPIRE_HOURS = int(os.getenv("ACCESS_TOKEN_EXPIRE_HOURS"))
 
-models.Base.metadata.create_all(bind=engine)
-
 
 class Settings(BaseSettings):
     openapi_url: str = os.getenv("OPENAPI_URL")
@@ -46,6 +53,11 @@ origins = [
     "*",
 ]
 
+app.add_middleware(ReadYourWritesMiddleware)
+app.add_middleware(queries.QueryCountMiddleware)
+app.add_middleware(limits.AdmissionMiddleware)
+app.add_middleware(profiler.ProfileMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -54,22 +66,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-conf = ConnectionConfig(
-    MAIL_USERNAME=os.getenv("MAIL_USERNAME"),
-    MAIL_PASSWORD=os.getenv("MAIL_PASSWORD"),
-    MAIL_SERVER=os.getenv("MAIL_SERVER"),
-    MAIL_FROM="manutenzione@moveautomation.it",
-    MAIL_PORT=587,
-    MAIL_FROM_NAME="Move Automation S.r.l.",
-    MAIL_STARTTLS=True,
-    MAIL_SSL_TLS=False,
-    USE_CREDENTIALS=True,
-    VALIDATE_CERTS=True
-)
+@app.on_event("startup")
+def resume_exports():
+    exports.resume()
+
+
+@app.exception_handler(exc.TimeoutError)
+def pool_timeout(request: Request, error: exc.TimeoutError):
+    return JSONResponse({"detail": "Database sovraccarico, riprova più tardi"}, status_code=503,
+                        headers={"Retry-After": limits.LIMIT_RETRY_AFTER})
+
+
+@app.on_event("startup")
+def start_mail():
+    mail.start()
+
+
+@app.on_event("startup")
+def serve_metrics():
+    metrics.serve()
 
 
 @app.post("/token", response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: SessionLocal = Depends(get_db)):
+def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: SessionLocal = Depends(get_db)):
     user = db.query(models.User).filter(models.User.username == form_data.username).first()
     if not user or not user.verify_password(form_data.password):
         raise HTTPException(
@@ -85,12 +104,12 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 
 @app.get("/users", response_model=list[schemas.User])
-def get_all_users(db: SessionLocal = Depends(get_db), current_user: schemas.User = Depends(is_admin)):
+def get_all_users(db: SessionLocal = Depends(get_read_db), current_user: schemas.User = Depends(is_read_admin)):
     return db.query(models.User).order_by(models.User.last_name).all()
 
 
 @app.get("/operators", response_model=list[schemas.User])
-def get_operators(db: SessionLocal = Depends(get_db), current_user: schemas.User = Depends(is_admin)):
+def get_operators(db: SessionLocal = Depends(get_read_db), current_user: schemas.User = Depends(is_read_admin)):
     return db.query(models.User).join(models.Role).order_by(models.User.last_name).filter(
         or_(models.Role.id == 1, models.Role.id == 2)).all()
 
@@ -101,8 +120,8 @@ def get_clients(db: SessionLocal = Depends(get_db)):
 
 
 @app.get("/commissions")
-def get_commissions(db: SessionLocal = Depends(get_db), client_id: Optional[int] = None,
-                    current_user: schemas.User = Depends(is_admin)):
+def get_commissions(db: SessionLocal = Depends(get_read_db), client_id: Optional[int] = None,
+                    current_user: schemas.User = Depends(is_read_admin)):
     if client_id:
         return crud.get_commissions(db, client_id=client_id)
     return crud.get_commissions(db)
@@ -132,24 +151,24 @@ def get_locations(db: SessionLocal = Depends(get_db)):
 
 
 @app.get("/plants")
-def get_plants(db: SessionLocal = Depends(get_db)):
+def get_plants(db: SessionLocal = Depends(get_read_db)):
     return crud.get_plants(db)
 
 
 @app.get("/machines")
-def get_machines(db: SessionLocal = Depends(get_db), limit: Optional[int] = None, sort: Optional[str] = None,
+def get_machines(db: SessionLocal = Depends(get_read_db), limit: Optional[int] = None, sort: Optional[str] = None,
                  order: Optional[str] = None, q: Optional[str] = None):
     return crud.get_machines(db, limit=limit, sort=sort, order=order, q=q)
 
 
 @app.get("/reports")
-def get_reports(current_user: models.User = Depends(is_admin),
-                db: SessionLocal = Depends(get_db), limit: Optional[int] = None):
+def get_reports(current_user: models.User = Depends(is_read_admin),
+                db: SessionLocal = Depends(get_read_db), limit: Optional[int] = None):
     return crud.get_reports(db, limit=limit)
 
 
 @app.get("/tickets")
-def get_tickets(current_user: models.User = Depends(is_admin), db: SessionLocal = Depends(get_db)):
+def get_tickets(current_user: models.User = Depends(is_read_admin), db: SessionLocal = Depends(get_read_db)):
     return crud.get_tickets(db)
 
 
@@ -174,7 +193,7 @@ def get_supervisors_by_client(db: SessionLocal = Depends(get_db), client_id: int
 
 
 @app.get("/months")
-def get_months(db: SessionLocal = Depends(get_db), user_id: Optional[int] = None, client_id: Optional[int] = None):
+def get_months(db: SessionLocal = Depends(get_read_db), user_id: Optional[int] = None, client_id: Optional[int] = None):
     if user_id:
         return crud.get_months(db, user_id=user_id)
     elif client_id:
@@ -191,41 +210,42 @@ def get_my_months(db: SessionLocal = Depends(get_db), current_user: models.User
 
 
 @app.get("/reports/monthly")
-def get_monthly_reports(month: Optional[str] = None, db: SessionLocal = Depends(get_db),
+def get_monthly_reports(month: Optional[str] = None, db: SessionLocal = Depends(get_read_db),
                         user_id: Optional[int] = None, client_id: Optional[int] = None, plant_id: Optional[int] = None,
-                        work_id: Optional[int] = None):
+                        work_id: Optional[int] = None, archive: bool = False):
     return crud.get_monthly_reports(month=month, user_id=user_id, client_id=client_id, plant_id=plant_id,
-                                    work_id=work_id, db=db)
+                                    work_id=work_id, db=db, archive=archive)
 
 
 @app.get("/reports/monthly/commissions")
-def get_monthly_commission_reports(month: str, db: SessionLocal = Depends(get_db),
+def get_monthly_commission_reports(month: str, db: SessionLocal = Depends(get_read_db),
                                    user_id: Optional[int] = None, client_id: Optional[int] = None,
-                                   work_id: Optional[int] = None):
+                                   work_id: Optional[int] = None, archive: bool = False):
     return crud.get_monthly_commission_reports(month=month, user_id=user_id, client_id=client_id, db=db,
-                                               work_id=work_id)
+                                               work_id=work_id, archive=archive)
 
 
 @app.get("/reports/interval")
 def get_interval_reports(start_date: Optional[str] = None, end_date: Optional[str] = None,
-                         db: SessionLocal = Depends(get_db), user_id: Optional[int] = None,
+                         db: SessionLocal = Depends(get_read_db), user_id: Optional[int] = None,
                          client_id: Optional[int] = None, plant_id: Optional[int] = None,
-                         work_id: Optional[int] = None):
+                         work_id: Optional[int] = None, archive: bool = False):
     return crud.get_interval_reports(start_date=start_date, end_date=end_date, user_id=user_id, client_id=client_id,
-                                     plant_id=plant_id, work_id=work_id, db=db)
+                                     plant_id=plant_id, work_id=work_id, db=db, archive=archive)
 
 
 @app.get("/reports/interval/commissions")
 def get_interval_commission_reports(start_date: Optional[str] = None, end_date: Optional[str] = None,
-                                    db: SessionLocal = Depends(get_db), user_id: Optional[int] = None,
-                                    client_id: Optional[int] = None, work_id: Optional[int] = None):
+                                    db: SessionLocal = Depends(get_read_db), user_id: Optional[int] = None,
+                                    client_id: Optional[int] = None, work_id: Optional[int] = None,
+                                    archive: bool = False):
     return crud.get_interval_commission_reports(start_date=start_date, end_date=end_date, user_id=user_id,
-                                                client_id=client_id, work_id=work_id, db=db)
+                                                client_id=client_id, work_id=work_id, db=db, archive=archive)
 
 
 @app.get("/reports/daily")
-def get_daily_hours_in_month(month: str, user_id: Optional[int] = None, db: SessionLocal = Depends(get_db),
-                             current_user: models.User = Depends(get_current_user)):
+def get_daily_hours_in_month(month: str, user_id: Optional[int] = None, db: SessionLocal = Depends(get_read_db),
+                             current_user: models.User = Depends(get_current_read_user)):
     if current_user.role_id != 1:
         raise HTTPException(status_code=403, detail="Non sei autorizzato ad accedere a questa risorsa")
     return crud.get_daily_hours_in_month(month=month, db=db, user_id=user_id)
@@ -237,8 +257,7 @@ def get_report_by_id(report_id: int, db: SessionLocal = Depends(get_db),
     report = crud.get_report_by_id(db, report_id=report_id)
     if report is None:
         raise HTTPException(status_code=404, detail="Intervento non trovato")
-    if db.query(models.Report).filter(
-            models.Report.id == report_id).first().operator_id != current_user.id and current_user.role_id != 1:
+    if report.Report.operator_id != current_user.id and current_user.role_id != 1:
         raise HTTPException(status_code=403, detail="Non sei autorizzato a vedere questo intervento")
     return report
 
@@ -248,201 +267,144 @@ def get_pdf_report(report_id: int, db: SessionLocal = Depends(get_db),
                    current_user: models.User = Depends(get_current_user)):
     if not current_user.id:
         raise HTTPException(status_code=403, detail="Non sei autorizzato a vedere questo intervento")
-    report = crud.get_report_by_id(db, report_id=report_id)
+    report = release(db, crud.get_report_by_id(db, report_id=report_id))
     if report is None:
         raise HTTPException(status_code=404, detail="Intervento non trovato")
-    with open('app/result.html') as file:
-        template = Template(file.read())
-    rendered_html = template.render(report=report)
-    pdf = HTML(string=rendered_html).write_pdf(presentational_hints=True)
-    return Response(content=pdf, media_type="application/pdf")
+    return Response(content=render.render_report_pdf(report), media_type="application/pdf")
+
+
+def release(db, records):
+    db.commit()
+    return records
+
+
+def csv_response(write, records, filename: str):
+    output = tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False)
+    try:
+        with output:
+            write(records, output)
+    except Exception:
+        os.remove(output.name)
+        raise
+    return FileResponse(output.name, filename=filename, background=BackgroundTask(os.remove, output.name))
 
 
 @app.get("/reports/monthly/csv")
-def get_csv_monthly_reports(month: str, db: SessionLocal = Depends(get_db),
+def get_csv_monthly_reports(month: str, db: SessionLocal = Depends(get_read_db),
                             user_id: Optional[int] = None, client_id: Optional[int] = None,
-                            plant_id: Optional[int] = None, work_id: Optional[int] = None):
+                            plant_id: Optional[int] = None, work_id: Optional[int] = None, archive: bool = False):
     reports = crud.get_monthly_reports(month=month, user_id=user_id, client_id=client_id, plant_id=plant_id,
-                                       work_id=work_id, db=db)
-    with open('app/test.csv', 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile, delimiter=';')
-        csvwriter.writerow(
-            ['Operatore', 'Data', 'Cliente', 'Stabilimento', 'Durata', 'Tipo', 'Macchina', 'Centro di costo',
-             'Location', 'Descrizione'])
-        filename = 'interventi_' + month + '.csv'
-        for report in reports:
-            csvwriter.writerow([report.first_name + ' ' + report.last_name, report.Report.date.strftime("%d/%m/%Y"),
-                                report.client_name,
-                                report.plant_city + ' ' + report.plant_address,
-                                report.Report.intervention_duration.replace('.', ','),
-                                report.Report.intervention_type, report.machine_name,
-                                report.cost_center, report.Report.intervention_location,
-                                report.Report.description])
-        total_hours = [report.Report.intervention_duration for report in reports]
-        total_hours = sum([float(i.replace(',', '.')) for i in total_hours])
-        csvwriter.writerow('')
-        csvwriter.writerow(['Totale ore', '', '', '', str(total_hours).replace('.', ','), '', '', '', '', ''])
-    return FileResponse('app/test.csv', filename=filename)
+                                       work_id=work_id, db=db, archive=archive)
+    return csv_response(render.write_reports_csv, release(db, reports), 'interventi_' + month + '.csv')
 
 
 @app.get("/reports/interval/csv")
-def get_csv_interval_reports(start_date: str, end_date: str, db: SessionLocal = Depends(get_db),
+def get_csv_interval_reports(start_date: str, end_date: str, db: SessionLocal = Depends(get_read_db),
                              user_id: Optional[int] = None, client_id: Optional[int] = None,
-                             plant_id: Optional[int] = None, work_id: Optional[int] = None):
+                             plant_id: Optional[int] = None, work_id: Optional[int] = None, archive: bool = False):
     reports = crud.get_interval_reports(start_date=start_date, end_date=end_date, user_id=user_id, client_id=client_id,
-                                        plant_id=plant_id, work_id=work_id, db=db)
-    with open('app/test.csv', 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile, delimiter=';')
-        csvwriter.writerow(
-            ['Operatore', 'Data', 'Cliente', 'Stabilimento', 'Durata', 'Tipo', 'Macchina', 'Centro di costo',
-             'Location', 'Descrizione'])
-        filename = 'interventi_' + '.csv'
-        for report in reports:
-            csvwriter.writerow([report.first_name + ' ' + report.last_name, report.Report.date.strftime("%d/%m/%Y"),
-                                report.client_name,
-                                report.plant_city + ' ' + report.plant_address,
-                                report.Report.intervention_duration.replace('.', ','),
-                                report.Report.intervention_type, report.machine_name,
-                                report.cost_center, report.Report.intervention_location,
-                                report.Report.description])
-        total_hours = [report.Report.intervention_duration for report in reports]
-        total_hours = sum([float(i.replace(',', '.')) for i in total_hours])
-        csvwriter.writerow('')
-        csvwriter.writerow(['Totale ore', '', '', '', str(total_hours).replace('.', ','), '', '', '', '', ''])
-    return FileResponse('app/test.csv', filename=filename)
+                                        plant_id=plant_id, work_id=work_id, db=db, archive=archive)
+    return csv_response(render.write_reports_csv, release(db, reports), 'interventi_' + '.csv')
 
 
 @app.get("/reports/monthly/pdf")
-def get_pdf_monthly_reports(month: str, db: SessionLocal = Depends(get_db),
+def get_pdf_monthly_reports(month: str, request: Request, db: SessionLocal = Depends(get_read_db),
                             user_id: Optional[int] = None, client_id: Optional[int] = None,
-                            plant_id: Optional[int] = None, work_id: Optional[int] = None):
-    merger = PdfWriter()
-    reports = crud.get_monthly_reports(month=month, user_id=user_id, client_id=client_id, plant_id=plant_id,
-                                       work_id=work_id, db=db)
-    for report in reports:
-        with open('app/result.html') as file:
-            template = Template(file.read())
-        rendered_html = template.render(report=report)
-        pdf = HTML(string=rendered_html).write_pdf(presentational_hints=True)
-        merger.append(BytesIO(pdf))
-    output = BytesIO()
-    merger.write(output)
-    output.seek(0)
-    return Response(content=output.getvalue(), media_type="application/pdf")
+                            plant_id: Optional[int] = None, work_id: Optional[int] = None, archive: bool = False):
+    pdf = coalesce.pdf.run(coalesce.request_key(request), lambda: render.render_reports_pdf(release(
+        db, crud.get_monthly_reports(month=month, user_id=user_id, client_id=client_id, plant_id=plant_id,
+                                     work_id=work_id, db=db, archive=archive))))
+    return Response(content=pdf, media_type="application/pdf")
 
 
 @app.get("/reports/monthly/commissions/pdf")
-def get_pdf_monthly_commission_reports(month: str, db: SessionLocal = Depends(get_db),
+def get_pdf_monthly_commission_reports(month: str, request: Request, db: SessionLocal = Depends(get_read_db),
                                        user_id: Optional[int] = None, client_id: Optional[int] = None,
-                                       work_id: Optional[int] = None):
-    merger = PdfWriter()
-    reports = crud.get_monthly_commission_reports(month=month, user_id=user_id, client_id=client_id, work_id=work_id,
-                                                  db=db)
-    for report in reports:
-        with open('app/result.html') as file:
-            template = Template(file.read())
-        rendered_html = template.render(report=report)
-        pdf = HTML(string=rendered_html).write_pdf(presentational_hints=True)
-        merger.append(BytesIO(pdf))
-    output = BytesIO()
-    merger.write(output)
-    output.seek(0)
-    return Response(content=output.getvalue(), media_type="application/pdf")
+                                       work_id: Optional[int] = None, archive: bool = False):
+    pdf = coalesce.pdf.run(coalesce.request_key(request), lambda: render.render_reports_pdf(release(
+        db, crud.get_monthly_commission_reports(month=month, user_id=user_id, client_id=client_id, work_id=work_id,
+                                                db=db, archive=archive))))
+    return Response(content=pdf, media_type="application/pdf")
 
 
 @app.get("/reports/interval/pdf")
-def get_pdf_interval_reports(start_date: Optional[str] = None, end_date: Optional[str] = None,
-                             db: SessionLocal = Depends(get_db), user_id: Optional[int] = None,
+def get_pdf_interval_reports(request: Request, start_date: Optional[str] = None, end_date: Optional[str] = None,
+                             db: SessionLocal = Depends(get_read_db), user_id: Optional[int] = None,
                              client_id: Optional[int] = None, plant_id: Optional[int] = None,
-                             work_id: Optional[int] = None):
-    merger = PdfWriter()
-    reports = crud.get_interval_reports(start_date=start_date, end_date=end_date, user_id=user_id, client_id=client_id,
-                                        plant_id=plant_id, work_id=work_id, db=db)
-    for report in reports:
-        with open('app/result.html') as file:
-            template = Template(file.read())
-        rendered_html = template.render(report=report)
-        pdf = HTML(string=rendered_html).write_pdf(presentational_hints=True)
-        merger.append(BytesIO(pdf))
-    output = BytesIO()
-    merger.write(output)
-    output.seek(0)
-    return Response(content=output.getvalue(), media_type="application/pdf")
+                             work_id: Optional[int] = None, archive: bool = False):
+    pdf = coalesce.pdf.run(coalesce.request_key(request), lambda: render.render_reports_pdf(release(
+        db, crud.get_interval_reports(start_date=start_date, end_date=end_date, user_id=user_id,
+                                      client_id=client_id, plant_id=plant_id, work_id=work_id, db=db,
+                                      archive=archive))))
+    return Response(content=pdf, media_type="application/pdf")
 
 
 @app.get("/reports/interval/commissions/pdf")
-def get_pdf_interval_commission_reports(start_date: Optional[str] = None, end_date: Optional[str] = None,
-                                        db: SessionLocal = Depends(get_db),
+def get_pdf_interval_commission_reports(request: Request, start_date: Optional[str] = None,
+                                        end_date: Optional[str] = None, db: SessionLocal = Depends(get_read_db),
                                         user_id: Optional[int] = None, client_id: Optional[int] = None,
-                                        work_id: Optional[int] = None):
-    merger = PdfWriter()
-    reports = crud.get_interval_commission_reports(start_date=start_date, end_date=end_date, user_id=user_id,
-                                                   client_id=client_id, work_id=work_id, db=db)
-    for report in reports:
-        with open('app/result.html') as file:
-            template = Template(file.read())
-        rendered_html = template.render(report=report)
-        pdf = HTML(string=rendered_html).write_pdf(presentational_hints=True)
-        merger.append(BytesIO(pdf))
-    output = BytesIO()
-    merger.write(output)
-    output.seek(0)
-    return Response(content=output.getvalue(), media_type="application/pdf")
+                                        work_id: Optional[int] = None, archive: bool = False):
+    pdf = coalesce.pdf.run(coalesce.request_key(request), lambda: render.render_reports_pdf(release(
+        db, crud.get_interval_commission_reports(start_date=start_date, end_date=end_date, user_id=user_id,
+                                                 client_id=client_id, work_id=work_id, db=db, archive=archive))))
+    return Response(content=pdf, media_type="application/pdf")
 
 
 @app.get("/reports/monthly/commissions/csv")
-def get_csv_monthly_commission_reports(month: str, db: SessionLocal = Depends(get_db),
+def get_csv_monthly_commission_reports(month: str, db: SessionLocal = Depends(get_read_db),
                                        user_id: Optional[int] = None, client_id: Optional[int] = None,
-                                       work_id: Optional[int] = None):
+                                       work_id: Optional[int] = None, archive: bool = False):
     reports = crud.get_monthly_commission_reports(month=month, user_id=user_id, client_id=client_id, work_id=work_id,
-                                                  db=db)
-    with open('app/test.csv', 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile, delimiter=';')
-        csvwriter.writerow(
-            ['Operatore', 'Data', 'Cliente', 'Commessa', 'Durata', 'Tipo', 'Location', 'Descrizione'])
-        filename = 'interventi_' + month + '.csv'
-        for report in reports:
-            csvwriter.writerow([report.first_name + ' ' + report.last_name, report.Report.date.strftime("%d/%m/%Y"),
-                                report.client_name,
-                                report.commission_code + ' - ' + report.commission_description,
-                                report.Report.intervention_duration.replace('.', ','),
-                                report.Report.intervention_type, report.Report.intervention_location,
-                                report.Report.description])
-        total_hours = [report.Report.intervention_duration for report in reports]
-        total_hours = sum([float(i.replace(',', '.')) for i in total_hours])
-        csvwriter.writerow('')
-        csvwriter.writerow(['Totale ore', '', '', '', str(total_hours).replace('.', ','), '', '', ''])
-    return FileResponse('app/test.csv', filename=filename)
+                                                  db=db, archive=archive)
+    return csv_response(render.write_commission_reports_csv, release(db, reports), 'interventi_' + month + '.csv')
 
 
 @app.get("/reports/interval/commissions/csv")
-def get_csv_interval_commission_reports(start_date: str, end_date: str, db: SessionLocal = Depends(get_db),
+def get_csv_interval_commission_reports(start_date: str, end_date: str, db: SessionLocal = Depends(get_read_db),
                                         user_id: Optional[int] = None, client_id: Optional[int] = None,
-                                        work_id: Optional[int] = None):
+                                        work_id: Optional[int] = None, archive: bool = False):
     reports = crud.get_interval_commission_reports(start_date=start_date, end_date=end_date, user_id=user_id,
                                                    client_id=client_id, work_id=work_id,
-                                                   db=db)
-    with open('app/test.csv', 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile, delimiter=';')
-        csvwriter.writerow(
-            ['Operatore', 'Data', 'Cliente', 'Commessa', 'Durata', 'Tipo', 'Location', 'Descrizione'])
-        filename = 'interventi.csv'
-        for report in reports:
-            csvwriter.writerow([report.first_name + ' ' + report.last_name, report.Report.date.strftime("%d/%m/%Y"),
-                                report.client_name,
-                                report.commission_code + ' - ' + report.commission_description,
-                                report.Report.intervention_duration.replace('.', ','),
-                                report.Report.intervention_type, report.Report.intervention_location,
-                                report.Report.description])
-        total_hours = [report.Report.intervention_duration for report in reports]
-        total_hours = sum([float(i.replace(',', '.')) for i in total_hours])
-        csvwriter.writerow('')
-        csvwriter.writerow(['Totale ore', '', '', '', str(total_hours).replace('.', ','), '', '', ''])
-    return FileResponse('app/test.csv', filename=filename)
+                                                   db=db, archive=archive)
+    return csv_response(render.write_commission_reports_csv, release(db, reports), 'interventi.csv')
+
+
+@app.post("/exports", response_model=schemas.ExportJob)
+def create_export(export: schemas.ExportCreate, db: SessionLocal = Depends(get_db),
+                  current_user: models.User = Depends(get_current_user)):
+    job = crud.create_export_job(db=db, export=export, user_id=current_user.id)
+    exports.submit(job.id)
+    return job
+
+
+def get_own_export_job(job_id: int, db: SessionLocal, current_user: models.User):
+    job = crud.get_export_job(db, job_id=job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Esportazione non trovata")
+    if job.requested_by != current_user.id and current_user.role_id != 1:
+        raise HTTPException(status_code=403, detail="Non sei autorizzato a vedere questa esportazione")
+    return job
+
+
+@app.get("/exports/{job_id}", response_model=schemas.ExportJob)
+def get_export(job_id: int, db: SessionLocal = Depends(get_db),
+               current_user: models.User = Depends(get_current_user)):
+    return get_own_export_job(job_id, db, current_user)
+
+
+@app.get("/exports/{job_id}/download")
+def download_export(job_id: int, request: Request, db: SessionLocal = Depends(get_db),
+                    current_user: models.User = Depends(get_current_user)):
+    job = get_own_export_job(job_id, db, current_user)
+    if job.status == 'expired':
+        raise HTTPException(status_code=410, detail="Esportazione scaduta")
+    if job.status != 'done':
+        raise HTTPException(status_code=409, detail="Esportazione non ancora completata")
+    return exports.file_response(job, request.headers.get('range'))
 
 
 @app.get("/me")
-async def get_profile(db: SessionLocal = Depends(get_db), current_user: schemas.User = Depends(get_current_user)):
+def get_profile(db: SessionLocal = Depends(get_db), current_user: schemas.User = Depends(get_current_user)):
     return crud.get_user_by_id(db, user_id=current_user.id)
 
 
@@ -509,6 +471,48 @@ def create_machine(machine: schemas.MachineCreate, db: SessionLocal = Depends(ge
     return crud.create_machine(db=db, machine=machine)
 
 
+def csv_encoding(file):
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    try:
+        for chunk in iter(lambda: file.read(64 * 1024), b''):
+            decoder.decode(chunk)
+        decoder.decode(b'', final=True)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        # Excel on Windows saves CSV files as cp1252 unless told otherwise
+        return 'cp1252'
+    finally:
+        file.seek(0)
+
+
+def decoded_lines(file, encoding: str):
+    try:
+        yield from codecs.iterdecode(file, encoding)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail='Codifica del file non riconosciuta, salvalo come CSV UTF-8')
+
+
+def read_csv_upload(file: UploadFile):
+    if not file.filename.lower().endswith('.csv'):
+        raise HTTPException(status_code=400, detail='Il file deve essere in formato CSV')
+    lines = decoded_lines(file.file, csv_encoding(file.file))
+    header = next(lines, '')
+    delimiter = ';' if header.count(';') >= header.count(',') else ','
+    return csv.DictReader(lines, fieldnames=next(csv.reader([header], delimiter=delimiter)), delimiter=delimiter)
+
+
+@app.post("/plants/import")
+def import_plants(file: UploadFile, db: SessionLocal = Depends(get_db),
+                  current_user: models.User = Depends(is_admin)):
+    return crud.import_plants(db=db, rows=read_csv_upload(file))
+
+
+@app.post("/machines/import")
+def import_machines(file: UploadFile, db: SessionLocal = Depends(get_db),
+                    current_user: models.User = Depends(is_admin)):
+    return crud.import_machines(db=db, rows=read_csv_upload(file))
+
+
 @app.post("/report/create", response_model=schemas.Report)
 def create_report(report: schemas.ReportCreate, current_user: models.User = Depends(get_current_user),
                   db: SessionLocal = Depends(get_db)):
@@ -631,153 +635,247 @@ def delete_machine(machine_id: int, db: SessionLocal = Depends(get_db),
 
 
 @app.post("/upload-xml")
-def upload_xml(file: UploadFile):
+def upload_xml(file: UploadFile, db: SessionLocal = Depends(get_db), current_user: models.User = Depends(is_admin)):
     if file.filename.endswith('.xml') or file.filename.endswith('.XML'):
         try:
-            xml = xmltodict.parse(file.file)
-            xml = list(xml.values())[0]
-            info1 = xml['FatturaElettronicaHeader']['CedentePrestatore']
-            info2 = xml['FatturaElettronicaBody']['DatiBeniServizi']['DatiRiepilogo']
-            general_info = xml['FatturaElettronicaBody']['DatiGenerali']['DatiGeneraliDocumento']
-            parsed = xml['FatturaElettronicaBody']['DatiBeniServizi']['DettaglioLinee']
-            with open('app/test.csv', 'w', newline='') as csvfile:
-                csvwriter = csv.writer(csvfile, delimiter=';')
-                csvwriter.writerow(['Data documento', general_info['Data']])
-                csvwriter.writerow(['Numero documento', general_info['Numero']])
-                csvwriter.writerow(['Tipologia documento', general_info['TipoDocumento']])
-                csvwriter.writerow(['Identificativo fiscale',
-                                    info1['DatiAnagrafici']['IdFiscaleIVA']['IdPaese'] +
-                                    info1['DatiAnagrafici']['IdFiscaleIVA']['IdCodice']])
-                csvwriter.writerow(['Codice fiscale', info1['DatiAnagrafici']['IdFiscaleIVA']['IdCodice']])
-                csvwriter.writerow(['Denominazione', info1['DatiAnagrafici']['Anagrafica']['Denominazione']])
-                csvwriter.writerow(['Regime fiscale', info1['DatiAnagrafici']['RegimeFiscale']])
-                csvwriter.writerow(['Indirizzo', info1.get('Sede', {}).get('Indirizzo', None)])
-                if info1.get('Sede', {}).get('Provincia', None):
-                    csvwriter.writerow(['Comune',
-                                        info1.get('Sede', {}).get('Comune', None) + ' (' + info1.get('Sede', {}).get(
-                                            'Provincia', None) + ')'])
-                else:
-                    csvwriter.writerow(['Comune', info1.get('Sede', {}).get('Comune', None)])
-                csvwriter.writerow(['CAP', info1.get('Sede', {}).get('CAP', None)])
-                csvwriter.writerow(['Nazione', info1.get('Sede', {}).get('Nazione', None)])
-                csvwriter.writerow([''])
-                csvwriter.writerow(
-                    ['Codice', 'Descrizione', 'Quantità', 'Prezzo unitario', 'Unità di misura', 'Sconto', 'IVA',
-                     'Totale'])
-                if type(parsed) == list:
-                    for line in parsed:
-                        if not line.get('CodiceArticolo', None):
-                            full_code = ''
-                        else:
-                            full_code = ''
-                            if type(line['CodiceArticolo']) == list:
-                                for value in line['CodiceArticolo']:
-                                    full_code += value['CodiceValore'] + '\r(' + value['CodiceTipo'] + ')\r'
-                            else:
-                                full_code = line['CodiceArticolo']['CodiceValore'] + '\r(' + \
-                                            line['CodiceArticolo']['CodiceTipo'] + ')'
-                        quantity = line.get('Quantita', None).replace('.', ',') if line.get('Quantita') else None
-                        if type(line.get('ScontoMaggiorazione', {})) == list:
-                            discount = ''
-                            for value in line['ScontoMaggiorazione']:
-                                discount += value['Percentuale'].replace('.', ',') + '\r'
-                        else:
-                            discount = line.get('ScontoMaggiorazione', {}).get('Percentuale', None).replace('.',
-                                                                                                            ',') if line.get(
-                                'ScontoMaggiorazione', {}).get('Percentuale', None) else None
-                        csvwriter.writerow(
-                            [full_code,
-                             line['Descrizione'], quantity,
-                             line['PrezzoUnitario'].replace('.', ','),
-                             line.get('UnitaMisura', None), discount,
-                             line['AliquotaIVA'].replace('.', ','),
-                             line['PrezzoTotale'].replace('.', ',')])
-                else:
-                    if not parsed.get('CodiceArticolo', None):
-                        full_code = ''
-                    else:
-                        full_code = parsed['CodiceArticolo']['CodiceValore'] + '\r(' + parsed['CodiceArticolo'][
-                            'CodiceTipo'] + ')'
-                    quantity = parsed.get('Quantita', None).replace('.', ',') if parsed.get('Quantita') else None
-                    discount = (
-                        parsed.get('ScontoMaggiorazione', {}).get('Percentuale', None).replace('.', ',') if parsed.get(
-                            'ScontoMaggiorazione', {}).get('Percentuale', None) is not None else None)
-                    csvwriter.writerow(
-                        [full_code,
-                         parsed['Descrizione'], quantity,
-                         parsed['PrezzoUnitario'].replace('.', ','),
-                         parsed.get('UnitaMisura', None),
-                         discount,
-                         parsed['AliquotaIVA'].replace('.', ','),
-                         parsed['PrezzoTotale'].replace('.', ',')])
-                csvwriter.writerow([''])
-                if type(info2) == list:
-                    for value in info2:
-                        csvwriter.writerow(['Aliquota IVA', value['AliquotaIVA'].replace('.', ',')])
-                        csvwriter.writerow(['Totale imponibile', value['ImponibileImporto'].replace('.', ',')])
-                        csvwriter.writerow(['Totale imposta', value['Imposta'].replace('.', ',')])
-                        csvwriter.writerow(['', ''])
-                else:
-                    csvwriter.writerow(['Aliquota IVA', info2['AliquotaIVA'].replace('.', ',')])
-                    csvwriter.writerow(['Totale imponibile', info2['ImponibileImporto'].replace('.', ',')])
-                    csvwriter.writerow(['Totale imposta', info2['Imposta'].replace('.', ',')])
-                    csvwriter.writerow(['', ''])
-                csvwriter.writerow(['Totale documento', general_info['ImportoTotaleDocumento'].replace('.', ',')])
-                if xml['FatturaElettronicaBody'].get('DatiPagamento', {}).get('ModalitaPagamento', None):
-                    payment_info = xml['FatturaElettronicaBody']['DatiPagamento']
-                    csvwriter.writerow(['Modalità di pagamento', payment_info['ModalitaPagamento']])
-                    csvwriter.writerow(['Data di scadenza', payment_info['DataScadenzaPagamento']])
-            return FileResponse('app/test.csv', filename=file.filename + '.csv')
+            sha256 = fatturapa.sha256(file.file)
+            invoices = crud.get_invoices_by_hash(db, sha256=sha256)
+            if invoices:
+                records = crud.get_invoice_records(db, invoices=invoices)
+            else:
+                records = crud.ingest_invoice(db, sha256=sha256, filename=file.filename,
+                                              records=fatturapa.parse(file.file))
+            return csv_response(fatturapa.write_csv, fatturapa.reconcile(records), file.filename + '.csv')
         except Exception:
             raise HTTPException(status_code=400, detail='Errore')
     else:
         raise HTTPException(status_code=400, detail='Errore')
 
 
+def read_invoice_uploads(files: List[UploadFile]):
+    total = 0
+    for file in files:
+        name = os.path.basename(file.filename)
+        if name.lower().endswith('.zip'):
+            try:
+                with zipfile.ZipFile(file.file) as archive:
+                    for member in archive.infolist():
+                        member_name = os.path.basename(member.filename)
+                        if not member.is_dir() and member_name.lower().endswith(('.xml', '.p7m')) and \
+                                not member.filename.startswith('__MACOSX'):
+                            total += member.file_size
+                            check_invoice_size(member_name, member.file_size, total)
+                            yield member_name, archive.read(member)
+            except zipfile.BadZipFile:
+                raise HTTPException(status_code=400, detail='Archivio ZIP non valido: ' + name)
+        elif name.lower().endswith(('.xml', '.p7m')):
+            data = file.file.read(fatturapa.INVOICE_MAX_FILE_BYTES + 1)
+            total += len(data)
+            check_invoice_size(name, len(data), total)
+            yield name, data
+        else:
+            raise HTTPException(status_code=400, detail='Formato non supportato: ' + name)
+
+
+def check_invoice_size(name: str, size: int, total: int):
+    if size > fatturapa.INVOICE_MAX_FILE_BYTES:
+        raise HTTPException(status_code=413, detail='File troppo grande: ' + name)
+    if total > fatturapa.INVOICE_MAX_BATCH_BYTES:
+        raise HTTPException(status_code=413, detail='Caricamento troppo grande')
+
+
+def convert_invoice_uploads(db: SessionLocal, uploads):
+    window = collections.deque()
+    try:
+        for name, data in uploads:
+            sha256 = hashlib.sha256(data).hexdigest()
+            invoices = crud.get_invoices_by_hash(db, sha256=sha256)
+            if invoices:
+                window.append((name, sha256, fatturapa.render_records(
+                    name[:-4] if name.lower().endswith('.p7m') else name,
+                    crud.get_invoice_records(db, invoices=invoices)), False))
+            else:
+                window.append((name, sha256, fatturapa.pool().submit(fatturapa.convert, name, data), True))
+            while len(window) > fatturapa.INVOICE_WORKERS * 2:
+                name, sha256, result, converted = window.popleft()
+                yield name, sha256, result.result() if converted else result, converted
+        while window:
+            name, sha256, result, converted = window.popleft()
+            yield name, sha256, result.result() if converted else result, converted
+    finally:
+        for _, _, result, converted in window:
+            if converted:
+                result.cancel()
+
+
+@app.post("/upload-xml/batch")
+def upload_xml_batch(files: List[UploadFile] = File(...), db: SessionLocal = Depends(get_db),
+                     current_user: models.User = Depends(is_admin)):
+    results = convert_invoice_uploads(db, read_invoice_uploads(files))
+    first = next(results, None)
+    if first is None:
+        raise HTTPException(status_code=400, detail='Nessuna fattura trovata')
+    output = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
+    try:
+        with output, zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive, \
+                tempfile.TemporaryFile() as ledger_file:
+            ledger = io.TextIOWrapper(ledger_file, encoding='utf-8', newline='')
+            ledger_writer = csv.writer(ledger, delimiter=';')
+            ledger_writer.writerow(fatturapa.LEDGER_HEADER)
+            used, errors, discrepancies = set(), [], []
+            for upload, sha256, result, converted in itertools.chain([first], results):
+                if 'error' in result:
+                    errors.append([result['name'], result['error']])
+                    continue
+                if converted:
+                    crud.store_invoice(db, sha256=sha256, filename=upload, records=result['records'])
+                name, i = result['name'], 1
+                while name in used:
+                    i += 1
+                    name = result['name'] + '_' + str(i)
+                used.add(name)
+                archive.writestr(name + '.csv', result['csv'])
+                ledger_writer.writerows([name] + row[1:] for row in result['ledger'])
+                discrepancies.extend([name] + row[1:] for row in result['discrepancies'])
+            ledger.flush()
+            ledger_file.seek(0)
+            with archive.open('registro.csv', 'w') as registro:
+                shutil.copyfileobj(ledger_file, registro)
+            if errors:
+                error_file = io.StringIO()
+                csv.writer(error_file, delimiter=';').writerows([['File', 'Errore']] + errors)
+                archive.writestr('errori.csv', error_file.getvalue())
+            if discrepancies:
+                discrepancy_file = io.StringIO()
+                csv.writer(discrepancy_file, delimiter=';').writerows([fatturapa.DISCREPANCY_HEADER] + discrepancies)
+                archive.writestr('discrepanze.csv', discrepancy_file.getvalue())
+    except Exception:
+        os.remove(output.name)
+        raise
+    return FileResponse(output.name, media_type='application/zip', filename='fatture.zip',
+                        background=BackgroundTask(os.remove, output.name))
+
+
 @app.post("/send-email")
-async def send_in_background(report_id: int,
-                             background_tasks: BackgroundTasks,
-                             email: EmailStr = Form(...),
-                             file: UploadFile = File(...),
-                             current_user: models.User = Depends(is_admin),
-                             db: SessionLocal = Depends(get_db)) -> Response:
+def send_email(report_id: int,
+               email: EmailStr = Form(...),
+               file: UploadFile = File(...),
+               current_user: models.User = Depends(is_admin),
+               db: SessionLocal = Depends(get_db)) -> Response:
     report = crud.get_report_by_id(db=db, report_id=report_id)
-    message = MessageSchema(
-        subject=report.last_name.upper() + ' ' + report.first_name.upper() + ' - Intervento ' + report.client_name + ' ' + report.Report.date.strftime(
-            '%d/%m/%Y'),
-        recipients=[email],
-        body='<div style="padding-bottom: 20px;">Buongiorno,<br> in allegato l\'intervento di ' + report.last_name.upper() + ' '
-             + report.first_name.upper() + ' in data ' + report.Report.date.strftime(
-            '%d/%m/%Y') + ' presso ' + report.client_name + '.<br><br>'
-                                                            'Il presente intervento è da ritenersi accettato se '
-                                                            'non vi saranno comunicazioni entro 3 giorni '
-                                                            'lavorativi.<br><br>' +
-             'Cordiali saluti<br>Team Manutenzione</div><hr style="width: 50%; margin-left: 0;">'
-             '<div><img src="cid:logo" alt="Move Automation" style="width: 150px; height: auto; padding-top: 20px;"'
-             '></div><div>'
-             '<a href="www.moveautomation.it">www.moveautomation.it</a><br>'
-             'Move Automation S.r.l.<br>'
-             'Via Fornaci, 70<br>'
-             '38068 Rovereto (TN)<br>'
-             '+39.348.2355393</div>',
-        subtype=MessageType.html,
-        attachments=[file,
-                     {
-                         "file": "app/static/logo.png",
-                         "headers": {"Content-ID": "<logo>",
-                                     "Content-Disposition": "inline; filename=\"logo.png\""},
-                         "mime_type": "image",
-                         "mime_subtype": "png",
-                     }]
-    )
-    fm = FastMail(conf)
-    background_tasks.add_task(fm.send_message, message)
-    crud.edit_report_email_date(db=db, report_id=report_id, email_date=datetime.datetime.now(ZoneInfo("Europe/Rome")))
+    if report is None:
+        raise HTTPException(status_code=404, detail="Intervento non trovato")
+    message = mail.report_message(report, recipient=email, pdf=file.file.read(), pdf_name=file.filename)
+    mail.enqueue(db, message=message, report_ids=[report_id], user_id=current_user.id)
     return Response(status_code=200)
 
 
+@app.post("/reports/monthly/email")
+def send_monthly_reports(email: schemas.ReportEmailCreate, db: SessionLocal = Depends(get_db),
+                         current_user: models.User = Depends(is_admin)):
+    if email.type == 'commission':
+        reports = crud.get_monthly_commission_reports(db=db, month=email.month, user_id=email.user_id,
+                                                      client_id=email.client_id, work_id=email.work_id)
+    else:
+        reports = crud.get_monthly_reports(db=db, month=email.month, user_id=email.user_id,
+                                           client_id=email.client_id, plant_id=email.plant_id or 0,
+                                           work_id=email.work_id)
+    if email.skip_sent:
+        reports = [report for report in reports if report.Report.email_date is None]
+    recipients = release(db, {report.Report.id: email.email for report in reports} if email.email else
+                         crud.get_report_recipients(db=db, reports=reports))
+    groups, skipped = {}, []
+    for report in reports:
+        if recipients[report.Report.id]:
+            groups.setdefault((recipients[report.Report.id], report.client_id), []).append(report)
+        else:
+            skipped.append(report.Report.id)
+    queued = []
+    for (recipient, _), group in groups.items():
+        batches, size = [[]], 0
+        for report in group:
+            pdf = render.render_report_pdf(report)
+            if batches[-1] and size + len(pdf) > mail.MAIL_MAX_BYTES:
+                batches.append([])
+                size = 0
+            batches[-1].append((report, pdf))
+            size += len(pdf)
+        for batch in batches:
+            message = mail.reports_message([report for report, _ in batch], recipient=recipient, month=email.month,
+                                           attachments=[(mail.report_filename(report), pdf) for report, pdf in batch])
+            db_message = mail.enqueue(db, message=message, report_ids=[report.Report.id for report, _ in batch],
+                                      user_id=current_user.id)
+            queued.append({"id": db_message.id, "recipient": recipient, "reports": len(batch)})
+    return {"queued": queued, "skipped": skipped}
+
+
+@app.get("/outbox")
+def get_outbox(status: Optional[str] = None, limit: int = 100, db: SessionLocal = Depends(get_read_db),
+               current_user: models.User = Depends(is_read_admin)):
+    return crud.get_outbox_messages(db=db, status=status, limit=limit)
+
+
+@app.get("/invoices")
+def get_invoices(supplier: Optional[str] = None, start_date: Optional[str] = None, end_date: Optional[str] = None,
+                 limit: int = 100, db: SessionLocal = Depends(get_read_db),
+                 current_user: models.User = Depends(is_read_admin)):
+    return crud.get_invoices(db=db, supplier=supplier, start_date=start_date, end_date=end_date, limit=limit)
+
+
+@app.get("/invoices/lines")
+def get_invoice_lines(article_code: Optional[str] = None, supplier: Optional[str] = None,
+                      start_date: Optional[str] = None, end_date: Optional[str] = None, limit: int = 1000,
+                      db: SessionLocal = Depends(get_read_db), current_user: models.User = Depends(is_read_admin)):
+    return crud.get_invoice_lines(db=db, article_code=article_code, supplier=supplier, start_date=start_date,
+                                  end_date=end_date, limit=limit)
+
+
+@app.get("/invoices/spend")
+def get_invoice_spend(group_by: Literal['supplier', 'article', 'month'] = 'supplier', supplier: Optional[str] = None,
+                      start_date: Optional[str] = None, end_date: Optional[str] = None,
+                      db: SessionLocal = Depends(get_read_db), current_user: models.User = Depends(is_read_admin)):
+    return crud.get_invoice_spend(db=db, group_by=group_by, supplier=supplier, start_date=start_date,
+                                  end_date=end_date)
+
+
+@app.get("/invoices/{invoice_id}")
+def get_invoice(invoice_id: int, db: SessionLocal = Depends(get_db), current_user: models.User = Depends(is_admin)):
+    invoice = crud.get_invoice_by_id(db=db, invoice_id=invoice_id)
+    if invoice is None:
+        raise HTTPException(status_code=404, detail="Fattura non trovata")
+    return invoice
+
+
+@app.get("/metrics")
+def get_metrics(current_user: models.User = Depends(is_admin)):
+    return Response(content=metrics.exposition(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/profile")
+def profile_server(seconds: float = 10, current_user: models.User = Depends(is_admin)):
+    collapsed = profiler.profile(seconds)
+    if collapsed is None:
+        raise HTTPException(status_code=409, detail="Profilazione già in corso")
+    return Response(content=collapsed, media_type="text/plain",
+                    headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'})
+
+
+@app.get("/profiles/{profile_id}")
+def get_request_profile(profile_id: str, current_user: models.User = Depends(is_admin)):
+    collapsed = profiler.profiles.get(profile_id)
+    if collapsed is None:
+        raise HTTPException(status_code=404, detail="Profilo non trovato")
+    return Response(content=collapsed, media_type="text/plain",
+                    headers={"Content-Disposition": 'attachment; filename="' + profile_id + '.collapsed"'})
+
+
+@app.get("/limits")
+def get_limits(current_user: models.User = Depends(is_admin)):
+    return limits.stats()
+
+
 @app.get("/reports/search")
-def search_reports(q: str, db: SessionLocal = Depends(get_db), current_user: models.User = Depends(is_admin)):
+def search_reports(q: str, db: SessionLocal = Depends(get_read_db), current_user: models.User = Depends(is_read_admin)):
     if not q:
         return crud.get_reports(db=db, limit=100)
     return crud.search_reports(db=db, search=q)
@@ -0,0 +1,279 @@
+import bisect
+import contextvars
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+from sqlalchemy import event
+
+import app.coalesce as coalesce
+import app.limits as limits
+import app.database as database
+
+load_dotenv()
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RENDER_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+PAGE_BUCKETS = (1, 2, 3, 5, 10, 20, 50)
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+current_scope = contextvars.ContextVar('current_scope', default=None)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                          for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + _labels(self.labels, labels), value) for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def observe(self, value: float, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        samples = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket' + _labels(self.labels + ('le',), labels + (bound,)), cumulative))
+            samples.append((self.name + '_sum' + _labels(self.labels, labels), total))
+            samples.append((self.name + '_count' + _labels(self.labels, labels), cumulative))
+        return samples
+
+
+class Collector:
+    def __init__(self, name: str, help: str, kind: str, collect, labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.collect = collect
+        self.labels = labels
+
+    def samples(self):
+        return [(self.name + _labels(self.labels, labels), value) for labels, value in self.collect()]
+
+
+request_duration = Histogram('http_request_duration_seconds', 'Request latency by route', LATENCY_BUCKETS,
+                             ('method', 'route'))
+requests_total = Counter('http_requests_total', 'Requests by route and status', ('method', 'route', 'status'))
+requests_in_flight = Gauge('http_requests_in_flight', 'Requests being served')
+pdf_render_duration = Histogram('pdf_render_duration_seconds', 'Time spent rendering a single report PDF',
+                                RENDER_BUCKETS)
+pdf_pages = Histogram('pdf_pages', 'Pages in a rendered report PDF', PAGE_BUCKETS)
+stage_duration = Histogram('stage_duration_seconds', 'Time spent in each pipeline stage', LATENCY_BUCKETS, ('stage',))
+pool_wait = Histogram('db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection', WAIT_BUCKETS,
+                      ('pool', 'route'))
+pool_hold = Histogram('db_pool_hold_seconds', 'Time a pooled connection stays checked out', LATENCY_BUCKETS,
+                      ('pool', 'route'))
+pool_timeouts = Counter('db_pool_timeouts_total', 'Checkouts that gave up after pool_timeout', ('pool', 'route'))
+
+
+def _current_route():
+    scope = current_scope.get()
+    return 'background' if scope is None else _route(scope)
+
+
+def _engines():
+    if database.replica_engine is database.engine:
+        return [database.engine]
+    return [database.engine, database.replica_engine]
+
+
+def _waited(pool, seconds, timed_out):
+    route = _current_route()
+    pool_wait.observe(seconds, pool.logging_name, route)
+    if timed_out:
+        pool_timeouts.inc(pool.logging_name, route)
+
+
+def _instrument(engine):
+    name = engine.pool.logging_name
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info['checked_out'] = time.perf_counter(), _current_route()
+
+    @event.listens_for(engine, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        checked_out = connection_record.info.pop('checked_out', None)
+        if checked_out is not None:
+            pool_hold.observe(time.perf_counter() - checked_out[0], name, checked_out[1])
+
+
+database.pool_listeners.append(_waited)
+for _engine in _engines():
+    _instrument(_engine)
+
+
+def _pool(method):
+    return lambda: [((engine.pool.logging_name,), getattr(engine.pool, method)()) for engine in _engines()]
+
+
+def _coalesce(attribute):
+    return lambda: [((), getattr(coalesce.pdf, attribute))]
+
+
+def _hit_ratio():
+    flight = coalesce.pdf
+    lookups = flight.hits + flight.misses + flight.shared
+    return [((), (flight.hits + flight.shared) / lookups if lookups else 0)]
+
+
+def _limits(key):
+    return lambda: [((name,), stats[key]) for name, stats in limits.stats().items()]
+
+
+registry = [
+    request_duration, requests_total, requests_in_flight, pdf_render_duration, pdf_pages, stage_duration,
+    pool_wait, pool_hold, pool_timeouts,
+    Collector('db_pool_size', 'Connections kept in the pool', 'gauge', _pool('size'), ('pool',)),
+    Collector('db_pool_checked_out', 'Connections currently checked out', 'gauge', _pool('checkedout'), ('pool',)),
+    Collector('db_pool_checked_in', 'Idle connections in the pool', 'gauge', _pool('checkedin'), ('pool',)),
+    Collector('db_pool_overflow', 'Connections opened beyond pool_size', 'gauge',
+              lambda: [((engine.pool.logging_name,), max(engine.pool.overflow(), 0)) for engine in _engines()],
+              ('pool',)),
+    Collector('pdf_coalesce_hits_total', 'PDF requests served from the cache', 'counter', _coalesce('hits')),
+    Collector('pdf_coalesce_shared_total', 'PDF requests that joined a render in progress', 'counter',
+              _coalesce('shared')),
+    Collector('pdf_coalesce_misses_total', 'PDF requests that rendered', 'counter', _coalesce('misses')),
+    Collector('pdf_coalesce_hit_ratio', 'Share of PDF requests that did not render', 'gauge', _hit_ratio),
+    Collector('admission_active', 'Requests admitted and running', 'gauge', _limits('active'), ('class',)),
+    Collector('admission_waiting', 'Requests waiting for admission', 'gauge', _limits('waiting'), ('class',)),
+    Collector('admission_admitted_total', 'Requests admitted', 'counter', _limits('admitted'), ('class',)),
+    Collector('admission_rejected_total', 'Requests rejected with 429', 'counter', _limits('rejected'), ('class',)),
+]
+
+
+def exposition():
+    lines = []
+    for metric in registry:
+        lines.append('# HELP ' + metric.name + ' ' + metric.help)
+        lines.append('# TYPE ' + metric.name + ' ' + metric.kind)
+        lines.extend(name + ' ' + repr(float(value)) for name, value in metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+def _route(scope):
+    endpoint = scope.get("endpoint")
+    app = scope.get("app")
+    if endpoint is None or app is None:
+        return 'unmatched'
+    for route in app.routes:
+        if getattr(route, 'endpoint', None) is endpoint:
+            return route.path
+    return 'unmatched'
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        requests_in_flight.inc()
+        token = current_scope.set(scope)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_scope.reset(token)
+            requests_in_flight.dec()
+            route = _route(scope)
+            request_duration.observe(time.perf_counter() - start, scope["method"], route)
+            requests_total.inc(scope["method"], route, str(status[0]))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+
+
+# single process only: the counters live in this process, and with uvicorn --workers N only the first worker
+# gets the port. Run one worker per container, or scrape the /metrics route of each worker instead.
+def serve():
+    global _server
+    if METRICS_PORT and _server is None:
+        try:
+            _server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), _Handler)
+        except OSError as e:
+            logger.warning("metrics port %s:%d not available, serving /metrics on the app only: %s", METRICS_HOST,
+                           METRICS_PORT, e)
+            return
+        threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
@@ -0,0 +1,135 @@
+import argparse
+import importlib
+import os
+import pkgutil
+import time
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+import app.migrations
+from app.database import engine
+
+load_dotenv()
+
+LOCK_ID = 4621
+LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s")
+
+
+def revisions():
+    result = []
+    for module in sorted(pkgutil.iter_modules(app.migrations.__path__), key=lambda module: module.name):
+        version, _, name = module.name.partition('_')
+        result.append((version, name, importlib.import_module('app.migrations.' + module.name)))
+    return result
+
+
+def applied(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_migrations (version VARCHAR PRIMARY KEY, name VARCHAR, '
+        'applied_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now(), seconds FLOAT)'))
+    return {version: (applied_at, seconds) for version, applied_at, seconds in connection.execute(
+        text('SELECT version, applied_at, seconds FROM schema_migrations'))}
+
+
+def record(connection, version: str, name: str, seconds: float):
+    connection.execute(text('INSERT INTO schema_migrations (version, name, seconds) VALUES (:version, :name, '
+                            ':seconds)'), {'version': version, 'name': name, 'seconds': seconds})
+
+
+def index_exists(connection, name: str):
+    return connection.execute(text(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"), {'name': name}).scalar()
+
+
+def create_index_concurrently(connection, name: str, table: str, columns: list, unique: bool = False,
+                              where: str = None):
+    valid = index_exists(connection, name)
+    if valid:
+        return
+    if valid is False:
+        print('  dropping invalid index ' + name)
+        connection.exec_driver_sql('DROP INDEX CONCURRENTLY IF EXISTS ' + name)
+    print('  creating index ' + name)
+    connection.exec_driver_sql('CREATE ' + ('UNIQUE ' if unique else '') + 'INDEX CONCURRENTLY IF NOT EXISTS ' +
+                               name + ' ON ' + table + ' (' + ', '.join(columns) + ')' +
+                               (' WHERE ' + where if where else ''))
+
+
+def drop_index_concurrently(connection, name: str):
+    connection.exec_driver_sql('DROP INDEX CONCURRENTLY IF EXISTS ' + name)
+
+
+def backfill(connection, table: str, assignment: str, condition: str = 'TRUE', batch_size: int = 10000,
+             pause: float = 0.0):
+    low, high = connection.execute(text('SELECT MIN(id), MAX(id) FROM ' + table + ' WHERE ' + condition)).one()
+    if low is None:
+        return 0
+    updated = 0
+    for start in range(low, high + 1, batch_size):
+        updated += connection.execute(text(
+            'UPDATE ' + table + ' SET ' + assignment + ' WHERE id >= :start AND id < :end AND (' + condition + ')'),
+            {'start': start, 'end': start + batch_size}).rowcount
+        print('  %s: %d rows updated, id %d of %d' % (table, updated, min(start + batch_size - 1, high), high))
+        if pause:
+            time.sleep(pause)
+    return updated
+
+
+def upgrade(connection, version: str, name: str, module):
+    start = time.perf_counter()
+    if module.transactional:
+        with engine.begin() as transaction:
+            transaction.exec_driver_sql("SET LOCAL lock_timeout = '" + LOCK_TIMEOUT + "'")
+            module.upgrade(transaction)
+            record(transaction, version, name, time.perf_counter() - start)
+    else:
+        module.upgrade(connection)
+        record(connection, version, name, time.perf_counter() - start)
+
+
+def migrate(target: str = None, fake: bool = False):
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        connection.execute(text('SELECT pg_advisory_lock(:id)'), {'id': LOCK_ID})
+        try:
+            done = applied(connection)
+            for version, name, module in revisions():
+                if version in done or (target and version > target):
+                    continue
+                print(('faking ' if fake else 'applying ') + version + ' ' + name)
+                if fake:
+                    record(connection, version, name, 0)
+                else:
+                    upgrade(connection, version, name, module)
+        finally:
+            connection.execute(text('SELECT pg_advisory_unlock(:id)'), {'id': LOCK_ID})
+
+
+def status():
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        done = applied(connection)
+    for version, name, module in revisions():
+        if version in done:
+            applied_at, seconds = done[version]
+            print('%s %-30s applied %s (%.1f s)' % (version, name, applied_at.isoformat(timespec='seconds'), seconds))
+        else:
+            print('%s %-30s pending%s' % (version, name, '' if module.transactional else ', online'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply the pending schema migrations in app/migrations.')
+    parser.add_argument('--list', action='store_true', help='show applied and pending migrations')
+    parser.add_argument('--target', help='stop after this version')
+    parser.add_argument('--fake', action='store_true', help='mark the migrations as applied without running them')
+    args = parser.parse_args()
+
+    if args.list:
+        status()
+    else:
+        migrate(args.target, args.fake)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+transactional = True
+
+STATEMENTS = [
+    '''CREATE TABLE IF NOT EXISTS clients (
+        id SERIAL NOT NULL,
+        name VARCHAR,
+        province VARCHAR,
+        city VARCHAR,
+        cap VARCHAR,
+        address VARCHAR,
+        email VARCHAR,
+        contact VARCHAR,
+        phone_number VARCHAR,
+        date_created TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (id)
+    )''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_clients_id ON clients (id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_clients_name ON clients (name)',
+    '''CREATE TABLE IF NOT EXISTS intervention_types (
+        id SERIAL NOT NULL,
+        name VARCHAR,
+        PRIMARY KEY (id)
+    )''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_intervention_types_id ON intervention_types (id)',
+    '''CREATE TABLE IF NOT EXISTS invoices (
+        id SERIAL NOT NULL,
+        sha256 VARCHAR,
+        body INTEGER,
+        filename VARCHAR,
+        supplier_name VARCHAR,
+        supplier_vat VARCHAR,
+        supplier_country VARCHAR,
+        supplier_code VARCHAR,
+        supplier_tax_code VARCHAR,
+        supplier_tax_regime VARCHAR,
+        supplier_address VARCHAR,
+        supplier_city VARCHAR,
+        supplier_province VARCHAR,
+        supplier_cap VARCHAR,
+        supplier_nation VARCHAR,
+        document_type VARCHAR,
+        number VARCHAR,
+        date DATE,
+        total NUMERIC,
+        payments JSON,
+        date_created TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (id),
+        UNIQUE (sha256, body)
+    )''',
+    'CREATE INDEX IF NOT EXISTS ix_invoices_date ON invoices (date)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_invoices_id ON invoices (id)',
+    'CREATE INDEX IF NOT EXISTS ix_invoices_sha256 ON invoices (sha256)',
+    'CREATE INDEX IF NOT EXISTS ix_invoices_supplier_name ON invoices (supplier_name)',
+    'CREATE INDEX IF NOT EXISTS ix_invoices_supplier_vat_date ON invoices (supplier_vat, date)',
+    '''CREATE TABLE IF NOT EXISTS locations (
+        id SERIAL NOT NULL,
+        name VARCHAR,
+        PRIMARY KEY (id)
+    )''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_locations_id ON locations (id)',
+    '''CREATE TABLE IF NOT EXISTS roles (
+        id SERIAL NOT NULL,
+        name VARCHAR,
+        PRIMARY KEY (id)
+    )''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_roles_id ON roles (id)',
+    '''CREATE TABLE IF NOT EXISTS commissions (
+        id SERIAL NOT NULL,
+        client_id INTEGER,
+        code VARCHAR,
+        description VARCHAR,
+        open BOOLEAN,
+        date_created TIMESTAMP WITHOUT TIME ZONE,
+        date_closed TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (id),
+        FOREIGN KEY(client_id) REFERENCES clients (id)
+    )''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_commissions_id ON commissions (id)',
+    '''CREATE TABLE IF NOT EXISTS invoice_lines (
+        id SERIAL NOT NULL,
+        invoice_id INTEGER,
+        line_number INTEGER,
+        article_code VARCHAR,
+        article_codes JSON,
+        description VARCHAR,
+        quantity NUMERIC,
+        unit VARCHAR,
+        unit_price NUMERIC,
+        discounts JSON,
+        vat_rate NUMERIC,
+        vat_nature VARCHAR,
+        total NUMERIC,
+        PRIMARY KEY (id),
+        FOREIGN KEY(invoice_id) REFERENCES invoices (id) ON DELETE CASCADE
+    )''',
+    'CREATE INDEX IF NOT EXISTS ix_invoice_lines_article_code ON invoice_lines (article_code)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_invoice_lines_id ON invoice_lines (id)',
+    'CREATE INDEX IF NOT EXISTS ix_invoice_lines_invoice_id ON invoice_lines (invoice_id)',
+    '''CREATE TABLE IF NOT EXISTS invoice_summaries (
+        id SERIAL NOT NULL,
+        invoice_id INTEGER,
+        vat_rate NUMERIC,
+        vat_nature VARCHAR,
+        taxable NUMERIC,
+        tax NUMERIC,
+        rounding NUMERIC,
+        PRIMARY KEY (id),
+        FOREIGN KEY(invoice_id) REFERENCES invoices (id) ON DELETE CASCADE
+    )''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_invoice_summaries_id ON invoice_summaries (id)',
+    'CREATE INDEX IF NOT EXISTS ix_invoice_summaries_invoice_id ON invoice_summaries (invoice_id)',
+    '''CREATE TABLE IF NOT EXISTS operators (
+        id SERIAL NOT NULL,
+        role_id INTEGER,
+        client_id INTEGER,
+        first_name VARCHAR,
+        last_name VARCHAR,
+        email VARCHAR,
+        username VARCHAR,
+        password VARCHAR,
+        temp_password VARCHAR,
+        phone_number VARCHAR,
+        PRIMARY KEY (id),
+        FOREIGN KEY(role_id) REFERENCES roles (id),
+        FOREIGN KEY(client_id) REFERENCES clients (id)
+    )''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_operators_email ON operators (email)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_operators_id ON operators (id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_operators_username ON operators (username)',
+    '''CREATE TABLE IF NOT EXISTS plants (
+        id SERIAL NOT NULL,
+        client_id INTEGER,
+        name VARCHAR,
+        city VARCHAR,
+        province VARCHAR,
+        cap VARCHAR,
+        address VARCHAR,
+        email VARCHAR,
+        contact VARCHAR,
+        phone_number VARCHAR,
+        date_created TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (id),
+        FOREIGN KEY(client_id) REFERENCES clients (id)
+    )''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_plants_id ON plants (id)',
+    '''CREATE TABLE IF NOT EXISTS export_jobs (
+        id SERIAL NOT NULL,
+        requested_by INTEGER,
+        format VARCHAR,
+        period VARCHAR,
+        type VARCHAR,
+        params JSON,
+        status VARCHAR,
+        progress INTEGER,
+        total INTEGER,
+        filename VARCHAR,
+        path VARCHAR,
+        error VARCHAR,
+        date_created TIMESTAMP WITHOUT TIME ZONE,
+        date_updated TIMESTAMP WITHOUT TIME ZONE,
+        date_finished TIMESTAMP WITHOUT TIME ZONE,
+        expires_at TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (id),
+        FOREIGN KEY(requested_by) REFERENCES operators (id)
+    )''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_export_jobs_id ON export_jobs (id)',
+    'CREATE INDEX IF NOT EXISTS ix_export_jobs_status ON export_jobs (status)',
+    '''CREATE TABLE IF NOT EXISTS machines (
+        id SERIAL NOT NULL,
+        plant_id INTEGER,
+        robotic_island VARCHAR,
+        code VARCHAR,
+        name VARCHAR,
+        brand VARCHAR,
+        model VARCHAR,
+        serial_number VARCHAR,
+        production_year VARCHAR,
+        cost_center VARCHAR,
+        description VARCHAR,
+        date_created TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (id),
+        FOREIGN KEY(plant_id) REFERENCES plants (id)
+    )''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_machines_id ON machines (id)',
+    '''CREATE TABLE IF NOT EXISTS outbox (
+        id SERIAL NOT NULL,
+        requested_by INTEGER,
+        recipients JSON,
+        subject VARCHAR,
+        message BYTEA,
+        report_ids JSON,
+        status VARCHAR,
+        attempts INTEGER,
+        next_attempt_at TIMESTAMP WITHOUT TIME ZONE,
+        error VARCHAR,
+        date_created TIMESTAMP WITHOUT TIME ZONE,
+        date_updated TIMESTAMP WITHOUT TIME ZONE,
+        date_sent TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (id),
+        FOREIGN KEY(requested_by) REFERENCES operators (id)
+    )''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_outbox_id ON outbox (id)',
+    'CREATE INDEX IF NOT EXISTS ix_outbox_next_attempt_at ON outbox (next_attempt_at)',
+    'CREATE INDEX IF NOT EXISTS ix_outbox_status ON outbox (status)',
+    '''CREATE TABLE IF NOT EXISTS reports (
+        id SERIAL NOT NULL,
+        operator_id INTEGER,
+        work_id INTEGER,
+        type VARCHAR,
+        date DATE,
+        intervention_duration VARCHAR,
+        intervention_type VARCHAR,
+        intervention_location VARCHAR,
+        supervisor_id INTEGER,
+        description VARCHAR,
+        notes VARCHAR,
+        trip_kms VARCHAR,
+        cost VARCHAR,
+        date_created TIMESTAMP WITHOUT TIME ZONE,
+        email_date TIMESTAMP WITHOUT TIME ZONE,
+        PRIMARY KEY (id),
+        FOREIGN KEY(operator_id) REFERENCES operators (id),
+        FOREIGN KEY(supervisor_id) REFERENCES operators (id)
+    )''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_reports_id ON reports (id)',
+    '''CREATE TABLE IF NOT EXISTS tickets (
+        id SERIAL NOT NULL,
+        title VARCHAR,
+        status VARCHAR,
+        priority VARCHAR,
+        date_created TIMESTAMP WITHOUT TIME ZONE,
+        date_edited TIMESTAMP WITHOUT TIME ZONE,
+        date_closed TIMESTAMP WITHOUT TIME ZONE,
+        requested_by INTEGER,
+        machine_id INTEGER,
+        description VARCHAR,
+        PRIMARY KEY (id),
+        FOREIGN KEY(requested_by) REFERENCES operators (id),
+        FOREIGN KEY(machine_id) REFERENCES machines (id)
+    )''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_tickets_id ON tickets (id)',
+]
+
+
+def upgrade(connection):
+    for statement in STATEMENTS:
+        connection.exec_driver_sql(statement)
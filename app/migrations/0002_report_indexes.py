@@ -0,0 +1,13 @@
+from app.migrate import create_index_concurrently
+
+transactional = False
+
+
+def upgrade(connection):
+    create_index_concurrently(connection, 'ix_reports_date', 'reports', ['date'])
+    create_index_concurrently(connection, 'ix_reports_operator_id_date', 'reports', ['operator_id', 'date'])
+    create_index_concurrently(connection, 'ix_reports_type_work_id_date', 'reports', ['type', 'work_id', 'date'])
+    create_index_concurrently(connection, 'ix_reports_supervisor_id', 'reports', ['supervisor_id'])
+    create_index_concurrently(connection, 'ix_plants_client_id', 'plants', ['client_id'])
+    create_index_concurrently(connection, 'ix_machines_plant_id', 'machines', ['plant_id'])
+    create_index_concurrently(connection, 'ix_commissions_client_id', 'commissions', ['client_id'])
@@ -0,0 +1,93 @@
+import datetime
+
+from sqlalchemy import text
+
+from app.database import engine
+from app.migrate import LOCK_TIMEOUT, backfill
+from app.partitions import YEARS_AHEAD, bounds, name
+
+transactional = False
+
+BATCH_SIZE = 50000
+
+INDEXES = [('ix_reports_date', 'date'), ('ix_reports_operator_id_date', 'operator_id, date'),
+           ('ix_reports_type_work_id_date', 'type, work_id, date'), ('ix_reports_supervisor_id', 'supervisor_id')]
+
+
+def create_partitioned(connection):
+    connection.exec_driver_sql('DROP TABLE IF EXISTS reports_partitioned')
+    connection.exec_driver_sql(
+        'CREATE TABLE reports_partitioned (LIKE reports INCLUDING DEFAULTS, '
+        'CONSTRAINT reports_partitioned_pkey PRIMARY KEY (id, date), '
+        'CONSTRAINT reports_operator_id_fkey FOREIGN KEY (operator_id) REFERENCES operators (id), '
+        'CONSTRAINT reports_supervisor_id_fkey FOREIGN KEY (supervisor_id) REFERENCES operators (id)) '
+        'PARTITION BY RANGE (date)')
+    for index, columns in INDEXES:
+        connection.exec_driver_sql('CREATE INDEX ' + index + '_new ON reports_partitioned (' + columns + ')')
+    first = connection.execute(text('SELECT MIN(date) FROM reports')).scalar() or datetime.date.today()
+    for year in range(first.year, datetime.date.today().year + YEARS_AHEAD + 1):
+        connection.exec_driver_sql('CREATE TABLE ' + name(year) + ' PARTITION OF reports_partitioned ' + bounds(year))
+    connection.exec_driver_sql('CREATE TABLE reports_default PARTITION OF reports_partitioned DEFAULT')
+
+
+def track_changes():
+    with engine.begin() as transaction:
+        transaction.exec_driver_sql("SET LOCAL lock_timeout = '" + LOCK_TIMEOUT + "'")
+        transaction.exec_driver_sql('DROP TABLE IF EXISTS reports_changes')
+        transaction.exec_driver_sql('CREATE TABLE reports_changes (id INTEGER PRIMARY KEY)')
+        transaction.exec_driver_sql(
+            "CREATE OR REPLACE FUNCTION log_report_change() RETURNS trigger AS $$ BEGIN "
+            "IF TG_OP <> 'INSERT' THEN INSERT INTO reports_changes VALUES (OLD.id) ON CONFLICT DO NOTHING; END IF; "
+            "IF TG_OP <> 'DELETE' THEN INSERT INTO reports_changes VALUES (NEW.id) ON CONFLICT DO NOTHING; END IF; "
+            "RETURN NULL; END $$ LANGUAGE plpgsql")
+        transaction.exec_driver_sql('DROP TRIGGER IF EXISTS reports_changes ON reports')
+        transaction.exec_driver_sql('CREATE TRIGGER reports_changes AFTER INSERT OR UPDATE OR DELETE ON reports '
+                                    'FOR EACH ROW EXECUTE FUNCTION log_report_change()')
+
+
+def copy(connection):
+    low, high = connection.execute(text('SELECT MIN(id), MAX(id) FROM reports')).one()
+    if low is None:
+        return
+    for start in range(low, high + 1, BATCH_SIZE):
+        connection.execute(text('INSERT INTO reports_partitioned SELECT * FROM reports WHERE id >= :start AND '
+                                'id < :end'), {'start': start, 'end': start + BATCH_SIZE})
+        print('  reports: copied up to id %d of %d' % (min(start + BATCH_SIZE - 1, high), high))
+
+
+def swap():
+    with engine.begin() as transaction:
+        transaction.exec_driver_sql("SET LOCAL lock_timeout = '" + LOCK_TIMEOUT + "'")
+        transaction.exec_driver_sql('LOCK TABLE reports IN EXCLUSIVE MODE')
+        transaction.exec_driver_sql('DELETE FROM reports_partitioned WHERE id IN (SELECT id FROM reports_changes)')
+        replayed = transaction.exec_driver_sql(
+            'INSERT INTO reports_partitioned SELECT r.* FROM reports r JOIN reports_changes c ON c.id = r.id').rowcount
+        print('  reports: %d rows changed during the copy' % replayed)
+        transaction.exec_driver_sql('ALTER SEQUENCE reports_id_seq OWNED BY NONE')
+        transaction.exec_driver_sql('DROP TABLE reports')
+        transaction.exec_driver_sql('DROP TABLE reports_changes')
+        transaction.exec_driver_sql('DROP FUNCTION log_report_change()')
+        transaction.exec_driver_sql('ALTER TABLE reports_partitioned RENAME TO reports')
+        transaction.exec_driver_sql('ALTER TABLE reports RENAME CONSTRAINT reports_partitioned_pkey TO reports_pkey')
+        transaction.exec_driver_sql('ALTER SEQUENCE reports_id_seq OWNED BY reports.id')
+        for index, _ in INDEXES:
+            transaction.exec_driver_sql('ALTER INDEX ' + index + '_new RENAME TO ' + index)
+
+
+def create_archive(connection):
+    connection.exec_driver_sql('CREATE TABLE IF NOT EXISTS reports_archive (LIKE reports, PRIMARY KEY (id, date)) '
+                               'PARTITION BY RANGE (date)')
+    for index, columns in INDEXES:
+        connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ' + index.replace('reports', 'reports_archive') +
+                                   ' ON reports_archive (' + columns + ')')
+
+
+def upgrade(connection):
+    if connection.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('reports')")).scalar() != 'p':
+        backfill(connection, 'reports', 'date = COALESCE(date_created, now())::date', 'date IS NULL')
+        track_changes()
+        create_partitioned(connection)
+        copy(connection)
+        swap()
+        connection.exec_driver_sql('ANALYZE reports')
+    create_archive(connection)
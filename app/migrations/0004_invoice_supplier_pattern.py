@@ -0,0 +1,8 @@
+from app.migrate import create_index_concurrently
+
+transactional = False
+
+
+def upgrade(connection):
+    create_index_concurrently(connection, 'ix_invoices_supplier_name_pattern', 'invoices',
+                              ['lower(supplier_name) text_pattern_ops'])
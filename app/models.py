@@ -1,6 +1,7 @@
 from passlib.context import CryptContext
 from pydantic import BaseModel
-from sqlalchemy import Column, Integer, String, ForeignKey, Date, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, ForeignKey, Date, DateTime, Boolean, JSON, Numeric, Index, \
+    UniqueConstraint, LargeBinary, PrimaryKeyConstraint, text
 from sqlalchemy.orm import deferred
 
 from app.database import Base
@@ -42,7 +43,7 @@ class Client(Base):
 class Plant(Base):
     __tablename__ = "plants"
     id = Column(Integer, primary_key=True, index=True, unique=True)
-    client_id = Column(Integer, ForeignKey("clients.id"))
+    client_id = Column(Integer, ForeignKey("clients.id"), index=True)
     name = Column(String)
     city = Column(String)
     province = Column(String)
@@ -57,7 +58,7 @@ class Plant(Base):
 class Machine(Base):
     __tablename__ = "machines"
     id = Column(Integer, primary_key=True, index=True, unique=True)
-    plant_id = Column(Integer, ForeignKey("plants.id"))
+    plant_id = Column(Integer, ForeignKey("plants.id"), index=True)
     robotic_island = Column(String)
     code = Column(String)
     name = Column(String)
@@ -73,7 +74,7 @@ class Machine(Base):
 class Commission(Base):
     __tablename__ = "commissions"
     id = Column(Integer, primary_key=True, index=True, unique=True)
-    client_id = Column(Integer, ForeignKey("clients.id"))
+    client_id = Column(Integer, ForeignKey("clients.id"), index=True)
     code = Column(String)
     description = Column(String)
     open = Column(Boolean)
@@ -83,7 +84,12 @@ class Commission(Base):
 
 class Report(Base):
     __tablename__ = "reports"
-    id = Column(Integer, primary_key=True, index=True, unique=True)
+    __table_args__ = (PrimaryKeyConstraint("id", "date"),
+                      Index("ix_reports_date", "date"),
+                      Index("ix_reports_operator_id_date", "operator_id", "date"),
+                      Index("ix_reports_type_work_id_date", "type", "work_id", "date"),
+                      {"postgresql_partition_by": "RANGE (date)"})
+    id = Column(Integer, autoincrement=True)
     operator_id = Column(Integer, ForeignKey("operators.id"))
     work_id = Column(Integer)  # might be either a machine or a commission
     type = Column(String)  # either machine or commission
@@ -91,7 +97,7 @@ class Report(Base):
     intervention_duration = Column(String)
     intervention_type = Column(String)
     intervention_location = Column(String)
-    supervisor_id = Column(Integer, ForeignKey("operators.id"))
+    supervisor_id = Column(Integer, ForeignKey("operators.id"), index=True)
     description = Column(String)
     notes = Column(String)
     trip_kms = Column(String)
@@ -99,6 +105,9 @@ class Report(Base):
     date_created = Column(DateTime)
     email_date = Column(DateTime)
 
+    # partitioned by date, so the table key is (id, date) while id alone still identifies a report
+    __mapper_args__ = {"primary_key": [id]}
+
 
 class InterventionType(Base):
     __tablename__ = "intervention_types"
@@ -132,6 +141,99 @@ class Ticket(Base):
     description = Column(String)
 
 
+class ExportJob(Base):
+    __tablename__ = "export_jobs"
+    id = Column(Integer, primary_key=True, index=True, unique=True)
+    requested_by = Column(Integer, ForeignKey("operators.id"))
+    format = Column(String)  # either pdf or csv
+    period = Column(String)  # either monthly or interval
+    type = Column(String)  # either machine or commission
+    params = Column(JSON)
+    status = Column(String, index=True)  # queued, running, done, failed or expired
+    progress = Column(Integer)
+    total = Column(Integer)
+    filename = Column(String)
+    path = Column(String)
+    error = Column(String)
+    date_created = Column(DateTime)
+    date_updated = Column(DateTime)
+    date_finished = Column(DateTime)
+    expires_at = Column(DateTime)
+
+
+class OutboxMessage(Base):
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True, index=True, unique=True)
+    requested_by = Column(Integer, ForeignKey("operators.id"))
+    recipients = Column(JSON)
+    subject = Column(String)
+    message = deferred(Column(LargeBinary))  # the whole MIME message, attachments included
+    report_ids = Column(JSON)
+    status = Column(String, index=True)  # queued, sending, sent or failed
+    attempts = Column(Integer)
+    next_attempt_at = Column(DateTime, index=True)
+    error = Column(String)
+    date_created = Column(DateTime)
+    date_updated = Column(DateTime)
+    date_sent = Column(DateTime)
+
+
+class Invoice(Base):
+    __tablename__ = "invoices"
+    __table_args__ = (UniqueConstraint("sha256", "body"),
+                      Index("ix_invoices_supplier_vat_date", "supplier_vat", "date"),
+                      Index("ix_invoices_supplier_name_pattern", text("lower(supplier_name) text_pattern_ops")))
+    id = Column(Integer, primary_key=True, index=True, unique=True)
+    sha256 = Column(String, index=True)  # of the uploaded file, which may hold several invoices
+    body = Column(Integer)
+    filename = Column(String)
+    supplier_name = Column(String, index=True)
+    supplier_vat = Column(String)
+    supplier_country = Column(String)
+    supplier_code = Column(String)
+    supplier_tax_code = Column(String)
+    supplier_tax_regime = Column(String)
+    supplier_address = Column(String)
+    supplier_city = Column(String)
+    supplier_province = Column(String)
+    supplier_cap = Column(String)
+    supplier_nation = Column(String)
+    document_type = Column(String)
+    number = Column(String)
+    date = Column(Date, index=True)
+    total = Column(Numeric)
+    payments = Column(JSON)
+    date_created = Column(DateTime)
+
+
+class InvoiceLine(Base):
+    __tablename__ = "invoice_lines"
+    id = Column(Integer, primary_key=True, index=True, unique=True)
+    invoice_id = Column(Integer, ForeignKey("invoices.id", ondelete="CASCADE"), index=True)
+    line_number = Column(Integer)
+    article_code = Column(String, index=True)
+    article_codes = Column(JSON)
+    description = Column(String)
+    quantity = Column(Numeric)
+    unit = Column(String)
+    unit_price = Column(Numeric)
+    discounts = Column(JSON)
+    vat_rate = Column(Numeric)
+    vat_nature = Column(String)
+    total = Column(Numeric)
+
+
+class InvoiceSummary(Base):
+    __tablename__ = "invoice_summaries"
+    id = Column(Integer, primary_key=True, index=True, unique=True)
+    invoice_id = Column(Integer, ForeignKey("invoices.id", ondelete="CASCADE"), index=True)
+    vat_rate = Column(Numeric)
+    vat_nature = Column(String)
+    taxable = Column(Numeric)
+    tax = Column(Numeric)
+    rounding = Column(Numeric)
+
+
 class Password(BaseModel):
     old_password: str
     new_password: str
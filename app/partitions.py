@@ -0,0 +1,135 @@
+import argparse
+import datetime
+import os
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+from app.database import engine
+
+load_dotenv()
+
+ARCHIVE_TABLESPACE = os.getenv("ARCHIVE_TABLESPACE")
+LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s")
+YEARS_AHEAD = int(os.getenv("REPORTS_PARTITION_YEARS_AHEAD", "1"))
+
+
+def name(year: int):
+    return 'reports_' + str(year)
+
+
+def bounds(year: int):
+    return "FOR VALUES FROM ('%d-01-01') TO ('%d-01-01')" % (year, year + 1)
+
+
+def exists(connection, relation: str):
+    return connection.execute(text('SELECT to_regclass(:relation) IS NOT NULL'), {'relation': relation}).scalar()
+
+
+def partitions(connection, parent: str):
+    return connection.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), COALESCE(t.spcname, 'pg_default'), "
+        "GREATEST(c.reltuples, 0)::bigint FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace WHERE i.inhparent = to_regclass(:parent) "
+        "ORDER BY c.relname"), {'parent': parent}).all()
+
+
+def years(connection, parent: str = 'reports'):
+    return [int(relname[len('reports_'):]) for relname, _, _, _ in partitions(connection, parent)
+            if relname[len('reports_'):].isdigit()]
+
+
+def _attach(connection, year: int):
+    connection.exec_driver_sql("SET LOCAL lock_timeout = '" + LOCK_TIMEOUT + "'")
+    connection.exec_driver_sql(
+        "WITH moved AS (DELETE FROM reports_default WHERE date >= '%d-01-01' AND date < '%d-01-01' RETURNING *) "
+        "INSERT INTO %s SELECT * FROM moved" % (year, year + 1, name(year)))
+    connection.exec_driver_sql('ALTER TABLE reports ATTACH PARTITION ' + name(year) + ' ' + bounds(year))
+
+
+def _set_tablespace(connection, year: int, tablespace: str):
+    connection.exec_driver_sql('ALTER TABLE ' + name(year) + ' SET TABLESPACE ' + tablespace)
+    for index, in connection.execute(text('SELECT indexname FROM pg_indexes WHERE tablename = :table'),
+                                     {'table': name(year)}):
+        connection.exec_driver_sql('ALTER INDEX ' + index + ' SET TABLESPACE ' + tablespace)
+
+
+def create(year: int):
+    with engine.begin() as connection:
+        if exists(connection, name(year)):
+            return False
+        connection.exec_driver_sql('CREATE TABLE ' + name(year) + ' (LIKE reports)')
+        _attach(connection, year)
+    print('created ' + name(year))
+    return True
+
+
+def ensure(first_year: int = None):
+    this_year = datetime.date.today().year
+    with engine.connect() as connection:
+        missing = {int(year) for year, in connection.execute(text(
+            'SELECT DISTINCT extract(year FROM date) FROM reports_default WHERE date IS NOT NULL'))}
+    missing.update(range(min(first_year or this_year, this_year), this_year + YEARS_AHEAD + 1))
+    for year in sorted(missing):
+        create(year)
+
+
+def archive(year: int, tablespace: str = None):
+    with engine.begin() as connection:
+        connection.exec_driver_sql("SET LOCAL lock_timeout = '" + LOCK_TIMEOUT + "'")
+        connection.exec_driver_sql('ALTER TABLE reports DETACH PARTITION ' + name(year))
+        connection.exec_driver_sql('ALTER TABLE reports_archive ATTACH PARTITION ' + name(year) + ' ' + bounds(year))
+    # moved once it is already archived, so the rewrite never holds a lock on reports
+    if tablespace:
+        with engine.begin() as connection:
+            _set_tablespace(connection, year, tablespace)
+    print('archived ' + name(year) + (' to ' + tablespace if tablespace else ''))
+
+
+def restore(year: int):
+    with engine.begin() as connection:
+        _set_tablespace(connection, year, 'pg_default')
+    with engine.begin() as connection:
+        connection.exec_driver_sql("SET LOCAL lock_timeout = '" + LOCK_TIMEOUT + "'")
+        connection.exec_driver_sql('ALTER TABLE reports_archive DETACH PARTITION ' + name(year))
+        _attach(connection, year)
+    print('restored ' + name(year))
+
+
+def status():
+    with engine.connect() as connection:
+        for parent in ('reports', 'reports_archive'):
+            print(parent)
+            for relname, bound, tablespace, rows in partitions(connection, parent):
+                print('  %-20s %-55s %-12s %10d rows' % (relname, bound, tablespace, rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the yearly partitions of the reports table.')
+    parser.add_argument('command', choices=['list', 'ensure', 'archive', 'restore'],
+                        help='ensure creates the partitions up to next year and moves matching rows out of the '
+                             'default partition; archive detaches years into reports_archive; restore brings '
+                             'them back')
+    parser.add_argument('years', type=int, nargs='*')
+    parser.add_argument('--before', type=int, help='archive every year before this one')
+    parser.add_argument('--tablespace', default=ARCHIVE_TABLESPACE, help='tablespace for archived partitions')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        status()
+    elif args.command == 'ensure':
+        ensure(min(args.years) if args.years else None)
+    elif args.command == 'archive':
+        archived = set(args.years)
+        if args.before:
+            with engine.connect() as connection:
+                archived.update(year for year in years(connection) if year < args.before)
+        for year in sorted(archived):
+            archive(year, args.tablespace)
+    else:
+        for year in args.years:
+            restore(year)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import functools
+import hashlib
+import os
+import re
+
+from dotenv import load_dotenv
+from sqlalchemy import event
+
+from app.database import engine, replica_engine
+
+load_dotenv()
+
+PREPARED_STATEMENTS = os.getenv("PREPARED_STATEMENTS", "true").lower() == "true"
+
+PLACEHOLDER = re.compile(r'%\(([^)]+)\)s|%%')
+
+
+@functools.lru_cache(maxsize=256)
+def positional(statement: str):
+    names = []
+
+    def replace(match):
+        if match.group(1) is None:
+            return '%'
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return '$' + str(names.index(match.group(1)) + 1)
+
+    sql = PLACEHOLDER.sub(replace, statement)
+    return 'prepared_' + hashlib.md5(statement.encode()).hexdigest()[:16], sql, tuple(names)
+
+
+def execute(cursor, info: dict, statement: str, parameters: dict):
+    name, sql, names = positional(statement)
+    prepared = info.setdefault('prepared', set())
+    if name not in prepared:
+        cursor.execute('PREPARE ' + name + ' AS ' + sql)
+        prepared.add(name)
+    cursor.execute('EXECUTE ' + name + (' (' + ', '.join(['%s'] * len(names)) + ')' if names else ''),
+                   [parameters[parameter] for parameter in names])
+
+
+def _do_execute(cursor, statement, parameters, context):
+    if PREPARED_STATEMENTS and context.execution_options.get('prepare'):
+        execute(cursor, context.root_connection.connection.info, statement, parameters)
+        return True
+
+
+def cached(query):
+    return query.execution_options(prepare=True)
+
+
+for _engine in {engine, replica_engine}:
+    event.listen(_engine, 'do_execute', _do_execute)
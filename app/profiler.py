@@ -0,0 +1,173 @@
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import anyio.to_thread
+from dotenv import load_dotenv
+
+import app.metrics as metrics
+
+load_dotenv()
+
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+
+IDLE_FILES = ('threading.py', 'selectors.py', 'queue.py')
+
+current = ContextVar('spans', default=None)
+current_threads = ContextVar('threads', default=None)
+profiles = OrderedDict()
+running = threading.Lock()
+
+
+def _frame_name(frame):
+    parts = frame.f_code.co_filename.replace('\\', '/').rsplit('/', 2)
+    return '/'.join(parts[-2:]) + ':' + frame.f_code.co_name
+
+
+def _tracked(func):
+    threads = current_threads.get()
+    if threads is None:
+        return func
+
+    def run(*args):
+        ident = threading.get_ident()
+        threads.add(ident)
+        try:
+            return func(*args)
+        finally:
+            threads.discard(ident)
+    return run
+
+
+_run_sync = anyio.to_thread.run_sync
+
+
+async def _run_sync_tracked(func, *args, **kwargs):
+    return await _run_sync(_tracked(func), *args, **kwargs)
+
+
+# starlette and fastapi send every sync endpoint and dependency through here
+anyio.to_thread.run_sync = _run_sync_tracked
+
+
+class Sampler:
+    def __init__(self, interval: float = PROFILE_INTERVAL, threads: set = None):
+        self.interval = interval
+        self.threads = threads
+        self.stacks = Counter()
+        self.samples = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def _run(self):
+        while not self.done.wait(self.interval):
+            self.samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == self.thread.ident or frame.f_code.co_filename.endswith(IDLE_FILES) or \
+                        (self.threads is not None and ident not in self.threads):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        return ''.join(stack + ' ' + str(count) + '\n' for stack, count in self.stacks.most_common())
+
+
+def profile(seconds: float):
+    if not running.acquire(blocking=False):
+        return None
+    try:
+        sampler = Sampler().start()
+        time.sleep(min(seconds, PROFILE_MAX_SECONDS))
+        return sampler.stop()
+    finally:
+        running.release()
+
+
+def _keep(collapsed: str):
+    profile_id = uuid.uuid4().hex
+    profiles[profile_id] = collapsed
+    while len(profiles) > PROFILE_KEEP:
+        profiles.popitem(last=False)
+    return profile_id
+
+
+def record(name: str, seconds: float):
+    metrics.stage_duration.observe(seconds, name)
+    spans = current.get()
+    if spans is not None:
+        spans[name] = spans.get(name, 0) + seconds
+
+
+@contextmanager
+def span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def server_timing(spans: dict):
+    return ', '.join(name + ';dur=' + '%.1f' % (seconds * 1000) for name, seconds in spans.items())
+
+
+class ProfileMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        tagged = PROFILE_TOKEN and (b"x-profile", PROFILE_TOKEN.encode()) in scope["headers"]
+        spans = {}
+        threads = set()
+        sampler = Sampler(threads=threads).start() if tagged and running.acquire(blocking=False) else None
+
+        def finish():
+            nonlocal sampler
+            if sampler is None:
+                return None
+            try:
+                return _keep(sampler.stop())
+            finally:
+                sampler = None
+                running.release()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                if spans:
+                    headers.append((b"server-timing", server_timing(spans).encode()))
+                profile_id = finish()
+                if profile_id:
+                    headers.append((b"x-profile-id", profile_id.encode()))
+                message["headers"] = headers
+            await send(message)
+
+        token = current.set(spans)
+        threads_token = current_threads.set(threads) if sampler is not None else None
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            if threads_token is not None:
+                current_threads.reset(threads_token)
+            current.reset(token)
+            finish()
@@ -0,0 +1,104 @@
+import logging
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from dotenv import load_dotenv
+from sqlalchemy import event
+
+import app.profiler as profiler
+from app.database import engine, replica_engine
+
+load_dotenv()
+
+QUERY_REPEAT_WARN = int(os.getenv("QUERY_REPEAT_WARN", "5"))
+QUERY_COUNT_WARN = int(os.getenv("QUERY_COUNT_WARN", "50"))
+
+logger = logging.getLogger(__name__)
+
+
+class Stats:
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.statements = Counter()
+
+    def repeated(self):
+        return [(statement, count) for statement, count in self.statements.most_common()
+                if count >= QUERY_REPEAT_WARN]
+
+
+current = ContextVar('queries', default=None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    profiler.record('sql', elapsed)
+    stats = current.get()
+    if stats is not None:
+        stats.count += 1
+        stats.time += elapsed
+        stats.statements[statement] += 1
+
+
+def handle_error(context):
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+
+for _engine in {engine, replica_engine}:
+    event.listen(_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(_engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(_engine, "handle_error", handle_error)
+
+
+@contextmanager
+def count_queries():
+    stats = Stats()
+    token = current.set(stats)
+    try:
+        yield stats
+    finally:
+        current.reset(token)
+
+
+def assert_query_budget(response, budget: int):
+    count = int(response.headers['X-DB-Queries'])
+    assert count <= budget, response.request.method + ' ' + response.request.url.path + ' issued ' + str(count) + \
+                            ' queries, budget is ' + str(budget)
+
+
+class QueryCountMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (b"x-db-queries", str(stats.count).encode()),
+                    (b"x-db-time", ('%.1f' % (stats.time * 1000)).encode()),
+                ]
+            await send(message)
+
+        with count_queries() as stats:
+            try:
+                await self.app(scope, receive, send_with_headers)
+            finally:
+                route = scope["method"] + " " + scope["path"]
+                logger.info("%s: %d queries, %.1f ms", route, stats.count, stats.time * 1000)
+                if stats.count >= QUERY_COUNT_WARN:
+                    logger.warning("%s issued %d queries", route, stats.count)
+                for statement, count in stats.repeated():
+                    logger.warning("%s repeated a query %d times, possible N+1: %s", route, count,
+                                   ' '.join(statement.split())[:200])
@@ -0,0 +1,89 @@
+import csv
+import time
+from io import BytesIO
+
+import app.metrics as metrics
+import app.profiler as profiler
+
+REPORT_HEADER = ['Operatore', 'Data', 'Cliente', 'Stabilimento', 'Durata', 'Tipo', 'Macchina', 'Centro di costo',
+                 'Location', 'Descrizione']
+COMMISSION_REPORT_HEADER = ['Operatore', 'Data', 'Cliente', 'Commessa', 'Durata', 'Tipo', 'Location', 'Descrizione']
+
+_template = None
+
+
+def template():
+    global _template
+    if _template is None:
+        from jinja2 import Template
+        with open('app/result.html') as file:
+            _template = Template(file.read())
+    return _template
+
+
+def render_report_pdf(report):
+    from weasyprint import HTML
+    start = time.perf_counter()
+    with profiler.span('template'):
+        html = template().render(report=report)
+    with profiler.span('layout'):
+        document = HTML(string=html).render(presentational_hints=True)
+    with profiler.span('pdf'):
+        pdf = document.write_pdf()
+    metrics.pdf_render_duration.observe(time.perf_counter() - start)
+    metrics.pdf_pages.observe(len(document.pages))
+    return pdf
+
+
+def render_reports_pdf(reports, progress=None):
+    from pypdf import PdfWriter
+    merger = PdfWriter()
+    for i, report in enumerate(reports):
+        pdf = render_report_pdf(report)
+        with profiler.span('merge'):
+            merger.append(BytesIO(pdf))
+        if progress:
+            progress(i + 1, len(reports))
+    output = BytesIO()
+    with profiler.span('merge'):
+        merger.write(output)
+    return output.getvalue()
+
+
+def total_hours(reports):
+    return sum([float(report.Report.intervention_duration.replace(',', '.')) for report in reports])
+
+
+@profiler.span('csv')
+def write_reports_csv(reports, csvfile, progress=None):
+    csvwriter = csv.writer(csvfile, delimiter=';')
+    csvwriter.writerow(REPORT_HEADER)
+    for i, report in enumerate(reports):
+        csvwriter.writerow([report.first_name + ' ' + report.last_name, report.Report.date.strftime("%d/%m/%Y"),
+                            report.client_name,
+                            report.plant_city + ' ' + report.plant_address,
+                            report.Report.intervention_duration.replace('.', ','),
+                            report.Report.intervention_type, report.machine_name,
+                            report.cost_center, report.Report.intervention_location,
+                            report.Report.description])
+        if progress:
+            progress(i + 1, len(reports))
+    csvwriter.writerow('')
+    csvwriter.writerow(['Totale ore', '', '', '', str(total_hours(reports)).replace('.', ','), '', '', '', '', ''])
+
+
+@profiler.span('csv')
+def write_commission_reports_csv(reports, csvfile, progress=None):
+    csvwriter = csv.writer(csvfile, delimiter=';')
+    csvwriter.writerow(COMMISSION_REPORT_HEADER)
+    for i, report in enumerate(reports):
+        csvwriter.writerow([report.first_name + ' ' + report.last_name, report.Report.date.strftime("%d/%m/%Y"),
+                            report.client_name,
+                            report.commission_code + ' - ' + report.commission_description,
+                            report.Report.intervention_duration.replace('.', ','),
+                            report.Report.intervention_type, report.Report.intervention_location,
+                            report.Report.description])
+        if progress:
+            progress(i + 1, len(reports))
+    csvwriter.writerow('')
+    csvwriter.writerow(['Totale ore', '', '', '', str(total_hours(reports)).replace('.', ','), '', '', ''])
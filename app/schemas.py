@@ -1,5 +1,5 @@
 import datetime
-from typing import Optional, List
+from typing import Optional, List, Literal
 
 from pydantic import BaseModel, EmailStr
 
@@ -271,3 +271,47 @@ class TicketCreate(BaseModel):
 
     class Config:
         orm_mode = True
+
+
+class ExportCreate(BaseModel):
+    format: Literal['pdf', 'csv']
+    period: Literal['monthly', 'interval']
+    type: Literal['machine', 'commission'] = 'machine'
+    month: Optional[str] = None
+    start_date: str = ''
+    end_date: str = ''
+    user_id: Optional[int] = None
+    client_id: Optional[int] = None
+    plant_id: Optional[int] = None
+    work_id: Optional[int] = None
+    archive: bool = False
+
+
+class ReportEmailCreate(BaseModel):
+    month: str
+    type: Literal['machine', 'commission'] = 'machine'
+    user_id: Optional[int] = None
+    client_id: Optional[int] = None
+    plant_id: Optional[int] = None
+    work_id: Optional[int] = None
+    email: Optional[EmailStr] = None
+    skip_sent: bool = False
+
+
+class ExportJob(BaseModel):
+    id: int
+    format: str
+    period: str
+    type: str
+    params: dict
+    status: str
+    progress: int
+    total: Optional[int] = None
+    filename: Optional[str] = None
+    error: Optional[str] = None
+    date_created: datetime.datetime
+    date_finished: Optional[datetime.datetime] = None
+    expires_at: Optional[datetime.datetime] = None
+
+    class Config:
+        orm_mode = True
@@ -0,0 +1,182 @@
+import argparse
+import datetime
+import io
+import json
+import math
+import platform
+import statistics
+import sys
+import time
+
+from sqlalchemy import func
+
+import app.crud as crud
+import app.fatturapa as fatturapa
+import app.models as models
+import app.render as render
+from app.database import SessionLocal
+from scripts import seed
+
+INVOICE_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<p:FatturaElettronica versione="FPR12" xmlns:p="http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2">
+<FatturaElettronicaHeader><CedentePrestatore><DatiAnagrafici><IdFiscaleIVA><IdPaese>IT</IdPaese>
+<IdCodice>01234567890</IdCodice></IdFiscaleIVA><Anagrafica><Denominazione>Fornitore S.p.A.</Denominazione>
+</Anagrafica><RegimeFiscale>RF01</RegimeFiscale></DatiAnagrafici><Sede><Indirizzo>Via Roma 1</Indirizzo>
+<CAP>38068</CAP><Comune>Rovereto</Comune><Provincia>TN</Provincia><Nazione>IT</Nazione></Sede></CedentePrestatore>
+</FatturaElettronicaHeader><FatturaElettronicaBody><DatiGenerali><DatiGeneraliDocumento>
+<TipoDocumento>TD01</TipoDocumento><Data>2023-05-31</Data><Numero>1</Numero>
+<ImportoTotaleDocumento>{total}</ImportoTotaleDocumento></DatiGeneraliDocumento></DatiGenerali><DatiBeniServizi>
+'''
+INVOICE_LINE = '''<DettaglioLinee><NumeroLinea>{number}</NumeroLinea><CodiceArticolo><CodiceTipo>INT</CodiceTipo>
+<CodiceValore>A-{code}</CodiceValore></CodiceArticolo><Descrizione>Articolo {code}</Descrizione>
+<Quantita>2.00</Quantita><UnitaMisura>PZ</UnitaMisura><PrezzoUnitario>5.00</PrezzoUnitario>
+<PrezzoTotale>10.00</PrezzoTotale><AliquotaIVA>22.00</AliquotaIVA></DettaglioLinee>
+'''
+INVOICE_FOOTER = '''<DatiRiepilogo><AliquotaIVA>22.00</AliquotaIVA><ImponibileImporto>{taxable}</ImponibileImporto>
+<Imposta>{tax}</Imposta></DatiRiepilogo></DatiBeniServizi><DatiPagamento><DettaglioPagamento>
+<ModalitaPagamento>MP05</ModalitaPagamento><DataScadenzaPagamento>2023-06-30</DataScadenzaPagamento>
+<ImportoPagamento>{total}</ImportoPagamento></DettaglioPagamento></DatiPagamento></FatturaElettronicaBody>
+</p:FatturaElettronica>
+'''
+
+
+def invoice_xml(lines: int):
+    taxable = lines * 10
+    tax = round(taxable * 0.22, 2)
+    return (INVOICE_HEADER.format(total='%.2f' % (taxable + tax)) +
+            ''.join(INVOICE_LINE.format(number=i, code=i % 500) for i in range(1, lines + 1)) +
+            INVOICE_FOOTER.format(taxable='%.2f' % taxable, tax='%.2f' % tax, total='%.2f' % (taxable + tax))).encode()
+
+
+def parameters(db: SessionLocal):
+    today = datetime.date.today()
+    last = db.query(func.max(models.Report.date)).filter(models.Report.date < today.replace(day=1)).scalar()
+    if last is None:
+        sys.exit('Nessun intervento nel database: eseguire prima python -m scripts.seed')
+    month = last.replace(day=1)
+    next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+    operator_id = db.query(models.Report.operator_id).filter(
+        models.Report.date >= month, models.Report.date < next_month).group_by(models.Report.operator_id).order_by(
+        func.count().desc()).limit(1).scalar()
+    client_id = db.query(models.Plant.client_id).join(models.Machine, models.Machine.plant_id == models.Plant.id).join(
+        models.Report, (models.Report.work_id == models.Machine.id) & (models.Report.type == 'machine')).filter(
+        models.Report.date >= month, models.Report.date < next_month).group_by(models.Plant.client_id).order_by(
+        func.count().desc()).limit(1).scalar()
+    return {'month': month.strftime('%m/%Y'), 'start_date': (month - datetime.timedelta(days=90)).isoformat(),
+            'end_date': (next_month - datetime.timedelta(days=1)).isoformat(), 'operator_id': operator_id,
+            'client_id': client_id, 'reports': db.query(func.count(models.Report.id)).scalar()}
+
+
+def cases(db: SessionLocal, params: dict):
+    month, client_id, operator_id = params['month'], params['client_id'], params['operator_id']
+    monthly = crud.get_monthly_reports(db, month=month, client_id=client_id)
+    small_xml, large_xml = invoice_xml(100), invoice_xml(20000)
+
+    def write_csv(reports):
+        output = io.StringIO()
+        render.write_reports_csv(reports, output)
+        return reports
+
+    def parse_xml(data: bytes):
+        output = io.StringIO()
+        fatturapa.write_csv(fatturapa.reconcile(fatturapa.parse(io.BytesIO(data))), output)
+        return output.getvalue()
+
+    return [
+        ('crud.get_reports', lambda: crud.get_reports(db, limit=100)),
+        ('crud.get_reports_operator', lambda: crud.get_reports(db, user_id=operator_id, limit=100)),
+        ('crud.get_monthly_reports', lambda: crud.get_monthly_reports(db, month=month)),
+        ('crud.get_monthly_reports_client', lambda: crud.get_monthly_reports(db, month=month, client_id=client_id)),
+        ('crud.get_monthly_commission_reports', lambda: crud.get_monthly_commission_reports(db, month=month)),
+        ('crud.get_interval_reports', lambda: crud.get_interval_reports(
+            db, start_date=params['start_date'], end_date=params['end_date'], client_id=client_id)),
+        ('crud.search_reports', lambda: crud.search_reports(db, search='encoder')),
+        ('crud.get_machines', lambda: crud.get_machines(db)),
+        ('crud.get_machines_search', lambda: crud.get_machines(db, q='Robot', limit=50)),
+        ('crud.get_daily_hours_in_month', lambda: crud.get_daily_hours_in_month(db, month=month,
+                                                                                 user_id=operator_id)),
+        ('render.report_pdf', lambda: render.render_report_pdf(monthly[0])),
+        ('render.reports_pdf_20', lambda: render.render_reports_pdf(monthly[:20])),
+        ('render.reports_csv', lambda: write_csv(monthly)),
+        ('fatturapa.parse_100_lines', lambda: parse_xml(small_xml)),
+        ('fatturapa.parse_20000_lines', lambda: parse_xml(large_xml)),
+    ]
+
+
+def measure(fn, repeat: int, warmup: int = 1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {'runs': repeat, 'min': times[0], 'median': statistics.median(times), 'mean': statistics.fmean(times),
+            'p95': times[min(len(times) - 1, math.ceil(len(times) * 0.95) - 1)],
+            'rows': len(result) if isinstance(result, list) else None}
+
+
+def run(repeat: int, only=None):
+    db = SessionLocal()
+    try:
+        params = parameters(db)
+        results = {}
+        for name, fn in cases(db, params):
+            if only and not any(pattern in name for pattern in only):
+                continue
+            results[name] = measure(fn, repeat)
+            print('%-40s %10.2f ms  (%s rows)' % (name, results[name]['median'] * 1000, results[name]['rows']))
+        return {'params': params, 'cases': results}
+    finally:
+        db.close()
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    regressions = []
+    for scale, scale_results in results['scales'].items():
+        base_cases = baseline.get('scales', {}).get(scale, {}).get('cases', {})
+        for name, result in scale_results['cases'].items():
+            if name not in base_cases:
+                continue
+            ratio = result['median'] / base_cases[name]['median'] if base_cases[name]['median'] else 1
+            flag = 'REGRESSION' if ratio > 1 + threshold else 'faster' if ratio < 1 - threshold else ''
+            print('%-10s %-40s %10.2f ms %10.2f ms %7.2fx %s' % (
+                scale, name, base_cases[name]['median'] * 1000, result['median'] * 1000, ratio, flag))
+            if flag == 'REGRESSION':
+                regressions.append((scale, name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time crud queries, exports and rendering against the database.')
+    parser.add_argument('--scales', help='comma separated seed scales to load (truncating) and benchmark in turn, '
+                                         'e.g. small,medium; by default the current data is used')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', action='append', help='run only the cases containing this text')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='a previous output to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    results = {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+               'repeat': args.repeat, 'scales': {}}
+    for scale in (args.scales.split(',') if args.scales else ['current']):
+        if scale != 'current':
+            print('seeding ' + scale + '...')
+            seed.load(seed.SCALES[scale], truncate=True)
+        print('== ' + scale)
+        results['scales'][scale] = run(args.repeat, args.only)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print('results written to ' + args.output)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions:
+            sys.exit(str(len(regressions)) + ' regressions over ' + str(int(args.threshold * 100)) + '%')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import argparse
+import json
+import sys
+
+from sqlalchemy import event, text
+
+import app.crud as crud
+import app.models as models
+from app.database import SessionLocal, engine
+from scripts.benchmark import parameters
+
+
+def large_tables(db: SessionLocal, min_rows: int):
+    return {name for name, in db.execute(text(
+        "SELECT relname FROM pg_class WHERE relkind IN ('r', 'p') AND reltuples >= :min_rows "
+        "AND relnamespace = 'public'::regnamespace"), {'min_rows': min_rows})}
+
+
+def parents(db: SessionLocal):
+    return dict(db.execute(text(
+        "SELECT c.relname, pg_partition_root(c.oid)::regclass::text FROM pg_class c WHERE c.relispartition "
+        "AND c.relnamespace = 'public'::regnamespace")).all())
+
+
+def cases(db: SessionLocal, params: dict):
+    month, client_id, operator_id = params['month'], params['client_id'], params['operator_id']
+    start_date, end_date = params['start_date'], params['end_date']
+    plant_id = db.query(models.Plant.id).filter(models.Plant.client_id == client_id).limit(1).scalar()
+    machine_id = db.query(models.Machine.id).filter(models.Machine.plant_id == plant_id).limit(1).scalar()
+    commission = db.query(models.Commission).order_by(models.Commission.id.desc()).first()
+    report_id = db.query(models.Report.id).order_by(models.Report.id.desc()).limit(1).scalar()
+    return [
+        ('get_plant_by_client', lambda: crud.get_plant_by_client(db, client_id=client_id), ()),
+        ('get_machine_by_plant', lambda: crud.get_machine_by_plant(db, plant_id=plant_id), ()),
+        ('get_plants', lambda: crud.get_plants(db), ()),
+        ('get_machines', lambda: crud.get_machines(db, limit=50), ()),
+        ('get_machines_search', lambda: crud.get_machines(db, q='Robot', limit=50), ()),
+        ('get_reports', lambda: crud.get_reports(db, limit=100), ()),
+        ('get_reports_operator', lambda: crud.get_reports(db, user_id=operator_id, limit=100), ()),
+        ('get_report_by_id', lambda: crud.get_report_by_id(db, report_id=report_id), ()),
+        ('get_months_operator', lambda: crud.get_months(db, user_id=operator_id), ()),
+        ('get_monthly_reports', lambda: crud.get_monthly_reports(db, month=month), ()),
+        ('get_monthly_reports_client', lambda: crud.get_monthly_reports(db, month=month, client_id=client_id), ()),
+        ('get_monthly_reports_operator', lambda: crud.get_monthly_reports(db, month=month, user_id=operator_id), ()),
+        ('get_monthly_reports_plant', lambda: crud.get_monthly_reports(db, month=month, plant_id=plant_id), ()),
+        ('get_monthly_reports_machine', lambda: crud.get_monthly_reports(db, month=month, work_id=machine_id), ()),
+        ('get_interval_reports', lambda: crud.get_interval_reports(db, start_date=start_date, end_date=end_date),
+         ('reports',)),
+        ('get_interval_reports_client', lambda: crud.get_interval_reports(
+            db, start_date=start_date, end_date=end_date, client_id=client_id), ()),
+        ('get_monthly_commission_reports', lambda: crud.get_monthly_commission_reports(db, month=month), ()),
+        ('get_monthly_commission_reports_client', lambda: crud.get_monthly_commission_reports(
+            db, month=month, client_id=commission.client_id), ()),
+        ('get_interval_commission_reports', lambda: crud.get_interval_commission_reports(
+            db, start_date=start_date, end_date=end_date, work_id=commission.id), ()),
+        ('get_daily_hours_in_month', lambda: crud.get_daily_hours_in_month(db, month=month, user_id=operator_id),
+         ()),
+        ('get_user_by_id', lambda: crud.get_user_by_id(db, user_id=operator_id), ()),
+        ('get_supervisors_by_client', lambda: crud.get_supervisors_by_client(db, client_id=client_id), ()),
+        ('get_commissions_client', lambda: crud.get_commissions(db, client_id=client_id), ()),
+        ('get_open_commissions', lambda: crud.get_open_commissions(db), ()),
+        ('get_tickets', lambda: crud.get_tickets(db), ('tickets',)),
+        ('search_reports', lambda: crud.search_reports(db, search='encoder'), ('reports',)),
+        ('get_outbox_messages', lambda: crud.get_outbox_messages(db, status='queued'), ()),
+        ('get_invoices', lambda: crud.get_invoices(db, start_date='2023-01-01', end_date='2023-12-31'), ()),
+        ('get_invoice_lines', lambda: crud.get_invoice_lines(db, article_code='A-1'), ()),
+    ]
+
+
+def capture(fn):
+    statements = []
+
+    def listener(conn, cursor, statement, values, context, executemany):
+        statements.append((statement, values))
+
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        fn()
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+    return statements
+
+
+def nodes(plan: dict):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from nodes(child)
+
+
+def explain(db: SessionLocal, statement: str, values):
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, values)
+        return cursor.fetchone()[0][0]['Plan']
+    finally:
+        cursor.close()
+
+
+def check(db: SessionLocal, name: str, fn, allowed, large: set, partitions: dict, baseline: dict, threshold: float):
+    cost, scans, failures = 0.0, [], []
+    for statement, values in capture(fn):
+        plan = explain(db, statement, values)
+        cost += plan['Total Cost']
+        for node in nodes(plan):
+            if 'Relation Name' not in node:
+                if 'Index Name' in node:
+                    scans.append(node['Index Name'])
+                continue
+            scans.append(node['Relation Name'] + ':' + node.get('Index Name', node['Node Type']))
+            if node['Node Type'] == 'Seq Scan' and node['Relation Name'] in large and \
+                    partitions.get(node['Relation Name'], node['Relation Name']) not in allowed:
+                failures.append('sequential scan on ' + node['Relation Name'])
+    ceiling = baseline.get(name)
+    if ceiling is not None and cost > ceiling * (1 + threshold):
+        failures.append('estimated cost %.0f over the ceiling %.0f' % (cost, ceiling * (1 + threshold)))
+    return {'cost': cost, 'scans': sorted(set(scans)), 'failures': failures}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the query plans of the crud functions against the database: '
+                                                 'large tables must be read through an index and the estimated cost '
+                                                 'must stay under the ceiling stored in the baseline.')
+    parser.add_argument('--baseline', default='explain.json', help='estimated costs to compare against')
+    parser.add_argument('--save', action='store_true', help='store the current costs as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.5, help='allowed growth over the baseline cost')
+    parser.add_argument('--min-rows', type=int, default=10000,
+                        help='tables with at least this many rows must not be read sequentially')
+    parser.add_argument('--only', action='append', help='check only the cases containing this text')
+    parser.add_argument('--verbose', action='store_true', help='print the tables and indexes each plan reads')
+    args = parser.parse_args()
+
+    baseline = {}
+    if not args.save:
+        try:
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        except FileNotFoundError:
+            print('no baseline at ' + args.baseline + ', checking index usage only')
+
+    db = SessionLocal()
+    try:
+        large = large_tables(db, args.min_rows)
+        partitions = parents(db)
+        results = {}
+        for name, fn, allowed in cases(db, parameters(db)):
+            if args.only and not any(pattern in name for pattern in args.only):
+                continue
+            result = results[name] = check(db, name, fn, allowed, large, partitions, baseline,
+                                          args.threshold)
+            print('%-40s %12.0f  %s' % (name, result['cost'], '; '.join(result['failures']) or 'ok'))
+            if args.verbose:
+                print('    ' + ', '.join(result['scans']))
+        db.rollback()
+    finally:
+        db.close()
+
+    if args.save:
+        with open(args.baseline, 'w') as file:
+            json.dump({name: round(result['cost'], 2) for name, result in results.items()}, file, indent=2)
+        print('baseline written to ' + args.baseline)
+    failed = [name for name, result in results.items() if result['failures']]
+    if failed:
+        sys.exit(str(len(failed)) + ' plan regressions: ' + ', '.join(failed))
+
+
+if __name__ == '__main__':
+    main()
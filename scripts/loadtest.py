@@ -0,0 +1,211 @@
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import random
+import time
+
+import httpx
+from sqlalchemy import func
+
+import app.models as models
+from app.database import SessionLocal
+
+PASSWORD = 'password'
+DESCRIPTION = 'Prova di carico'
+
+
+def percentile(values, q: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(math.ceil(len(values) * q) - 1, 0))]
+
+
+class Recorder:
+    def __init__(self):
+        self.timings = {}
+        self.errors = {}
+
+    def add(self, name: str, seconds: float, status):
+        self.timings.setdefault(name, []).append(seconds)
+        if status is None or status >= 400:
+            errors = self.errors.setdefault(name, {})
+            errors[str(status)] = errors.get(str(status), 0) + 1
+
+    def summary(self, elapsed: float):
+        endpoints = {}
+        for name, timings in sorted(self.timings.items()):
+            errors = sum(self.errors.get(name, {}).values())
+            endpoints[name] = {'requests': len(timings), 'errors': errors, 'error_rate': errors / len(timings),
+                               'statuses': self.errors.get(name, {}), 'p50': percentile(timings, 0.5),
+                               'p95': percentile(timings, 0.95), 'p99': percentile(timings, 0.99),
+                               'max': max(timings)}
+        requests = sum(len(timings) for timings in self.timings.values())
+        errors = sum(sum(statuses.values()) for statuses in self.errors.values())
+        return {'seconds': elapsed, 'requests': requests, 'throughput': requests / elapsed,
+                'error_rate': errors / requests if requests else 0, 'endpoints': endpoints}
+
+
+class Session:
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder):
+        self.client = client
+        self.recorder = recorder
+        self.headers = {}
+
+    async def request(self, method: str, name: str, url: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, headers=self.headers, **kwargs)
+        except httpx.HTTPError:
+            response = None
+        self.recorder.add(method + ' ' + name, time.perf_counter() - start,
+                          response.status_code if response is not None else None)
+        return response
+
+    async def get(self, name: str, **params):
+        return await self.request('GET', name, name, params=params)
+
+    async def login(self, username: str):
+        response = await self.request('POST', '/token', '/token', data={'username': username, 'password': PASSWORD})
+        if response is None or response.status_code != 200:
+            return False
+        self.headers = {'Authorization': 'Bearer ' + response.json()['access_token']}
+        return True
+
+
+def fixtures(db: SessionLocal):
+    admin = db.query(models.User.username).filter(models.User.role_id == 1).order_by(models.User.id).first()
+    operators = [username for username, in db.query(models.User.username).filter(models.User.role_id == 2)]
+    supervisors = {}
+    for user_id, client_id in db.query(models.User.id, models.User.client_id).filter(models.User.role_id == 3):
+        supervisors.setdefault(client_id, []).append(user_id)
+    machines = [row for row in db.query(models.Machine.id, models.Plant.id, models.Plant.client_id).join(
+        models.Plant, models.Machine.plant_id == models.Plant.id).order_by(func.random()).limit(500)
+                if row[2] in supervisors]
+    last = db.query(func.max(models.Report.date)).filter(
+        models.Report.date < datetime.date.today().replace(day=1)).scalar() or datetime.date.today()
+    month = last.replace(day=1)
+    if admin is None or not operators or not machines:
+        raise SystemExit('Dati insufficienti: eseguire prima python -m scripts.seed')
+    return {'admin': admin[0], 'operators': operators, 'supervisors': supervisors, 'machines': machines,
+            'intervention_types': [name for name, in db.query(models.InterventionType.name)] or ['Guasto'],
+            'locations': [name for name, in db.query(models.Location.name)] or ['Presso cliente'],
+            'month': month.strftime('%m/%Y'), 'start_date': (month - datetime.timedelta(days=60)).isoformat(),
+            'end_date': last.isoformat(), 'clients': sorted({client_id for _, _, client_id in machines})}
+
+
+async def operator(session: Session, data: dict, rng: random.Random, writes: bool):
+    if not await session.login(rng.choice(data['operators'])):
+        return
+    for name in ('/me', '/clients', '/intervention_types', '/locations', '/commissions/open'):
+        await session.get(name)
+    machine_id, plant_id, client_id = rng.choice(data['machines'])
+    await session.get('/plant', client_id=client_id)
+    await session.get('/machine', plant_id=plant_id)
+    await session.get('/supervisors', client_id=client_id)
+    if writes:
+        await session.request('POST', '/report/create', '/report/create', json={
+            'type': 'machine', 'work_id': machine_id, 'date': datetime.date.today().isoformat(),
+            'intervention_duration': rng.choice(['1', '2', '4']),
+            'intervention_type': rng.choice(data['intervention_types']),
+            'intervention_location': rng.choice(data['locations']),
+            'supervisor_id': rng.choice(data['supervisors'][client_id]), 'description': DESCRIPTION})
+    await session.get('/me/reports', limit=20)
+    await session.get('/me/months')
+
+
+async def admin(session: Session, data: dict, rng: random.Random, writes: bool):
+    if not await session.login(data['admin']):
+        return
+    client_id = rng.choice(data['clients'])
+    await session.get('/reports', limit=100)
+    await session.get('/months')
+    await session.get('/reports/monthly', month=data['month'], plant_id=0)
+    await session.get('/reports/monthly', month=data['month'], client_id=client_id, plant_id=0)
+    await session.get('/reports/interval', start_date=data['start_date'], end_date=data['end_date'],
+                      client_id=client_id, plant_id=0)
+    await session.get('/reports/monthly/csv', month=data['month'], client_id=client_id, plant_id=0)
+    await session.get('/machines', q=rng.choice(['Robot', 'Pressa', 'Tornio']), limit=50)
+    if rng.random() < 0.2:
+        await session.get('/reports/search', q=rng.choice(['encoder', 'cinghia', 'software']))
+
+
+async def user(client, recorder: Recorder, data: dict, rng: random.Random, scenario, deadline: float, think: float,
+               writes: bool):
+    while time.perf_counter() < deadline:
+        await scenario(Session(client, recorder), data, rng, writes)
+        if think:
+            await asyncio.sleep(rng.expovariate(1 / think))
+
+
+async def stage(client, data: dict, concurrency: int, duration: float, admin_ratio: float, think: float,
+                writes: bool, rng_seed: int):
+    recorder = Recorder()
+    admins = round(concurrency * admin_ratio)
+    start = time.perf_counter()
+    await asyncio.gather(*(user(client, recorder, data, random.Random(rng_seed + i), admin if i < admins else operator,
+                                start + duration, think, writes) for i in range(concurrency)))
+    return dict(recorder.summary(time.perf_counter() - start), concurrency=concurrency, admins=admins)
+
+
+def report(result: dict):
+    print('== concurrency %d (%d admin): %.1f req/s, errors %.2f%%' % (
+        result['concurrency'], result['admins'], result['throughput'], result['error_rate'] * 100))
+    print('%-45s %8s %7s %10s %10s %10s' % ('endpoint', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, endpoint in result['endpoints'].items():
+        print('%-45s %8d %7d %10.1f %10.1f %10.1f' % (name, endpoint['requests'], endpoint['errors'],
+                                                        endpoint['p50'] * 1000, endpoint['p95'] * 1000,
+                                                        endpoint['p99'] * 1000))
+
+
+async def run(args, data: dict):
+    if args.url:
+        transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=None))
+        base_url = args.url
+    else:
+        from app.main import app
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        base_url = 'http://loadtest'
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout) as client:
+        for concurrency in args.concurrency:
+            results.append(await stage(client, data, concurrency, args.duration, args.admin_ratio, args.think,
+                                       not args.read_only, args.seed))
+            report(results[-1])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive the API with simulated operators and admins at increasing '
+                                                 'concurrency and report latency percentiles per endpoint.')
+    parser.add_argument('--url', help='base URL of a running server; by default the app is called in process')
+    parser.add_argument('--concurrency', default='1,5,10,25',
+                        type=lambda value: [int(level) for level in value.split(',')])
+    parser.add_argument('--duration', type=float, default=30, help='seconds per concurrency level')
+    parser.add_argument('--admin-ratio', type=float, default=0.1, help='share of the users running admin exports')
+    parser.add_argument('--think', type=float, default=0, help='mean pause between sessions, in seconds')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--read-only', action='store_true', help='do not create reports')
+    parser.add_argument('--keep', action='store_true', help='keep the reports created during the test')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        data = fixtures(db)
+        results = asyncio.run(run(args, data))
+        if not args.read_only and not args.keep:
+            deleted = db.query(models.Report).filter(models.Report.description == DESCRIPTION).delete()
+            db.commit()
+            print('removed ' + str(deleted) + ' reports created by the test')
+    finally:
+        db.close()
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'date': datetime.datetime.now().isoformat(timespec='seconds'), 'url': args.url or 'asgi',
+                       'admin_ratio': args.admin_ratio, 'stages': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
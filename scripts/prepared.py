@@ -0,0 +1,119 @@
+import argparse
+import datetime
+import json
+import statistics
+import sys
+import time
+
+from sqlalchemy import event, func
+
+import app.auth as auth
+import app.crud as crud
+import app.models as models
+import app.prepared as prepared
+from app.database import SessionLocal, engine
+
+
+def parameters(db: SessionLocal):
+    report_id = db.query(func.max(models.Report.id)).scalar()
+    if report_id is None:
+        sys.exit('Nessun intervento nel database: eseguire prima python -m scripts.seed')
+    user = db.query(models.User).order_by(models.User.id).first()
+    return {'report_id': report_id, 'user_id': user.id, 'username': user.username,
+            'plant_id': db.query(func.min(models.Plant.id)).scalar(),
+            'machine_id': db.query(func.min(models.Machine.id)).scalar()}
+
+
+def cases(db: SessionLocal, params: dict):
+    token = auth.create_access_token({'sub': params['username']}, datetime.timedelta(minutes=10))
+    return [
+        ('auth.get_current_user', lambda: auth.get_current_user(token=token, db=db)),
+        ('crud.get_report_by_id', lambda: crud.get_report_by_id(db, report_id=params['report_id'])),
+        ('crud.get_user_by_id', lambda: crud.get_user_by_id(db, user_id=params['user_id'])),
+        ('crud.get_plant_by_id', lambda: crud.get_plant_by_id(db, plant_id=params['plant_id'])),
+        ('crud.get_machine_by_id', lambda: crud.get_machine_by_id(db, machine_id=params['machine_id'])),
+    ]
+
+
+def timed(db: SessionLocal, fn, repeat: int, warmup: int):
+    times = []
+    for i in range(warmup + repeat):
+        db.expunge_all()
+        start = time.perf_counter()
+        fn()
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def captured(fn):
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        fn()
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+    return statements[-1]
+
+
+def planning(cursor, statement: str, values):
+    cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + statement, values)
+    return cursor.fetchone()[0][0]['Planning Time'] / 1000
+
+
+def plan_times(db: SessionLocal, statement: str, parameters: dict, repeat: int, warmup: int):
+    connection = db.connection().connection
+    cursor = connection.cursor()
+    name, _, names = prepared.positional(statement)
+    for _ in range(warmup):
+        prepared.execute(cursor, connection.info, statement, parameters)
+    execute = 'EXECUTE ' + name + (' (' + ', '.join(['%s'] * len(names)) + ')' if names else '')
+    values = [parameters[parameter] for parameter in names]
+    plain = statistics.median(planning(cursor, statement, parameters) for _ in range(repeat))
+    cached = statistics.median(planning(cursor, execute, values) for _ in range(repeat))
+    db.rollback()
+    return plain, cached
+
+
+def run(repeat: int, warmup: int):
+    db = SessionLocal()
+    try:
+        params = parameters(db)
+        results = {}
+        print('%-25s %10s %10s %10s %12s %12s' % ('', 'plain', 'prepared', 'saved', 'plan plain', 'plan cached'))
+        for name, fn in cases(db, params):
+            prepared.PREPARED_STATEMENTS = False
+            statement, bound = captured(fn)
+            plain = timed(db, fn, repeat, warmup)
+            prepared.PREPARED_STATEMENTS = True
+            cached = timed(db, fn, repeat, warmup)
+            plan_plain, plan_cached = plan_times(db, statement, bound, repeat, warmup)
+            results[name] = {'plain': plain, 'prepared': cached, 'plan_plain': plan_plain, 'plan_cached': plan_cached}
+            print('%-25s %8.3f ms %8.3f ms %8.3f ms %9.3f ms %9.3f ms' % (
+                name, plain * 1000, cached * 1000, (plain - cached) * 1000, plan_plain * 1000, plan_cached * 1000))
+        return {'params': params, 'cases': results}
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the hot point lookups with and without server-side prepared '
+                                                 'statements, end to end and in Postgres planning time alone.')
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='calls before timing; Postgres switches to a cached generic plan after five')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.warmup)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
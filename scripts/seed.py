@@ -0,0 +1,280 @@
+import argparse
+import csv
+import datetime
+import io
+import itertools
+import math
+import random
+import time
+
+import app.partitions as partitions
+from app.migrate import migrate
+from app.auth import get_password_hash
+from app.database import engine
+
+SCALES = {
+    'small': dict(clients=20, plants=2, machines=5, commissions=3, operators=10, supervisors=2, reports=20000,
+                  tickets=1000, years=2),
+    'medium': dict(clients=150, plants=3, machines=8, commissions=6, operators=40, supervisors=2, reports=500000,
+                   tickets=20000, years=4),
+    'large': dict(clients=600, plants=4, machines=10, commissions=10, operators=120, supervisors=3, reports=5000000,
+                  tickets=200000, years=8),
+}
+
+CITIES = [('Rovereto', 'TN', '38068'), ('Trento', 'TN', '38121'), ('Verona', 'VR', '37121'),
+          ('Brescia', 'BS', '25121'), ('Bergamo', 'BG', '24121'), ('Vicenza', 'VI', '36100'),
+          ('Bolzano', 'BZ', '39100'), ('Milano', 'MI', '20121'), ('Padova', 'PD', '35121'), ('Modena', 'MO', '41121')]
+STREETS = ['Via Roma', 'Via Industria', 'Via dell\'Artigianato', 'Viale Trento', 'Via Fornaci', 'Via Garibaldi',
+           'Via Brennero', 'Via del Lavoro']
+FIRST_NAMES = ['Marco', 'Luca', 'Andrea', 'Giulia', 'Francesca', 'Matteo', 'Sara', 'Paolo', 'Elena', 'Davide',
+               'Chiara', 'Stefano', 'Simone', 'Anna', 'Alessandro', 'Martina']
+LAST_NAMES = ['Rossi', 'Bianchi', 'Ferrari', 'Esposito', 'Romano', 'Colombo', 'Ricci', 'Marino', 'Greco', 'Bruno',
+              'Gallo', 'Conti', 'Costa', 'Giordano', 'Mancini', 'Lombardi']
+BRANDS = ['ABB', 'KUKA', 'Fanuc', 'Yaskawa', 'Siemens', 'Comau', 'Bosch', 'Festo']
+MACHINE_NAMES = ['Robot saldatura', 'Pressa', 'Nastro trasportatore', 'Pallettizzatore', 'Isola robotizzata',
+                 'Tornio CNC', 'Centro di lavoro', 'Avvolgitore']
+INTERVENTION_TYPES = ['Manutenzione ordinaria', 'Manutenzione straordinaria', 'Guasto', 'Installazione',
+                      'Collaudo', 'Formazione', 'Programmazione']
+LOCATIONS = ['Presso cliente', 'In sede', 'Da remoto']
+DESCRIPTIONS = ['Sostituzione cinghia', 'Verifica finecorsa', 'Aggiornamento software', 'Calibrazione assi',
+                'Sostituzione encoder', 'Pulizia e lubrificazione', 'Verifica impianto pneumatico',
+                'Sostituzione fusibili', 'Ripristino allarmi', 'Controllo sicurezze', 'Modifica programma',
+                'Sostituzione motore', 'Regolazione pinza', 'Verifica cablaggi']
+DURATIONS = [str(hours / 2).replace('.0', '') for hours in range(1, 17)]
+DURATION_WEIGHTS = [8, 14, 12, 14, 8, 9, 5, 12, 3, 3, 2, 3, 1, 1, 1, 4]
+TICKET_STATUSES = ['Aperto', 'In lavorazione', 'Chiuso']
+PRIORITIES = ['Bassa', 'Media', 'Alta']
+
+CHUNK_SIZE = 100000
+
+
+def copy(cursor, table: str, columns: list, rows):
+    count = 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % CHUNK_SIZE == 0:
+            _flush(cursor, table, columns, buffer)
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+    _flush(cursor, table, columns, buffer)
+    return count
+
+
+def _flush(cursor, table: str, columns: list, buffer: io.StringIO):
+    buffer.seek(0)
+    cursor.copy_expert('COPY ' + table + ' (' + ', '.join(columns) + ') FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def next_id(cursor, table: str):
+    cursor.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM ' + table)
+    return cursor.fetchone()[0]
+
+
+def zipf_weights(n: int, s: float = 0.9):
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+
+def working_days(years: int):
+    today = datetime.date.today()
+    day = today - datetime.timedelta(days=365 * years)
+    days = []
+    while day <= today:
+        if day.weekday() < 5:
+            days.append(day)
+        day += datetime.timedelta(days=1)
+    return days
+
+
+def seed(cursor, rng: random.Random, clients: int, plants: int, machines: int, commissions: int, operators: int,
+         supervisors: int, reports: int, tickets: int, years: int):
+    now = datetime.datetime.now()
+    password = get_password_hash('password')
+    cursor.execute("INSERT INTO roles (id, name) VALUES (1, 'admin'), (2, 'operator'), (3, 'supervisor') "
+                   "ON CONFLICT (id) DO NOTHING")
+    cursor.execute("INSERT INTO intervention_types (name) SELECT unnest(%s) WHERE NOT EXISTS "
+                   "(SELECT 1 FROM intervention_types)", (INTERVENTION_TYPES,))
+    cursor.execute("INSERT INTO locations (name) SELECT unnest(%s) WHERE NOT EXISTS (SELECT 1 FROM locations)",
+                   (LOCATIONS,))
+
+    first_client = next_id(cursor, 'clients')
+    client_ids = list(range(first_client, first_client + clients + 1))
+    internal = client_ids.pop(0)
+
+    def client_rows():
+        yield internal, 'Move Automation S.r.l. ' + str(internal), 'TN', 'Rovereto', '38068', 'Via Fornaci, 70', \
+            'info' + str(internal) + '@moveautomation.it', 'Ufficio tecnico', '0464 000000', now
+        for client_id in client_ids:
+            city, province, cap = rng.choice(CITIES)
+            yield client_id, 'Cliente ' + str(client_id) + ' S.r.l.', province, city, cap, \
+                rng.choice(STREETS) + ', ' + str(rng.randint(1, 200)), 'cliente' + str(client_id) + '@example.com', \
+                rng.choice(FIRST_NAMES) + ' ' + rng.choice(LAST_NAMES), '0' + str(rng.randint(100000000, 999999999)), \
+                now
+
+    copy(cursor, 'clients', ['id', 'name', 'province', 'city', 'cap', 'address', 'email', 'contact', 'phone_number',
+                             'date_created'],
+         client_rows())
+
+    first_plant = next_id(cursor, 'plants')
+    plant_clients = [client_id for client_id in client_ids for _ in range(max(1, round(rng.gauss(plants, 1))))]
+
+    def plant_rows():
+        for plant_id, client_id in enumerate(plant_clients, first_plant):
+            city, province, cap = rng.choice(CITIES)
+            yield plant_id, client_id, 'Stabilimento ' + str(plant_id), city, province, cap, \
+                rng.choice(STREETS) + ', ' + str(rng.randint(1, 200)), \
+                'stabilimento' + str(plant_id) + '@example.com' if rng.random() < 0.6 else '', now
+
+    copy(cursor, 'plants', ['id', 'client_id', 'name', 'city', 'province', 'cap', 'address', 'email', 'date_created'],
+         plant_rows())
+
+    first_machine = next_id(cursor, 'machines')
+    machine_plants = [plant_id for plant_id in range(first_plant, first_plant + len(plant_clients))
+                      for _ in range(max(1, round(rng.gauss(machines, 2))))]
+    machines_by_client = {}
+    for machine_id, plant_id in enumerate(machine_plants, first_machine):
+        machines_by_client.setdefault(plant_clients[plant_id - first_plant], []).append(machine_id)
+
+    def machine_rows():
+        for machine_id, plant_id in enumerate(machine_plants, first_machine):
+            yield machine_id, plant_id, 'IR' + str(rng.randint(1, 20)), 'M' + str(machine_id), \
+                rng.choice(MACHINE_NAMES), rng.choice(BRANDS), 'MOD-' + str(rng.randint(100, 999)), \
+                'SN' + str(rng.randint(100000, 999999)), str(rng.randint(1995, 2023)), \
+                'CDC' + str(rng.randint(100, 999)), '', now
+
+    copy(cursor, 'machines', ['id', 'plant_id', 'robotic_island', 'code', 'name', 'brand', 'model', 'serial_number',
+                              'production_year', 'cost_center', 'description', 'date_created'], machine_rows())
+
+    first_commission = next_id(cursor, 'commissions')
+    commission_clients = [client_id for client_id in client_ids if rng.random() < 0.5
+                          for _ in range(rng.randint(1, 2 * commissions))]
+    commissions_by_client = {}
+    for commission_id, client_id in enumerate(commission_clients, first_commission):
+        commissions_by_client.setdefault(client_id, []).append(commission_id)
+
+    def commission_rows():
+        for commission_id, client_id in enumerate(commission_clients, first_commission):
+            closed = rng.random() < 0.7
+            yield commission_id, client_id, 'C' + str(commission_id), 'Commessa ' + str(commission_id), \
+                not closed, now, now if closed else None
+
+    copy(cursor, 'commissions', ['id', 'client_id', 'code', 'description', 'open', 'date_created', 'date_closed'],
+         commission_rows())
+
+    first_user = next_id(cursor, 'operators')
+    operator_ids = list(range(first_user, first_user + operators))
+    supervisors_by_client = {}
+    user_id = first_user + operators
+    for client_id in client_ids:
+        supervisors_by_client[client_id] = list(range(user_id, user_id + supervisors))
+        user_id += supervisors
+
+    def user_rows():
+        for user_id in operator_ids:
+            yield user_id, 1 if user_id == first_user else 2, internal, rng.choice(FIRST_NAMES), \
+                rng.choice(LAST_NAMES), 'operatore' + str(user_id) + '@example.com', 'operatore' + str(user_id), \
+                password
+        for client_id, user_ids in supervisors_by_client.items():
+            for user_id in user_ids:
+                yield user_id, 3, client_id, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), \
+                    'supervisore' + str(user_id) + '@example.com', 'supervisore' + str(user_id), password
+
+    copy(cursor, 'operators', ['id', 'role_id', 'client_id', 'first_name', 'last_name', 'email', 'username',
+                               'password'], user_rows())
+
+    days = working_days(years)
+    day_weights = list(itertools.accumulate([1 + i / len(days) for i in range(len(days))]))
+    client_weights = list(itertools.accumulate(zipf_weights(len(client_ids))))
+    operator_weights = list(itertools.accumulate([rng.lognormvariate(0, 0.5) for _ in operator_ids]))
+    duration_weights = list(itertools.accumulate(DURATION_WEIGHTS))
+    emailed_before = datetime.date.today() - datetime.timedelta(days=60)
+
+    def report_rows():
+        remaining = reports
+        while remaining:
+            size = min(remaining, CHUNK_SIZE)
+            remaining -= size
+            dates = rng.choices(days, cum_weights=day_weights, k=size)
+            clients_chosen = rng.choices(client_ids, cum_weights=client_weights, k=size)
+            operators_chosen = rng.choices(operator_ids, cum_weights=operator_weights, k=size)
+            durations = rng.choices(DURATIONS, cum_weights=duration_weights, k=size)
+            for date, client_id, operator_id, duration in zip(dates, clients_chosen, operators_chosen, durations):
+                if client_id in commissions_by_client and rng.random() < 0.2:
+                    report_type, work_id = 'commission', rng.choice(commissions_by_client[client_id])
+                else:
+                    report_type, work_id = 'machine', rng.choice(machines_by_client[client_id])
+                created = datetime.datetime.combine(date, datetime.time(rng.randint(7, 19), rng.randint(0, 59)))
+                emailed = created + datetime.timedelta(days=rng.randint(0, 10)) \
+                    if date < emailed_before and rng.random() < 0.85 else None
+                yield operator_id, work_id, report_type, date, duration, rng.choice(INTERVENTION_TYPES), \
+                    rng.choice(LOCATIONS), rng.choice(supervisors_by_client[client_id]), \
+                    rng.choice(DESCRIPTIONS), '', str(rng.randint(0, 150)), '', created, emailed
+
+    copy(cursor, 'reports', ['operator_id', 'work_id', 'type', 'date', 'intervention_duration', 'intervention_type',
+                             'intervention_location', 'supervisor_id', 'description', 'notes', 'trip_kms', 'cost',
+                             'date_created', 'email_date'], report_rows())
+
+    def ticket_rows():
+        for _ in range(tickets):
+            client_id = rng.choices(client_ids, cum_weights=client_weights)[0]
+            created = datetime.datetime.combine(rng.choice(days), datetime.time(rng.randint(7, 19)))
+            status = rng.choice(TICKET_STATUSES)
+            yield rng.choice(DESCRIPTIONS), status, rng.choice(PRIORITIES), created, created, \
+                created + datetime.timedelta(days=rng.randint(1, 30)) if status == 'Chiuso' else None, \
+                rng.choice(supervisors_by_client[client_id]), rng.choice(machines_by_client[client_id]), \
+                rng.choice(DESCRIPTIONS)
+
+    copy(cursor, 'tickets', ['title', 'status', 'priority', 'date_created', 'date_edited', 'date_closed',
+                             'requested_by', 'machine_id', 'description'], ticket_rows())
+
+    for table in ('clients', 'plants', 'machines', 'commissions', 'operators', 'reports', 'tickets'):
+        cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), (SELECT COALESCE(MAX(id), 1) FROM " + table +
+                       "))", (table,))
+    return {'clients': len(client_ids) + 1, 'plants': len(plant_clients), 'machines': len(machine_plants),
+            'commissions': len(commission_clients), 'operators': len(operator_ids),
+            'supervisors': sum(len(user_ids) for user_ids in supervisors_by_client.values()), 'reports': reports,
+            'tickets': tickets, 'admin': 'operatore' + str(first_user)}
+
+
+def load(options: dict, truncate: bool = False, rng_seed: int = 42):
+    migrate()
+    partitions.ensure(datetime.date.today().year - options['years'])
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        if truncate:
+            cursor.execute('TRUNCATE reports, tickets, commissions, machines, plants, operators, clients, '
+                           'export_jobs, outbox RESTART IDENTITY CASCADE')
+        counts = seed(cursor, random.Random(rng_seed), **options)
+        connection.commit()
+        cursor.execute('ANALYZE')
+        connection.commit()
+    finally:
+        connection.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill the database with synthetic data for scale testing.')
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    for name in SCALES['small']:
+        parser.add_argument('--' + name, type=int, help='overrides the value of the chosen scale')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--truncate', action='store_true', help='empty the seeded tables first')
+    args = parser.parse_args()
+    options = dict(SCALES[args.scale], **{name: getattr(args, name) for name in SCALES['small']
+                                          if getattr(args, name) is not None})
+
+    start = time.perf_counter()
+    counts = load(options, truncate=args.truncate, rng_seed=args.seed)
+    elapsed = time.perf_counter() - start
+    for name, count in counts.items():
+        print(name + ': ' + str(count))
+    print('password: password')
+    print('seconds: ' + str(math.ceil(elapsed)))
+
+
+if __name__ == '__main__':
+    main()
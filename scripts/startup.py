@@ -0,0 +1,75 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = '''
+import json
+import time
+from fastapi.testclient import TestClient
+start = time.perf_counter()
+import app.main
+imported = time.perf_counter()
+with TestClient(app.main.app) as client:
+    started = time.perf_counter()
+    client.get('/roles')
+    answered = time.perf_counter()
+print(json.dumps({'import': imported - start, 'startup': started - imported, 'first_request': answered - started,
+                  'total': answered - start}))
+'''
+
+
+def probe():
+    output = subprocess.run([sys.executable, '-c', PROBE], capture_output=True, text=True, check=True, cwd=os.getcwd())
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def import_times(limit: int):
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app.main'], capture_output=True,
+                            text=True, check=True, cwd=os.getcwd())
+    modules = {}
+    for line in output.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        if '.' not in name or name.startswith('app.'):
+            modules[name] = int(cumulative) / 1e6
+    return dict(sorted(modules.items(), key=lambda item: -item[1])[:limit])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time a cold start of the app: importing app.main, running the '
+                                                 'startup events and answering the first request, each in a fresh '
+                                                 'interpreter.')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--modules', type=int, default=15, help='how many of the slowest imports to list')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='a previous output to compare against')
+    args = parser.parse_args()
+
+    runs = [probe() for _ in range(args.runs)]
+    results = {'runs': args.runs, 'python': sys.version.split()[0],
+               'median': {key: statistics.median(run[key] for run in runs) for key in runs[0]},
+               'modules': import_times(args.modules)}
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    for key, value in results['median'].items():
+        line = '%-15s %8.0f ms' % (key, value * 1000)
+        if baseline:
+            line += '   was %8.0f ms  %5.2fx' % (baseline['median'][key] * 1000, value / baseline['median'][key])
+        print(line)
+    print('slowest imports:')
+    for name, seconds in results['modules'].items():
+        print('  %-30s %8.0f ms' % (name, seconds * 1000))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
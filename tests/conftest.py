@@ -0,0 +1,51 @@
+import os
+
+import pytest
+from dotenv import load_dotenv
+
+load_dotenv()
+
+if not os.getenv("DATABASE_URL"):
+    collect_ignore_glob = ['test_*.py']
+
+
+@pytest.fixture(scope='session')
+def database():
+    from sqlalchemy import text
+
+    from app.database import engine
+    try:
+        with engine.connect() as connection:
+            connection.execute(text('SELECT 1 FROM reports LIMIT 1'))
+    except Exception as e:
+        pytest.skip('database not available: ' + str(e))
+
+
+@pytest.fixture
+def db(database):
+    from app.database import SessionLocal
+    session = SessionLocal.session_factory()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def admin(db):
+    import app.models as models
+    return db.query(models.User).filter(models.User.role_id == 1).order_by(models.User.id).first()
+
+
+@pytest.fixture
+def client(database):
+    from fastapi.testclient import TestClient
+
+    import app.main
+    return TestClient(app.main.app)
+
+
+@pytest.fixture
+def admin_headers(admin):
+    from datetime import timedelta
+
+    from app.auth import create_access_token
+    return {'Authorization': 'Bearer ' + create_access_token({'sub': admin.username}, timedelta(minutes=10))}
@@ -0,0 +1,49 @@
+import pytest
+
+HEADER = ['client_name', 'name', 'city', 'province', 'cap', 'address', 'email', 'contact', 'phone_number']
+
+
+def plants_csv(rows, delimiter=',', encoding='utf-8'):
+    return '\r\n'.join(delimiter.join(row) for row in [HEADER] + rows).encode(encoding)
+
+
+def import_plants(client, admin_headers, content: bytes):
+    return client.post('/plants/import', headers=admin_headers, files={'file': ('impianti.csv', content, 'text/csv')})
+
+
+def plant(client_name, city='Rovereto'):
+    return [client_name, 'Stabilimento', city, 'TN', '38068', 'Via Inesistente, 1', 'a@example.com', 'Mario',
+            '0464 000000']
+
+
+@pytest.mark.parametrize('delimiter', [',', ';'])
+def test_sniffs_the_delimiter(client, admin_headers, delimiter):
+    response = import_plants(client, admin_headers, plants_csv([plant('Cliente che non esiste')], delimiter))
+
+    assert response.status_code == 200
+    assert response.json() == {'imported': 0, 'errors': [
+        {'row': 2, 'detail': 'Cliente non trovato: Cliente che non esiste'}]}
+
+
+def test_reports_errors_by_row(client, admin_headers):
+    rows = [plant('Cliente che non esiste'), plant(''), plant('Cliente che non esiste', city='')]
+    response = import_plants(client, admin_headers, plants_csv(rows))
+
+    errors = response.json()['errors']
+    assert response.json()['imported'] == 0
+    assert [error['row'] for error in errors] == [2, 3, 4]
+    assert errors[1]['detail'] == 'client_id: field required'
+    assert errors[2]['detail'].startswith('city:')
+
+
+def test_reads_windows_1252_files(client, admin_headers):
+    response = import_plants(client, admin_headers, plants_csv([plant('Società che non esiste')], ';', 'cp1252'))
+
+    assert response.status_code == 200
+    assert response.json()['errors'] == [{'row': 2, 'detail': 'Cliente non trovato: Società che non esiste'}]
+
+
+def test_rejects_files_in_an_unknown_encoding(client, admin_headers):
+    response = import_plants(client, admin_headers, plants_csv([plant('Cliente \x81')], ';', 'latin-1'))
+
+    assert response.status_code == 400
@@ -0,0 +1,32 @@
+import datetime
+
+import pytest
+from sqlalchemy import delete
+
+import app.exports as exports
+import app.models as models
+
+STALE = datetime.datetime(2000, 1, 1)
+
+
+@pytest.fixture
+def jobs(db, admin):
+    jobs = [models.ExportJob(requested_by=admin.id, format='csv', period='monthly', type='machine',
+                             params={'month': '01/2026'}, status='running', date_created=STALE, date_updated=STALE)
+            for _ in range(2)]
+    db.add_all(jobs)
+    db.commit()
+    yield jobs
+    db.execute(delete(models.ExportJob).where(models.ExportJob.id.in_([job.id for job in jobs])))
+    db.commit()
+
+
+def test_heartbeat_keeps_only_this_process_jobs_fresh(db, jobs, monkeypatch):
+    mine, orphaned = jobs
+    monkeypatch.setattr(exports, 'running', {mine.id})
+
+    exports.beat()
+
+    db.expire_all()
+    assert db.query(models.ExportJob).get(mine.id).date_updated > STALE
+    assert db.query(models.ExportJob).get(orphaned.id).date_updated == STALE
@@ -0,0 +1,126 @@
+import datetime
+import socket
+from email.message import EmailMessage
+
+import pytest
+from aiosmtpd.controller import Controller
+from sqlalchemy import delete, update
+
+import app.mail as mail
+import app.models as models
+import app.queries as queries
+
+
+class Handler:
+    def __init__(self):
+        self.responses = []
+        self.received = []
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.responses:
+            return self.responses.pop(0)
+        self.received.append(envelope)
+        return '250 OK'
+
+
+@pytest.fixture
+def smtp_server(monkeypatch):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    handler = Handler()
+    controller = Controller(handler, hostname='127.0.0.1', port=port)
+    controller.start()
+    monkeypatch.setattr(mail, 'MAIL_SERVER', '127.0.0.1')
+    monkeypatch.setattr(mail, 'MAIL_PORT', port)
+    monkeypatch.setattr(mail, 'MAIL_STARTTLS', False)
+    monkeypatch.setattr(mail, 'MAIL_SSL_TLS', False)
+    monkeypatch.setattr(mail, 'MAIL_USERNAME', None)
+    yield handler
+    controller.stop()
+
+
+@pytest.fixture
+def queued(db, admin):
+    message = EmailMessage()
+    message['Subject'] = 'Prova'
+    message['To'] = 'cliente@example.com'
+    message.set_content('Interventi del mese')
+    db_message = mail.enqueue(db, message=message, report_ids=[], user_id=admin.id)
+    # due before anything else in the queue, so the worker claims this one first
+    db.execute(update(models.OutboxMessage).where(models.OutboxMessage.id == db_message.id).values(
+        next_attempt_at=datetime.datetime(2000, 1, 1)))
+    db.commit()
+    yield db_message
+    db.execute(delete(models.OutboxMessage).where(models.OutboxMessage.id == db_message.id))
+    db.commit()
+
+
+def reload(db, message):
+    db.expire_all()
+    return db.query(models.OutboxMessage).get(message.id)
+
+
+def rewind(db, message):
+    db.execute(update(models.OutboxMessage).where(models.OutboxMessage.id == message.id).values(
+        next_attempt_at=datetime.datetime(2000, 1, 1)))
+    db.commit()
+
+
+def test_delivers_queued_message(db, smtp_server, queued):
+    db.expunge_all()
+    with queries.count_queries() as stats:
+        smtp, message = mail.send_next(db, None)
+    mail.disconnect(smtp)
+
+    assert message.id == queued.id
+    # claim and complete only: the body comes back with the claim, not from a lazy load
+    assert stats.count == 2
+    assert [envelope.rcpt_tos for envelope in smtp_server.received] == [['cliente@example.com']]
+    assert b'Interventi del mese' in smtp_server.received[0].content
+    sent = reload(db, queued)
+    assert (sent.status, sent.attempts, sent.error) == ('sent', 1, None)
+    assert sent.date_sent is not None
+
+
+def test_retries_with_backoff_then_fails(db, smtp_server, queued, monkeypatch):
+    monkeypatch.setattr(mail, 'MAIL_MAX_ATTEMPTS', 3)
+    monkeypatch.setattr(mail, 'MAIL_RETRY_SECONDS', 60)
+    smtp_server.responses = ['451 4.3.0 Riprova piu tardi'] * 3
+    smtp = None
+    for attempt, delay in ((1, 60), (2, 120)):
+        smtp, _ = mail.send_next(db, smtp)
+        message = reload(db, queued)
+        assert (message.status, message.attempts) == ('queued', attempt)
+        assert '451' in message.error
+        assert round((message.next_attempt_at - message.date_updated).total_seconds()) == delay
+        rewind(db, queued)
+    smtp, _ = mail.send_next(db, smtp)
+    mail.disconnect(smtp)
+
+    message = reload(db, queued)
+    assert (message.status, message.attempts) == ('failed', 3)
+    assert smtp_server.received == []
+
+
+def test_permanent_rejection_fails_at_once(db, smtp_server, queued):
+    smtp_server.responses = ['550 5.1.1 Destinatario sconosciuto']
+    smtp, _ = mail.send_next(db, None)
+    mail.disconnect(smtp)
+
+    message = reload(db, queued)
+    assert (message.status, message.attempts) == ('failed', 1)
+    assert '550' in message.error
+
+
+def test_requeues_message_left_sending_by_a_dead_worker(db, smtp_server, queued):
+    db.execute(update(models.OutboxMessage).where(models.OutboxMessage.id == queued.id).values(
+        status='sending', date_updated=datetime.datetime(2000, 1, 1)))
+    db.commit()
+
+    mail.requeue_stale(db)
+    smtp, message = mail.send_next(db, None)
+    mail.disconnect(smtp)
+
+    assert message.id == queued.id
+    assert reload(db, queued).status == 'sent'
@@ -0,0 +1,24 @@
+import threading
+
+import app.profiler as profiler
+
+
+def test_request_profile_samples_only_the_tagged_request(client, admin_headers, monkeypatch):
+    monkeypatch.setattr(profiler, 'PROFILE_TOKEN', 'segreto')
+    stop = threading.Event()
+
+    def unrelated_work():
+        while not stop.is_set():
+            sum(range(1000))
+
+    thread = threading.Thread(target=unrelated_work)
+    thread.start()
+    try:
+        response = client.get('/reports?limit=2000', headers=dict(admin_headers, **{'x-profile': 'segreto'}))
+    finally:
+        stop.set()
+        thread.join()
+
+    collapsed = profiler.profiles[response.headers['x-profile-id']]
+    assert 'get_reports' in collapsed
+    assert 'unrelated_work' not in collapsed
@@ -0,0 +1,27 @@
+import pytest
+from sqlalchemy import func
+
+import app.models as models
+from app.queries import assert_query_budget
+
+
+@pytest.fixture
+def report(db):
+    return db.query(models.Report).filter(models.Report.id == db.query(func.max(models.Report.id)).filter(
+        models.Report.type == 'machine').scalar_subquery()).one()
+
+
+# each page loads in one query, plus one to authenticate on the admin routes; more usually means an N+1
+@pytest.mark.parametrize('url, budget', [
+    ('/reports?limit=100', 2),
+    ('/report/{report.id}', 2),
+    ('/report/{report.id}/pdf', 2),
+    ('/reports/monthly?month={month}&user_id={report.operator_id}&plant_id=0', 1),
+    ('/reports/monthly/pdf?month={month}&user_id={report.operator_id}&plant_id=0', 1),
+    ('/reports/monthly/csv?month={month}&user_id={report.operator_id}&plant_id=0', 1),
+])
+def test_report_endpoints_stay_within_query_budget(client, admin_headers, report, url, budget):
+    response = client.get(url.format(report=report, month=report.date.strftime('%m/%Y')), headers=admin_headers)
+
+    assert response.status_code == 200
+    assert_query_budget(response, budget)
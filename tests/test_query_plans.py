@@ -0,0 +1,36 @@
+import json
+import os
+
+import pytest
+
+from scripts import explain
+from scripts.benchmark import parameters
+
+EXPLAIN_BASELINE = os.getenv("EXPLAIN_BASELINE", "explain.json")
+EXPLAIN_THRESHOLD = float(os.getenv("EXPLAIN_THRESHOLD", "0.5"))
+EXPLAIN_MIN_ROWS = int(os.getenv("EXPLAIN_MIN_ROWS", "10000"))
+
+
+def baseline():
+    try:
+        with open(EXPLAIN_BASELINE) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def test_query_plans_use_indexes_and_stay_under_the_baseline(db):
+    try:
+        params = parameters(db)
+    except SystemExit as e:
+        pytest.skip(str(e))
+    large, partitions, ceilings = explain.large_tables(db, EXPLAIN_MIN_ROWS), explain.parents(db), baseline()
+
+    failures = {}
+    for name, fn, allowed in explain.cases(db, params):
+        result = explain.check(db, name, fn, allowed, large, partitions, ceilings, EXPLAIN_THRESHOLD)
+        if result['failures']:
+            failures[name] = result['failures']
+    db.rollback()
+
+    assert failures == {}
@@ -0,0 +1,108 @@
+import re
+
+import pytest
+
+import app.crud as crud
+import app.database as database
+import app.models as models
+from app.database import READ_YOUR_WRITES_COOKIE, caught_up_replica, current_writes, engine, read_session, \
+    replica_engine
+
+
+@pytest.fixture
+def writes():
+    writes = []
+    token = current_writes.set(writes)
+    yield writes
+    current_writes.reset(token)
+
+
+@pytest.fixture
+def commission(db):
+    return db.query(models.Commission).order_by(models.Commission.id).first()
+
+
+def test_read_only_commit_is_not_a_write(db, writes, commission):
+    commission.description = commission.description
+    db.commit()
+
+    assert writes == []
+
+
+def test_flushed_change_is_a_write(db, writes, commission):
+    description = commission.description
+    commission.description = (description or '') + ' '
+    db.commit()
+    commission.description = description
+    db.commit()
+
+    assert len(writes) == 2
+
+
+def test_returning_statement_is_a_write(db, writes, commission):
+    crud.close_commission(db, commission.id)
+    crud.close_commission(db, commission.id)
+
+    assert len(writes) == 2
+
+
+def test_rolled_back_change_is_not_a_write(db, writes, commission):
+    commission.description = (commission.description or '') + ' '
+    db.flush()
+    db.rollback()
+    db.commit()
+
+    assert writes == []
+
+
+replica = pytest.mark.skipif(not database.REPLICA_DATABASE_URL, reason='REPLICA_DATABASE_URL is not set')
+
+
+@replica
+@pytest.mark.usefixtures('database')
+def test_reads_go_to_the_replica():
+    db = read_session()
+    try:
+        assert db.get_bind() is replica_engine
+    finally:
+        db.close()
+
+
+@replica
+@pytest.mark.usefixtures('database')
+def test_reads_go_to_the_replica_once_it_replayed_the_write():
+    db = read_session('0/0')
+    try:
+        assert db.get_bind() is replica_engine
+    finally:
+        db.close()
+
+
+@replica
+@pytest.mark.usefixtures('database')
+def test_reads_fall_back_to_the_primary_until_the_replica_replays_the_write():
+    db = read_session('FFFFFFFF/FFFFFFFF')
+    try:
+        assert db.get_bind() is engine
+    finally:
+        db.close()
+
+
+@replica
+def test_writes_set_the_lsn_cookie(client, admin_headers, commission):
+    read = client.get('/reports?limit=1', headers=admin_headers)
+    url = '/commission/close?commission_id=' + str(commission.id)
+    written = client.put(url, headers=admin_headers)
+    client.put(url, headers=admin_headers)
+
+    assert READ_YOUR_WRITES_COOKIE not in read.cookies
+    assert written.status_code == 200
+    assert re.fullmatch('[0-9A-F]+/[0-9A-F]+', written.cookies[READ_YOUR_WRITES_COOKIE])
+
+
+@replica
+def test_caught_up_replica_gives_up_after_the_wait(db, monkeypatch):
+    monkeypatch.setattr(database, 'REPLICA_WAIT_SECONDS', 0.2)
+    monkeypatch.setattr(database, 'current_lsn', lambda db: 'FFFFFFFF/FFFFFFFF')
+
+    assert caught_up_replica(db) is None
@@ -0,0 +1,48 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import delete, func
+
+import app.mail as mail
+import app.models as models
+
+
+def commission_month(db):
+    month = func.to_char(models.Report.date, 'MM/YYYY')
+    return db.query(month, models.Commission.client_id, models.Report.operator_id).join(
+        models.Commission, models.Report.work_id == models.Commission.id).filter(
+        models.Report.type == 'commission').group_by(month, models.Commission.client_id,
+                                                     models.Report.operator_id).having(
+        func.count().between(1, 3)).first()
+
+
+def test_commission_reports_go_to_the_client_address(db, client, admin_headers):
+    row = commission_month(db)
+    if row is None:
+        pytest.skip('no commission month with 1 to 3 reports')
+    month, client_id, operator_id = row
+    email = db.query(models.Client.email).filter(models.Client.id == client_id).scalar()
+
+    response = client.post('/reports/monthly/email', headers=admin_headers, json={
+        'month': month, 'type': 'commission', 'client_id': client_id, 'user_id': operator_id})
+    queued = response.json().get('queued', [])
+    db.execute(delete(models.OutboxMessage).where(models.OutboxMessage.id.in_([item['id'] for item in queued])))
+    db.commit()
+
+    assert response.status_code == 200
+    if email:
+        assert {item['recipient'] for item in queued} == {email.strip()}
+        assert response.json()['skipped'] == []
+    else:
+        assert queued == []
+
+
+def test_bulk_email_with_one_report_lists_it_as_a_batch():
+    report = SimpleNamespace(last_name='Rossi', first_name='Mario', client_name='Cliente S.r.l.',
+                             Report=SimpleNamespace(id=1, date=datetime.date(2026, 1, 5)))
+
+    body = mail.reports_message([report], 'cliente@example.com', '01/2026', []).get_body(('html',)).get_content()
+
+    assert 'gli interventi presso Cliente S.r.l. del mese 01/2026' in body
+    assert "l'intervento di" not in body